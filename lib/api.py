@@ -13,6 +13,7 @@ import urllib
 import functools
 
 from logging import handlers as logging_handlers
+import gevent.pool
 from gevent import wsgi
 from geventhttpclient import HTTPClient
 from geventhttpclient.url import URL
@@ -24,11 +25,12 @@ from bson import json_util
 from bson.son import SON
 
 from lib import config, siofeeds, util, blockchain, util_litecoin
-from lib.components import betting, rps, assets, assets_trading, dex
+from lib.components import betting, rps, assets, assets_trading, dex, candles
 
 PREFERENCES_MAX_LENGTH = 100000 #in bytes, as expressed in JSON
 API_MAX_LOG_SIZE = 10 * 1024 * 1024 #max log size of 20 MB before rotation (make configurable later)
 API_MAX_LOG_COUNT = 10
+ADDRESS_HISTORY_FETCH_CONCURRENCY = 6 #max number of concurrent litetokensd calls made for one _get_address_history
 
 decimal.setcontext(decimal.Context(prec=8, rounding=decimal.ROUND_HALF_EVEN))
 D = decimal.Decimal
@@ -39,7 +41,6 @@ def serve_api(mongo_db, redis_client):
     # use liteblockd to not only pull useful data, but also load and store their own preferences, containing
     # whatever data they need
     
-    DEFAULT_COUNTERPARTYD_API_CACHE_PERIOD = 60 #in seconds
     app = flask.Flask(__name__)
     tx_logger = logging.getLogger("transaction_log") #get transaction logger
     
@@ -160,7 +161,7 @@ def serve_api(mongo_db, redis_client):
         for d in result:
             if not d['quantity'] and ((d['address'] + d['asset']) not in isowner):
                 continue #don't include balances with a zero asset value
-            asset_info = mongo_db.tracked_assets.find_one({'asset': d['asset']})
+            asset_info = util.get_tracked_asset(d['asset'])
             d['normalized_quantity'] = util_litecoin.normalize_quantity(d['quantity'], asset_info['divisible'])
             d['owner'] = (d['address'] + d['asset']) in isowner
             mappings[d['address'] + d['asset']] = d
@@ -185,164 +186,168 @@ def serve_api(mongo_db, redis_client):
         return assets.get_escrowed_balances(addresses)
 
     def _get_address_history(address, start_block=None, end_block=None):
-        address_dict = {}
+        calls = [] #(category, method, params) tuples
         
-        address_dict['balances'] = util.call_jsonrpc_api("get_balances",
+        calls.append(('balances', "get_balances",
             { 'filters': [{'field': 'address', 'op': '==', 'value': address},],
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['debits'] = util.call_jsonrpc_api("get_debits",
+        calls.append(('debits', "get_debits",
             { 'filters': [{'field': 'address', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['credits'] = util.call_jsonrpc_api("get_credits",
+        calls.append(('credits', "get_credits",
             { 'filters': [{'field': 'address', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['burns'] = util.call_jsonrpc_api("get_burns",
+        calls.append(('burns', "get_burns",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['sends'] = util.call_jsonrpc_api("get_sends",
+        calls.append(('sends', "get_sends",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address}, {'field': 'destination', 'op': '==', 'value': address}],
               'filterop': 'or',
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         #^ with filterop == 'or', we get all sends where this address was the source OR destination 
         
-        address_dict['orders'] = util.call_jsonrpc_api("get_orders",
+        calls.append(('orders', "get_orders",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
 
-        address_dict['order_matches'] = util.call_jsonrpc_api("get_order_matches",
+        calls.append(('order_matches', "get_order_matches",
             { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
               'filterop': 'or',
               'order_by': 'tx0_block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['ltcpays'] = util.call_jsonrpc_api("get_ltcpays",
+        calls.append(('ltcpays', "get_ltcpays",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address}, {'field': 'destination', 'op': '==', 'value': address}],
               'filterop': 'or',
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['issuances'] = util.call_jsonrpc_api("get_issuances",
+        calls.append(('issuances', "get_issuances",
             { 'filters': [{'field': 'issuer', 'op': '==', 'value': address}, {'field': 'source', 'op': '==', 'value': address}],
               'filterop': 'or',
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['broadcasts'] = util.call_jsonrpc_api("get_broadcasts",
+        calls.append(('broadcasts', "get_broadcasts",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
 
-        address_dict['bets'] = util.call_jsonrpc_api("get_bets",
+        calls.append(('bets', "get_bets",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['bet_matches'] = util.call_jsonrpc_api("get_bet_matches",
+        calls.append(('bet_matches', "get_bet_matches",
             { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
               'filterop': 'or',
               'order_by': 'tx0_block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['dividends'] = util.call_jsonrpc_api("get_dividends",
+        calls.append(('dividends', "get_dividends",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
         
-        address_dict['cancels'] = util.call_jsonrpc_api("get_cancels",
+        calls.append(('cancels', "get_cancels",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['callbacks'] = util.call_jsonrpc_api("get_callbacks",
+        calls.append(('callbacks', "get_callbacks",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['bet_expirations'] = util.call_jsonrpc_api("get_bet_expirations",
+        calls.append(('bet_expirations', "get_bet_expirations",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['order_expirations'] = util.call_jsonrpc_api("get_order_expirations",
+        calls.append(('order_expirations', "get_order_expirations",
             { 'filters': [{'field': 'source', 'op': '==', 'value': address},],
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['bet_match_expirations'] = util.call_jsonrpc_api("get_bet_match_expirations",
+        calls.append(('bet_match_expirations', "get_bet_match_expirations",
             { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
               'filterop': 'or',
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
-        address_dict['order_match_expirations'] = util.call_jsonrpc_api("get_order_match_expirations",
+        calls.append(('order_match_expirations', "get_order_match_expirations",
             { 'filters': [{'field': 'tx0_address', 'op': '==', 'value': address}, {'field': 'tx1_address', 'op': '==', 'value': address},],
               'filterop': 'or',
               'order_by': 'block_index',
               'order_dir': 'asc',
               'start_block': start_block,
               'end_block': end_block,
-            }, abort_on_error=True)['result']
+            }))
     
+        #make the calls concurrently, so that this takes about as long as the slowest call (instead of all of them)
+        pool = gevent.pool.Pool(ADDRESS_HISTORY_FETCH_CONCURRENCY)
+        results = pool.map(lambda c: util.call_jsonrpc_api(c[1], c[2], abort_on_error=True)['result'], calls)
+        address_dict = dict(zip([c[0] for c in calls], results))
         return address_dict
 
     @dispatcher.add_method
@@ -369,7 +374,7 @@ def serve_api(mongo_db, redis_client):
         def get_asset_cached(asset, asset_cache):
             if asset in asset_cache:
                 return asset_cache[asset]
-            asset_data = mongo_db.tracked_assets.find_one({'asset': asset})
+            asset_data = util.get_tracked_asset(asset)
             asset_cache[asset] = asset_data
             return asset_data
         
@@ -407,8 +412,8 @@ def serve_api(mongo_db, redis_client):
         """
         #DEPRECATED 1.5
         base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
-        base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
-        quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
+        base_asset_info = util.get_tracked_asset(base_asset)
+        quote_asset_info = util.get_tracked_asset(quote_asset)
         pair_name = "%s/%s" % (base_asset, quote_asset)
 
         if not base_asset_info or not quote_asset_info:
@@ -542,56 +547,27 @@ def serve_api(mongo_db, redis_client):
             start_ts = end_ts - (180 * 24 * 60 * 60) 
         base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
         
-        #get ticks -- open, high, low, close, volume
-        result = mongo_db.trades.aggregate([
-            {"$match": {
-                "base_asset": base_asset,
-                "quote_asset": quote_asset,
-                "block_time": {
-                    "$gte": datetime.datetime.utcfromtimestamp(start_ts)
-                } if end_ts == now_ts else {
-                    "$gte": datetime.datetime.utcfromtimestamp(start_ts),
-                    "$lte": datetime.datetime.utcfromtimestamp(end_ts)                    
-                }                
-            }},
-            {"$project": {
-                "year":  {"$year": "$block_time"},
-                "month": {"$month": "$block_time"},
-                "day":   {"$dayOfMonth": "$block_time"},
-                "hour":  {"$hour": "$block_time"},
-                "block_index": 1,
-                "unit_price": 1,
-                "base_quantity_normalized": 1 #to derive volume
-            }},
-            {"$group": {
-                "_id":   {"year": "$year", "month": "$month", "day": "$day", "hour": "$hour"},
-                "open":  {"$first": "$unit_price"},
-                "high":  {"$max": "$unit_price"},
-                "low":   {"$min": "$unit_price"},
-                "close": {"$last": "$unit_price"},
-                "vol":   {"$sum": "$base_quantity_normalized"},
-                "count": {"$sum": 1},
-            }},
-            {"$sort": SON([("_id.year", pymongo.ASCENDING), ("_id.month", pymongo.ASCENDING), ("_id.day", pymongo.ASCENDING), ("_id.hour", pymongo.ASCENDING)])},
-        ])
-        if not result['ok'] or not len(result['result']):
+        #get ticks -- open, high, low, close, volume (from the pre-aggregated hourly candles)
+        result = candles.get_candles(mongo_db, base_asset, quote_asset, '1h', datetime.datetime.utcfromtimestamp(start_ts),
+            datetime.datetime.utcfromtimestamp(end_ts) if end_ts != now_ts else None)
+        if not len(result):
             return False
-        result = result['result']
         
         midline = [((r['high'] + r['low']) / 2.0) for r in result]
         if as_dict:
+            dict_result = []
             for i in xrange(len(result)):
-                result[i]['interval_time'] = int(time.mktime(datetime.datetime(
-                    result[i]['_id']['year'], result[i]['_id']['month'], result[i]['_id']['day'], result[i]['_id']['hour']).timetuple()) * 1000)
-                result[i]['midline'] = midline[i]
-                del result[i]['_id']
-            return result
+                dict_result.append({
+                    'interval_time': int(time.mktime(result[i]['interval_time'].timetuple()) * 1000),
+                    'open': result[i]['open'], 'high': result[i]['high'], 'low': result[i]['low'], 'close': result[i]['close'],
+                    'vol': result[i]['vol'], 'count': result[i]['count'], 'midline': midline[i],
+                })
+            return dict_result
         else:
             list_result = []
             for i in xrange(len(result)):
                 list_result.append([
-                    int(time.mktime(datetime.datetime(
-                        result[i]['_id']['year'], result[i]['_id']['month'], result[i]['_id']['day'], result[i]['_id']['hour']).timetuple()) * 1000),
+                    int(time.mktime(result[i]['interval_time'].timetuple()) * 1000),
                     result[i]['open'], result[i]['high'], result[i]['low'], result[i]['close'], result[i]['vol'],
                     result[i]['count'], midline[i]
                 ])
@@ -643,143 +619,178 @@ def serve_api(mongo_db, redis_client):
         @param: normalized_fee_provided: Only specify if selling LTC. If specified, the order book will be pruned down to only
          show orders at and above this fee_provided
         """
-        base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
-        quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
+        base_asset_info = util.get_tracked_asset(base_asset)
+        quote_asset_info = util.get_tracked_asset(quote_asset)
         
         if not base_asset_info or not quote_asset_info:
             raise Exception("Invalid asset(s)")
         
-        #TODO: limit # results to 8 or so for each book (we have to sort as well to limit)
-        base_bid_filters = [
-            {"field": "get_asset", "op": "==", "value": base_asset},
-            {"field": "give_asset", "op": "==", "value": quote_asset},
-        ]
-        base_ask_filters = [
-            {"field": "get_asset", "op": "==", "value": quote_asset},
-            {"field": "give_asset", "op": "==", "value": base_asset},
-        ]
-        if base_asset == config.LTC or quote_asset == config.LTC:
-            extra_filters = [
-                {'field': 'give_remaining', 'op': '>', 'value': 0}, #don't show empty LTC orders
-                {'field': 'get_remaining', 'op': '>', 'value': 0}, #don't show empty LTC orders
-                {'field': 'fee_required_remaining', 'op': '>=', 'value': 0},
-                {'field': 'fee_provided_remaining', 'op': '>=', 'value': 0},
+        def get_orders_from_litetokensd():
+            base_bid_filters = [
+                {"field": "get_asset", "op": "==", "value": base_asset},
+                {"field": "give_asset", "op": "==", "value": quote_asset},
             ]
-            base_bid_filters += extra_filters
-            base_ask_filters += extra_filters
-        
-        base_bid_orders = util.call_jsonrpc_api("get_orders", {
-             'filters': base_bid_filters,
-             'show_expired': False,
-             'status': 'open',
-             'order_by': 'block_index',
-             'order_dir': 'asc',
-            }, abort_on_error=True)['result']
-
-        base_ask_orders = util.call_jsonrpc_api("get_orders", {
-             'filters': base_ask_filters,
-             'show_expired': False,
-             'status': 'open',
-             'order_by': 'block_index',
-             'order_dir': 'asc',
-            }, abort_on_error=True)['result']
+            base_ask_filters = [
+                {"field": "get_asset", "op": "==", "value": quote_asset},
+                {"field": "give_asset", "op": "==", "value": base_asset},
+            ]
+            if base_asset == config.LTC or quote_asset == config.LTC:
+                extra_filters = [
+                    {'field': 'give_remaining', 'op': '>', 'value': 0}, #don't show empty LTC orders
+                    {'field': 'get_remaining', 'op': '>', 'value': 0}, #don't show empty LTC orders
+                    {'field': 'fee_required_remaining', 'op': '>=', 'value': 0},
+                    {'field': 'fee_provided_remaining', 'op': '>=', 'value': 0},
+                ]
+                base_bid_filters += extra_filters
+                base_ask_filters += extra_filters
         
-        def get_o_pct(o):
-            if o['give_asset'] == config.LTC: #NB: fee_provided could be zero here
-                pct_fee_provided = float(( D(o['fee_provided_remaining']) / D(o['give_quantity']) ))
-            else: pct_fee_provided = None
-            if o['get_asset'] == config.LTC: #NB: fee_required could be zero here
-                pct_fee_required = float(( D(o['fee_required_remaining']) / D(o['get_quantity']) ))
-            else: pct_fee_required = None
-            return pct_fee_provided, pct_fee_required
-
-        #filter results by pct_fee_provided and pct_fee_required for LTC pairs as appropriate
-        filtered_base_bid_orders = []
-        filtered_base_ask_orders = []
-        if base_asset == config.LTC or quote_asset == config.LTC:      
-            for o in base_bid_orders:
-                pct_fee_provided, pct_fee_required = get_o_pct(o)
-                addToBook = True
-                if bid_book_min_pct_fee_provided is not None and pct_fee_provided is not None and pct_fee_provided < bid_book_min_pct_fee_provided:
-                    addToBook = False
-                if bid_book_min_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required < bid_book_min_pct_fee_required:
-                    addToBook = False
-                if bid_book_max_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required > bid_book_max_pct_fee_required:
-                    addToBook = False
-                if addToBook: filtered_base_bid_orders.append(o)
-            for o in base_ask_orders:
-                pct_fee_provided, pct_fee_required = get_o_pct(o)
-                addToBook = True
-                if ask_book_min_pct_fee_provided is not None and pct_fee_provided is not None and pct_fee_provided < ask_book_min_pct_fee_provided:
-                    addToBook = False
-                if ask_book_min_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required < ask_book_min_pct_fee_required:
-                    addToBook = False
-                if ask_book_max_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required > ask_book_max_pct_fee_required:
-                    addToBook = False
-                if addToBook: filtered_base_ask_orders.append(o)
-        else:
-            filtered_base_bid_orders += base_bid_orders
-            filtered_base_ask_orders += base_ask_orders
+            base_bid_orders = util.call_jsonrpc_api("get_orders", {
+                 'filters': base_bid_filters,
+                 'show_expired': False,
+                 'status': 'open',
+                 'order_by': 'block_index',
+                 'order_dir': 'asc',
+                }, abort_on_error=True)['result']
+
+            base_ask_orders = util.call_jsonrpc_api("get_orders", {
+                 'filters': base_ask_filters,
+                 'show_expired': False,
+                 'status': 'open',
+                 'order_by': 'block_index',
+                 'order_dir': 'asc',
+                }, abort_on_error=True)['result']
+            return base_bid_orders, base_ask_orders
+
+        def get_orders_from_index():
+            base_bid_orders = []
+            base_ask_orders = []
+            for o in dex.order_book_index.get_orders(base_asset, quote_asset):
+                if (base_asset == config.LTC or quote_asset == config.LTC) and (
+                       o['give_remaining'] <= 0 or o['get_remaining'] <= 0 #don't show empty LTC orders
+                    or o['fee_required_remaining'] < 0 or o['fee_provided_remaining'] < 0):
+                    continue
+                if o['get_asset'] == base_asset:
+                    base_bid_orders.append(o)
+                else:
+                    base_ask_orders.append(o)
+            return base_bid_orders, base_ask_orders
+
+        def compile_books(base_bid_orders, base_ask_orders):
+            def get_o_pct(o):
+                if o['give_asset'] == config.LTC: #NB: fee_provided could be zero here
+                    pct_fee_provided = float(( D(o['fee_provided_remaining']) / D(o['give_quantity']) ))
+                else: pct_fee_provided = None
+                if o['get_asset'] == config.LTC: #NB: fee_required could be zero here
+                    pct_fee_required = float(( D(o['fee_required_remaining']) / D(o['get_quantity']) ))
+                else: pct_fee_required = None
+                return pct_fee_provided, pct_fee_required
+
+            #filter results by pct_fee_provided and pct_fee_required for LTC pairs as appropriate
+            filtered_base_bid_orders = []
+            filtered_base_ask_orders = []
+            if base_asset == config.LTC or quote_asset == config.LTC:      
+                for o in base_bid_orders:
+                    pct_fee_provided, pct_fee_required = get_o_pct(o)
+                    addToBook = True
+                    if bid_book_min_pct_fee_provided is not None and pct_fee_provided is not None and pct_fee_provided < bid_book_min_pct_fee_provided:
+                        addToBook = False
+                    if bid_book_min_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required < bid_book_min_pct_fee_required:
+                        addToBook = False
+                    if bid_book_max_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required > bid_book_max_pct_fee_required:
+                        addToBook = False
+                    if addToBook: filtered_base_bid_orders.append(o)
+                for o in base_ask_orders:
+                    pct_fee_provided, pct_fee_required = get_o_pct(o)
+                    addToBook = True
+                    if ask_book_min_pct_fee_provided is not None and pct_fee_provided is not None and pct_fee_provided < ask_book_min_pct_fee_provided:
+                        addToBook = False
+                    if ask_book_min_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required < ask_book_min_pct_fee_required:
+                        addToBook = False
+                    if ask_book_max_pct_fee_required is not None and pct_fee_required is not None and pct_fee_required > ask_book_max_pct_fee_required:
+                        addToBook = False
+                    if addToBook: filtered_base_ask_orders.append(o)
+            else:
+                filtered_base_bid_orders += base_bid_orders
+                filtered_base_ask_orders += base_ask_orders
 
 
-        def make_book(orders, isBidBook):
-            book = {}
-            for o in orders:
-                if o['give_asset'] == base_asset:
-                    if base_asset == config.LTC and o['give_quantity'] <= config.ORDER_LTC_DUST_LIMIT_CUTOFF:
-                        continue #filter dust orders, if necessary
+            def make_book(orders, isBidBook):
+                book = {}
+                for o in orders:
+                    if o['give_asset'] == base_asset:
+                        if base_asset == config.LTC and o['give_quantity'] <= config.ORDER_LTC_DUST_LIMIT_CUTOFF:
+                            continue #filter dust orders, if necessary
                     
-                    give_quantity = util_litecoin.normalize_quantity(o['give_quantity'], base_asset_info['divisible'])
-                    get_quantity = util_litecoin.normalize_quantity(o['get_quantity'], quote_asset_info['divisible'])
-                    unit_price = float(( D(get_quantity) / D(give_quantity) ))
-                    remaining = util_litecoin.normalize_quantity(o['give_remaining'], base_asset_info['divisible'])
-                else:
-                    if quote_asset == config.LTC and o['give_quantity'] <= config.ORDER_LTC_DUST_LIMIT_CUTOFF:
-                        continue #filter dust orders, if necessary
-
-                    give_quantity = util_litecoin.normalize_quantity(o['give_quantity'], quote_asset_info['divisible'])
-                    get_quantity = util_litecoin.normalize_quantity(o['get_quantity'], base_asset_info['divisible'])
-                    unit_price = float(( D(give_quantity) / D(get_quantity) ))
-                    remaining = util_litecoin.normalize_quantity(o['get_remaining'], base_asset_info['divisible'])
-                id = "%s_%s_%s" % (base_asset, quote_asset, unit_price)
-                #^ key = {base}_{bid}_{unit_price}, values ref entries in book
-                book.setdefault(id, {'unit_price': unit_price, 'quantity': 0, 'count': 0})
-                book[id]['quantity'] += remaining #base quantity outstanding
-                book[id]['count'] += 1 #num orders at this price level
-            book = sorted(book.itervalues(), key=operator.itemgetter('unit_price'), reverse=isBidBook)
-            #^ convert to list and sort -- bid book = descending, ask book = ascending
-            return book
+                        give_quantity = util_litecoin.normalize_quantity(o['give_quantity'], base_asset_info['divisible'])
+                        get_quantity = util_litecoin.normalize_quantity(o['get_quantity'], quote_asset_info['divisible'])
+                        unit_price = float(( D(get_quantity) / D(give_quantity) ))
+                        remaining = util_litecoin.normalize_quantity(o['give_remaining'], base_asset_info['divisible'])
+                    else:
+                        if quote_asset == config.LTC and o['give_quantity'] <= config.ORDER_LTC_DUST_LIMIT_CUTOFF:
+                            continue #filter dust orders, if necessary
+
+                        give_quantity = util_litecoin.normalize_quantity(o['give_quantity'], quote_asset_info['divisible'])
+                        get_quantity = util_litecoin.normalize_quantity(o['get_quantity'], base_asset_info['divisible'])
+                        unit_price = float(( D(give_quantity) / D(get_quantity) ))
+                        remaining = util_litecoin.normalize_quantity(o['get_remaining'], base_asset_info['divisible'])
+                    id = "%s_%s_%s" % (base_asset, quote_asset, unit_price)
+                    #^ key = {base}_{bid}_{unit_price}, values ref entries in book
+                    book.setdefault(id, {'unit_price': unit_price, 'quantity': 0, 'count': 0})
+                    book[id]['quantity'] += remaining #base quantity outstanding
+                    book[id]['count'] += 1 #num orders at this price level
+                book = sorted(book.itervalues(), key=operator.itemgetter('unit_price'), reverse=isBidBook)
+                #^ convert to list and sort -- bid book = descending, ask book = ascending
+                return book
         
-        #compile into a single book, at volume tiers
-        base_bid_book = make_book(filtered_base_bid_orders, True)
-        base_ask_book = make_book(filtered_base_ask_orders, False)
-
-        #get stats like the spread and median
-        if base_bid_book and base_ask_book:
-            #don't do abs(), as this is "the amount by which the ask price exceeds the bid", so I guess it could be negative
-            # if there is overlap in the book (right?)
-            bid_ask_spread = float(( D(base_ask_book[0]['unit_price']) - D(base_bid_book[0]['unit_price']) ))
-            bid_ask_median = float(( D( max(base_ask_book[0]['unit_price'], base_bid_book[0]['unit_price']) ) - (D(abs(bid_ask_spread)) / 2) ))
-        else:
-            bid_ask_spread = 0
-            bid_ask_median = 0
+            #compile into a single book, at volume tiers
+            base_bid_book = make_book(filtered_base_bid_orders, True)
+            base_ask_book = make_book(filtered_base_ask_orders, False)
+
+            #get stats like the spread and median
+            if base_bid_book and base_ask_book:
+                #don't do abs(), as this is "the amount by which the ask price exceeds the bid", so I guess it could be negative
+                # if there is overlap in the book (right?)
+                bid_ask_spread = float(( D(base_ask_book[0]['unit_price']) - D(base_bid_book[0]['unit_price']) ))
+                bid_ask_median = float(( D( max(base_ask_book[0]['unit_price'], base_bid_book[0]['unit_price']) ) - (D(abs(bid_ask_spread)) / 2) ))
+            else:
+                bid_ask_spread = 0
+                bid_ask_median = 0
         
-        #compose depth and round out quantities
-        bid_depth = D(0)
-        for o in base_bid_book:
-            o['quantity'] = float(D(o['quantity']))
-            bid_depth += D(o['quantity'])
-            o['depth'] = float(D(bid_depth))
-        bid_depth = float(D(bid_depth))
-        ask_depth = D(0)
-        for o in base_ask_book:
-            o['quantity'] = float(D(o['quantity']))
-            ask_depth += D(o['quantity'])
-            o['depth'] = float(D(ask_depth))
-        ask_depth = float(D(ask_depth))
+            #compose depth and round out quantities
+            bid_depth = D(0)
+            for o in base_bid_book:
+                o['quantity'] = float(D(o['quantity']))
+                bid_depth += D(o['quantity'])
+                o['depth'] = float(D(bid_depth))
+            bid_depth = float(D(bid_depth))
+            ask_depth = D(0)
+            for o in base_ask_book:
+                o['quantity'] = float(D(o['quantity']))
+                ask_depth += D(o['quantity'])
+                o['depth'] = float(D(ask_depth))
+            ask_depth = float(D(ask_depth))
+            return {
+                'base_bid_book': base_bid_book,
+                'base_ask_book': base_ask_book,
+                'bid_depth': bid_depth,
+                'ask_depth': ask_depth,
+                'bid_ask_spread': bid_ask_spread,
+                'bid_ask_median': bid_ask_median,
+                'raw_orders': filtered_base_bid_orders + filtered_base_ask_orders,
+            }
+
+        #TODO: limit # results to 8 or so for each book (we have to sort as well to limit)
+        if dex.order_book_index.loaded:
+            #serve the books off of the in-memory order book index, recompiling them only when the pair's orders change
+            book_filters = (bid_book_min_pct_fee_provided, bid_book_min_pct_fee_required, bid_book_max_pct_fee_required,
+                ask_book_min_pct_fee_provided, ask_book_min_pct_fee_required, ask_book_max_pct_fee_required)
+            books = dex.order_book_index.get_snapshot(base_asset, quote_asset, ('order_book', base_asset, book_filters),
+                lambda: compile_books(*get_orders_from_index()))
+        else:
+            books = compile_books(*get_orders_from_litetokensd())
         
-        #compose raw orders
-        orders = filtered_base_bid_orders + filtered_base_ask_orders
+        #compose raw orders (copying them, as the compiled books may be shared with other requests)
+        orders = [dict(o) for o in books['raw_orders']]
         for o in orders:
             #add in the blocktime to help makes interfaces more user-friendly (i.e. avoid displaying block
             # indexes and display datetimes instead)
@@ -794,12 +805,12 @@ def serve_api(mongo_db, redis_client):
                 o['_is_online'] = None #does not apply in this case
 
         result = {
-            'base_bid_book': base_bid_book,
-            'base_ask_book': base_ask_book,
-            'bid_depth': bid_depth,
-            'ask_depth': ask_depth,
-            'bid_ask_spread': bid_ask_spread,
-            'bid_ask_median': bid_ask_median,
+            'base_bid_book': books['base_bid_book'],
+            'base_ask_book': books['base_ask_book'],
+            'bid_depth': books['bid_depth'],
+            'ask_depth': books['ask_depth'],
+            'bid_ask_spread': books['bid_ask_spread'],
+            'bid_ask_median': books['bid_ask_median'],
             'raw_orders': orders,
             'base_asset': base_asset,
             'quote_asset': quote_asset
@@ -1142,7 +1153,7 @@ def serve_api(mongo_db, redis_client):
         if not isinstance(addresses, list):
             raise Exception("addresses must be a list of addresses, even if it just contains one address")
             
-        asset_info = mongo_db.tracked_assets.find_one({'asset': asset})
+        asset_info = util.get_tracked_asset(asset)
         if not asset_info:
             raise Exception("Asset does not exist.")
             
@@ -1341,26 +1352,7 @@ def serve_api(mongo_db, redis_client):
     @dispatcher.add_method
     def proxy_to_litetokensd(method='', params=[]):
         if method=='sql': raise Exception("Invalid method") 
-        result = None
-        cache_key = None
-
-        if redis_client: #check for a precached result and send that back instead
-            cache_key = method + '||' + base64.b64encode(json.dumps(params).encode()).decode()
-            #^ must use encoding (e.g. base64) since redis doesn't allow spaces in its key names
-            # (also shortens the hashing key for better performance)
-            result = redis_client.get(cache_key)
-            if result:
-                try:
-                    result = json.loads(result)
-                except Exception, e:
-                    logging.warn("Error loading JSON from cache: %s, cached data: '%s'" % (e, result))
-                    result = None #skip from reading from cache and just make the API call
-        
-        if result is None: #cache miss or cache disabled
-            result = util.call_jsonrpc_api(method, params)
-            if redis_client: #cache miss
-                redis_client.setex(cache_key, DEFAULT_COUNTERPARTYD_API_CACHE_PERIOD, json.dumps(result))
-                #^TODO: we may want to have different cache periods for different types of data
+        result = util.proxy_result_cache.get_or_call(method, params, util.call_jsonrpc_api)
         
         if 'error' in result:
             if result['error'].get('data', None):
@@ -1594,6 +1586,10 @@ def serve_api(mongo_db, redis_client):
             'litetokensd_check_elapsed': cpd_e - cpd_s,
             'liteblockd_check_elapsed': cbd_e - cbd_s,
             'local_online_users': len(siofeeds.onlineClients),
+            'upstream_requests': util.inflight_request_stats['requests'],
+            'upstream_requests_coalesced': util.inflight_request_stats['coalesced'],
+            'api_cache_bytes': util.proxy_result_cache.lru.size,
+            'proxy_cache': util.proxy_result_cache.stats,
         }
         return flask.Response(json.dumps(result), response_code, mimetype='application/json')
         
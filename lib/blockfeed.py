@@ -15,20 +15,373 @@ import time
 import pymongo
 import gevent
 
-from lib import config, util, events, blockchain, util_litecoin
-from lib.components import assets, betting
+from lib import config, util, events, blockchain, util_litecoin, checkpoint, message_journal, blocknotify
+from lib.components import assets, assets_trading, betting, dex, candles, trade_windows
 
 D = decimal.Decimal
+BLOCK_PREFETCH_WINDOW = 20 #max number of upcoming blocks to have in flight from litetokensd while catching up
+BLOCK_RANGE_FETCH_SIZE = 100 #number of blocks to pull from litetokensd per (bulk) request when far behind
+
+class BlockPrefetcher(object):
+    """Keeps a bounded window of upcoming blocks (block info + messages) being fetched from litetokensd on their own
+    greenlets while the current block is being processed, and hands them back strictly in block order.
+    
+    When we are far behind litetokensd (e.g. on a reparse), whole ranges of blocks are pulled at once via the sql API
+    call, instead of a get_block_info + get_messages call pair for every single block. As we get close to the tip,
+    this drops back to fetching block by block.
+    
+    Only blocks at least MAX_REORG_NUM_BLOCKS deep are ever prefetched (i.e. ones litetokensd won't reorg out from under
+    us), and the whole window is thrown away on any prune/reorg (see reset()). Blocks that deep that we already have in
+    the local message journal are read from there instead of from litetokensd"""
+    def __init__(self, msg_journal, window=BLOCK_PREFETCH_WINDOW, range_size=BLOCK_RANGE_FETCH_SIZE):
+        self.msg_journal = msg_journal
+        self.window = window
+        self.range_size = range_size
+        self._pending = {} #block_index -> greenlet (a range fetch greenlet is shared by all the blocks in its range)
+    
+    def _fetch_block(self, block_index):
+        cur_block = util.call_jsonrpc_api("get_block_info",
+            {'block_index': block_index}, abort_on_error=True)['result']
+        block_data = util.call_jsonrpc_api("get_messages",
+            {'block_index': block_index}, abort_on_error=True)['result']
+        return {block_index: (cur_block, block_data)}
+    
+    def _fetch_block_range(self, start_block_index, end_block_index):
+        blocks = util.call_sql('SELECT * FROM blocks WHERE block_index >= ? AND block_index <= ? ORDER BY block_index ASC',
+            [start_block_index, end_block_index], abort_on_error=True)
+        messages = util.call_sql('SELECT * FROM messages WHERE block_index >= ? AND block_index <= ? ORDER BY message_index ASC',
+            [start_block_index, end_block_index], abort_on_error=True)
+        if len(blocks) != end_block_index - start_block_index + 1:
+            raise Exception("litetokensd returned %i blocks for range %i-%i" % (
+                len(blocks), start_block_index, end_block_index))
+        result = dict([(b['block_index'], (b, [])) for b in blocks])
+        for m in messages:
+            result[m['block_index']][1].append(m)
+        return result
+    
+    def _spawn(self, block_index, max_prefetch_block_index):
+        """starts fetching block_index (and the rest of its range, if we are far enough behind to fetch a range).
+        returns the last block index covered by the fetch"""
+        if block_index + self.range_size - 1 <= max_prefetch_block_index:
+            end_block_index = block_index + self.range_size - 1
+            g = gevent.spawn(self._fetch_block_range, block_index, end_block_index)
+        else:
+            end_block_index = block_index
+            g = gevent.spawn(self._fetch_block, block_index)
+        for i in xrange(block_index, end_block_index + 1):
+            self._pending[i] = g
+        return end_block_index
+
+    def get(self, block_index, max_prefetch_block_index):
+        """returns a (cur_block, block_data) tuple for block_index, after topping up the prefetch window with the
+        blocks that follow it (up to and including max_prefetch_block_index)"""
+        for stale_block_index in [i for i in self._pending if i < block_index]:
+            self._pending.pop(stale_block_index)
+        if block_index <= max_prefetch_block_index and self.msg_journal.has_block(block_index):
+            return self.msg_journal.get(block_index)
+        if self.msg_journal.first_block_index is not None and block_index < self.msg_journal.first_block_index:
+            #don't prefetch what we'll be able to read out of the journal
+            max_prefetch_block_index = min(max_prefetch_block_index, self.msg_journal.first_block_index - 1)
+        if block_index not in self._pending:
+            self._spawn(block_index, max_prefetch_block_index)
+        i = block_index + 1
+        last_block_index = min(block_index + max(self.window, self.range_size), max_prefetch_block_index)
+        while i <= last_block_index:
+            i = (i if i in self._pending else self._spawn(i, max_prefetch_block_index)) + 1
+        
+        try:
+            return self._pending.pop(block_index).get()[block_index]
+        except:
+            self.reset() #start the window over fresh once the caller retries
+            raise
+    
+    def reset(self):
+        """drop (and stop fetching) any prefetched blocks"""
+        gevent.killall(list(set(self._pending.values())), block=False)
+        self._pending.clear()
+
+class BalanceChangeIndex(object):
+    """In-memory (address, asset) -> latest balance_changes record index, so that processing a credit or debit doesn't
+    need to go to mongo to look up the previous balance.
+    
+    Entries are loaded lazily from mongo (and then kept up to date as blocks are processed), except after the database
+    has been blown away, where the index is known to be complete and a miss simply means no balance change yet. Only
+    (block_index, new_balance, new_balance_normalized) is kept per pair, along with the full records created in the
+    block currently being processed (as those get updated in place)."""
+    def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        self._latest = {} #(address, asset) -> (block_index, new_balance, new_balance_normalized), or None if no changes
+        self._block_changes = {} #(address, asset) -> balance_changes record, for the block being processed
+        self._complete = False
+    
+    def _load(self, address, asset):
+        bal_change = self.mongo_db.balance_changes.find_one({
+            'address': address,
+            'asset': asset
+        }, sort=[("block_index", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        self._latest[(address, asset)] = (bal_change['block_index'], bal_change['new_balance'],
+            bal_change['new_balance_normalized']) if bal_change else None
+    
+    def get(self, address, asset):
+        """returns the latest balance change for the given address and asset (the full record if it was made in the
+        block currently being processed, otherwise a dict with just block_index and the new balance), or None"""
+        key = (address, asset)
+        if key in self._block_changes:
+            return self._block_changes[key]
+        if key not in self._latest:
+            if self._complete:
+                return None
+            self._load(address, asset)
+        latest = self._latest[key]
+        if latest is None:
+            return None
+        return {'block_index': latest[0], 'new_balance': latest[1], 'new_balance_normalized': latest[2]}
+    
+    def add(self, bal_change):
+        """records a new (or updated) balance_changes record for the block currently being processed"""
+        key = (bal_change['address'], bal_change['asset'])
+        self._latest[key] = (bal_change['block_index'], bal_change['new_balance'], bal_change['new_balance_normalized'])
+        self._block_changes[key] = bal_change
+    
+    def start_block(self):
+        self._block_changes.clear()
+    
+    def prune(self, max_block_index):
+        """rolls the index back to max_block_index (call after the balance_changes records above it are removed)"""
+        self._block_changes.clear()
+        stale_keys = [key for key, latest in self._latest.iteritems() if latest and latest[0] > max_block_index]
+        for address, asset in stale_keys:
+            self._load(address, asset)
+    
+    def reset(self, complete=False):
+        self._latest.clear()
+        self._block_changes.clear()
+        self._complete = complete
+
+
+class BlockWriteBuffer(object):
+    """Holds the records generated while processing a block, and writes them to mongo with one batch insert per
+    collection once the block is done (just before the block is recorded in processed_blocks, so that if we die
+    part way through, prune_my_stale_blocks still finds and removes anything written for the unfinished block)"""
+    COLLECTIONS = ('transaction_stats', 'balance_changes', 'trades', 'order_matches')
+    
+    def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        self._records = dict([(c, []) for c in self.COLLECTIONS])
+    
+    def insert(self, collection, record):
+        """queue up record for insertion. record can still be modified in place up until flush() is called"""
+        self._records[collection].append(record)
+    
+    def find(self, collection, field, value):
+        """returns the (first) record queued for insertion into collection with the given field value, or None"""
+        for record in self._records[collection]:
+            if record[field] == value:
+                return record
+        return None
+    
+    def flush(self):
+        """writes out all queued records, returning a dict of collection -> list of the ids of the records inserted"""
+        inserted_ids = {}
+        for collection in self.COLLECTIONS:
+            inserted_ids[collection] = self.mongo_db[collection].insert(self._records[collection]) \
+                if self._records[collection] else []
+        self.discard()
+        return inserted_ids
+    
+    def discard(self):
+        for records in self._records.itervalues():
+            del records[:]
+
+class UndoJournal(object):
+    """Per-block journal (in the undo_journal collection) of what processing each block did to the derived collections:
+    the ids of the records it inserted, and the tracked assets it changed (each of which pushed exactly one prior
+    version onto that asset's _history, unless the change created the asset). Rolling back a reorg then only touches
+    what the rolled back blocks actually wrote, instead of range deleting across whole collections.
+    
+    Entries are kept for the last MAX_REORG_NUM_BLOCKS blocks only. Rolling back further than that, as well as the
+    crash recovery done on startup (where a partially processed block may have left data behind that was never
+    journaled), is left to the full prune in prune_my_stale_blocks"""
+    def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        self.active = False #set once we know there is no unjournaled data left over from a prior run
+        self._block_asset_changes = [] #(asset, created) tuples for the block being processed
+    
+    def record_asset_change(self, asset, created):
+        """call before a tracked asset is created or changed while processing the current block"""
+        self._block_asset_changes.append((asset, created))
+    
+    def commit_block(self, block_index, inserted_ids):
+        """records the journal entry for a processed block. inserted_ids is a dict of collection -> list of record ids"""
+        self.mongo_db.undo_journal.insert({
+            'block_index': block_index,
+            'inserted': inserted_ids,
+            'tracked_assets': self._block_asset_changes,
+        })
+        self._block_asset_changes = []
+        self.mongo_db.undo_journal.remove({'block_index': {'$lte': block_index - config.MAX_REORG_NUM_BLOCKS}})
+    
+    def _rollback_asset_changes(self, asset_changes):
+        for asset, created in reversed(asset_changes):
+            if created:
+                self.mongo_db.tracked_assets.remove({'asset': asset})
+                continue
+            tracked_asset = self.mongo_db.tracked_assets.find_one({'asset': asset})
+            prev_ver = tracked_asset['_history'].pop()
+            prev_ver['_id'] = tracked_asset['_id']
+            prev_ver['_history'] = tracked_asset['_history']
+            self.mongo_db.tracked_assets.save(prev_ver)
+    
+    def rollback(self, max_block_index):
+        """undoes all journaled blocks above max_block_index (as well as any tracked asset changes made by the block
+        currently being processed). Returns False without changing anything if the journal doesn't cover every
+        processed block above max_block_index (in which case the caller must fall back to a full prune)"""
+        if not self.active:
+            return False
+        entries = list(self.mongo_db.undo_journal.find(
+            {'block_index': {'$gt': max_block_index}}).sort('block_index', pymongo.DESCENDING))
+        processed_block_indexes = [b['block_index'] for b in self.mongo_db.processed_blocks.find(
+            {'block_index': {'$gt': max_block_index}}, fields={'block_index': True})]
+        if set(processed_block_indexes) - set([e['block_index'] for e in entries]):
+            return False
+        
+        self._rollback_asset_changes(self._block_asset_changes)
+        self._block_asset_changes = []
+        for entry in entries:
+            logging.info("Rolling back block %i from the undo journal ..." % entry['block_index'])
+            for collection, ids in entry['inserted'].iteritems():
+                if ids:
+                    self.mongo_db[collection].remove({'_id': {'$in': ids}})
+            self._rollback_asset_changes(entry['tracked_assets'])
+        self.mongo_db.undo_journal.remove({'block_index': {'$gt': max_block_index}})
+        return True
+    
+    def reset(self):
+        """call after a full prune or db rebuild (which leave no unjournaled data behind)"""
+        self.mongo_db.undo_journal.remove()
+        self._block_asset_changes = []
+        self.active = True
+
+MEMPOOL_CATEGORIES = ['sends', 'ltcpays', 'issuances', 'dividends', 'callbacks']
+MEMPOOL_TIMESTAMP_SLACK = 60 #seconds to look back before the newest mempool tx timestamp we've seen, when polling for new ones
+MEMPOOL_FULL_RESYNC_POLLS = 30 #do a full (non-incremental) mempool poll once per this many polls
+
+class MempoolTracker(object):
+    """Keeps the set of mempool tx hashes we've already seen (and stored in the mempool collection) in memory, so that
+    polling litetokensd for new mempool txs only asks for those newer than (about) the newest one seen so far, instead
+    of sending every known tx hash along in a NOT IN filter. Every so often, a full poll is done to pick up anything the
+    timestamp based polling may have missed."""
+    def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        self._seen = None #tx_hash -> viewed_in_block
+        self._last_timestamp = None
+        self._num_polls = 0
+    
+    def _seed(self):
+        self._seen = {}
+        self._last_timestamp = None
+        for mempool_tx in self.mongo_db.mempool.find(fields={'tx_hash': True, 'viewed_in_block': True, 'timestamp': True}):
+            self._seen[str(mempool_tx['tx_hash'])] = mempool_tx['viewed_in_block']
+            self._last_timestamp = max(self._last_timestamp, mempool_tx['timestamp'])
+    
+    def get_new_txs(self):
+        """returns the mempool txs litetokensd has that we haven't seen yet"""
+        if self._seen is None:
+            self._seed()
+        filters = [{'field': 'category', 'op': 'IN', 'value': MEMPOOL_CATEGORIES}]
+        if self._last_timestamp is not None and self._num_polls % MEMPOOL_FULL_RESYNC_POLLS != 0:
+            filters.append({'field': 'timestamp', 'op': '>=', 'value': self._last_timestamp - MEMPOOL_TIMESTAMP_SLACK})
+        self._num_polls += 1
+        mempool_txs = util.call_jsonrpc_api("get_mempool",
+            {'filters': filters, 'filterop': 'AND'}, abort_on_error=True)['result']
+        new_txs = []
+        for tx in mempool_txs:
+            if tx['tx_hash'] not in self._seen:
+                new_txs.append(tx)
+            self._last_timestamp = max(self._last_timestamp, tx['timestamp'])
+        return new_txs
+    
+    def add(self, tx_hash, viewed_in_block):
+        if self._seen is not None:
+            self._seen[tx_hash] = viewed_in_block
+    
+    def evict(self, min_viewed_in_block):
+        """forgets about mempool txs viewed before min_viewed_in_block (in step with their removal from mongo)"""
+        if self._seen is None:
+            return
+        for tx_hash in [h for h, viewed_in_block in self._seen.iteritems() if viewed_in_block < min_viewed_in_block]:
+            del self._seen[tx_hash]
+
+class PendingOrderMatchIndex(object):
+    """In-memory index of the pending order matches (i.e. ones involving LTC, waiting on a LTCpay) seen in the message
+    feed, so that booking the trade once a LTCpay completes one doesn't need a get_order_matches call to litetokensd.
+    
+    Matches that get settled (completed or expired) are only marked as such, and kept around until they're
+    MAX_REORG_NUM_BLOCKS deep, so that prune() can bring them back if the block settling them is rolled back.
+    Matches made before we started up aren't in here, so callers still need to fall back to the order_matches
+    collection (see get_mirrored_order_match)"""
+    FIELDS = ('tx0_hash', 'tx1_hash', 'tx0_index', 'tx1_index', 'tx0_address', 'tx1_address',
+        'forward_asset', 'forward_quantity', 'backward_asset', 'backward_quantity', 'status')
+    
+    def __init__(self):
+        self._matches = {} #order_match_id -> [order_match, block_index created, block_index settled (or None)]
+    
+    def add(self, order_match, block_index):
+        self._matches[order_match['tx0_hash'] + order_match['tx1_hash']] = [
+            dict([(f, order_match[f]) for f in self.FIELDS]), block_index, None]
+    
+    def settle(self, order_match_id, status, block_index):
+        """marks a pending order match as settled, returning the order match (with its new status), or None if we don't
+        know about it"""
+        entry = self._matches.get(order_match_id, None)
+        if not entry or entry[2] is not None:
+            return None
+        entry[2] = block_index
+        return dict(entry[0], status=status)
+    
+    def prune(self, max_block_index):
+        for order_match_id, entry in self._matches.items():
+            if entry[1] > max_block_index:
+                del self._matches[order_match_id]
+            elif entry[2] is not None and entry[2] > max_block_index:
+                entry[2] = None
+    
+    def trim(self, block_index):
+        """forgets about order matches settled at least MAX_REORG_NUM_BLOCKS before block_index"""
+        for order_match_id, entry in self._matches.items():
+            if entry[2] is not None and entry[2] <= block_index - config.MAX_REORG_NUM_BLOCKS:
+                del self._matches[order_match_id]
+    
+    def reset(self):
+        self._matches.clear()
+
+def get_mirrored_order_match(mongo_db, write_buffer, order_match_id):
+    """returns the given order match from our order_matches mirror (including the ones still queued for insertion), in
+    the form of a litetokensd order_matches row"""
+    order_match = write_buffer.find('order_matches', 'id', order_match_id) \
+        or mongo_db.order_matches.find_one({'id': order_match_id})
+    assert order_match, "Order match %s is not in the order_matches collection" % order_match_id
+    return dict([(f, order_match[f]) for f in PendingOrderMatchIndex.FIELDS if f in order_match],
+        tx0_hash=order_match_id[:64], tx1_hash=order_match_id[64:])
 
 def process_cpd_blockfeed(zmq_publisher_eventfeed):
     LATEST_BLOCK_INIT = {'block_index': config.BLOCK_FIRST, 'block_time': None, 'block_hash': None}
     mongo_db = config.mongo_db
+    msg_journal = message_journal.MessageJournal()
+    prefetcher = BlockPrefetcher(msg_journal)
+    balance_index = BalanceChangeIndex(mongo_db)
+    write_buffer = BlockWriteBuffer(mongo_db)
+    candle_buffer = candles.CandleBuffer(mongo_db)
+    undo_journal = UndoJournal(mongo_db)
+    mempool_tracker = MempoolTracker(mongo_db)
+    pending_order_matches = PendingOrderMatchIndex()
 
     def blow_away_db():
         """boom! blow away all applicable collections in mongo"""
         mongo_db.processed_blocks.drop()
         mongo_db.tracked_assets.drop()
         mongo_db.trades.drop()
+        mongo_db.trade_candles.drop()
         mongo_db.balance_changes.drop()
         mongo_db.asset_market_info.drop()
         mongo_db.asset_marketcap_history.drop()
@@ -36,6 +389,8 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         mongo_db.ltc_open_orders.drop()
         mongo_db.asset_extended_info.drop()
         mongo_db.transaction_stats.drop()
+        mongo_db.order_matches.drop()
+        mongo_db.undo_journal.drop()
         mongo_db.feeds.drop()
         mongo_db.wallet_stats.drop()
         
@@ -64,10 +419,20 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 '_history': [] #to allow for block rollbacks
             }
             mongo_db.tracked_assets.insert(base_asset)
+        util.clear_tracked_asset_cache()
+        util.purge_block_cache()
             
         #reinitialize some internal counters
         config.CURRENT_BLOCK_INDEX = 0
         config.LAST_MESSAGE_INDEX = -1
+        prefetcher.reset()
+        balance_index.reset(complete=True) #nothing in balance_changes now
+        util.block_time_index.reset()
+        pending_order_matches.reset()
+        dex.order_book_index.reset()
+        trade_windows.rolling_trade_stats.reset()
+        assets_trading.market_cap_calculator.reset()
+        undo_journal.reset()
         
         return app_config
         
@@ -79,58 +444,104 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         (which will get a new last_processed_block from litetokensd and resume as appropriate)   
         """
         logging.warn("Pruning to block %i ..." % (max_block_index))        
-        mongo_db.processed_blocks.remove({"block_index": {"$gt": max_block_index}})
-        mongo_db.balance_changes.remove({"block_index": {"$gt": max_block_index}})
-        mongo_db.trades.remove({"block_index": {"$gt": max_block_index}})
-        mongo_db.asset_marketcap_history.remove({"block_index": {"$gt": max_block_index}})
-        mongo_db.transaction_stats.remove({"block_index": {"$gt": max_block_index}})
+        write_buffer.discard()
+        candle_buffer.discard()
+        if undo_journal.rollback(max_block_index):
+            mongo_db.processed_blocks.remove({"block_index": {"$gt": max_block_index}})
+            mongo_db.asset_marketcap_history.remove({"block_index": {"$gt": max_block_index}}) #(from events.py, not journaled)
+        else:
+            #not (fully) covered by the undo journal, so prune everything above max_block_index
+            mongo_db.processed_blocks.remove({"block_index": {"$gt": max_block_index}})
+            mongo_db.balance_changes.remove({"block_index": {"$gt": max_block_index}})
+            mongo_db.trades.remove({"block_index": {"$gt": max_block_index}})
+            mongo_db.asset_marketcap_history.remove({"block_index": {"$gt": max_block_index}})
+            mongo_db.transaction_stats.remove({"block_index": {"$gt": max_block_index}})
+            mongo_db.order_matches.remove({"block_index": {"$gt": max_block_index}})
+        
+            #to roll back the state of the tracked asset, dive into the history object for each asset that has
+            # been updated on or after the block that we are pruning back to
+            assets_to_prune = mongo_db.tracked_assets.find({'_at_block': {"$gt": max_block_index}})
+            for asset in assets_to_prune:
+                logging.info("Pruning asset %s (last modified @ block %i, pruning to state at block %i)" % (
+                    asset['asset'], asset['_at_block'], max_block_index))
+                prev_ver = None
+                while len(asset['_history']):
+                    prev_ver = asset['_history'].pop()
+                    if prev_ver['_at_block'] <= max_block_index:
+                        break
+                if prev_ver:
+                    if prev_ver['_at_block'] > max_block_index:
+                        #even the first history version is newer than max_block_index.
+                        #in this case, just remove the asset tracking record itself
+                        mongo_db.tracked_assets.remove({'asset': asset['asset']})
+                    else:
+                        #if here, we were able to find a previous version that was saved at or before max_block_index
+                        # (which should be prev_ver ... restore asset's values to its values
+                        prev_ver['_id'] = asset['_id']
+                        prev_ver['_history'] = asset['_history']
+                        mongo_db.tracked_assets.save(prev_ver)
+            undo_journal.reset()
         
-        #to roll back the state of the tracked asset, dive into the history object for each asset that has
-        # been updated on or after the block that we are pruning back to
-        assets_to_prune = mongo_db.tracked_assets.find({'_at_block': {"$gt": max_block_index}})
-        for asset in assets_to_prune:
-            logging.info("Pruning asset %s (last modified @ block %i, pruning to state at block %i)" % (
-                asset['asset'], asset['_at_block'], max_block_index))
-            prev_ver = None
-            while len(asset['_history']):
-                prev_ver = asset['_history'].pop()
-                if prev_ver['_at_block'] <= max_block_index:
-                    break
-            if prev_ver:
-                if prev_ver['_at_block'] > max_block_index:
-                    #even the first history version is newer than max_block_index.
-                    #in this case, just remove the asset tracking record itself
-                    mongo_db.tracked_assets.remove({'asset': asset['asset']})
-                else:
-                    #if here, we were able to find a previous version that was saved at or before max_block_index
-                    # (which should be prev_ver ... restore asset's values to its values
-                    prev_ver['_id'] = asset['_id']
-                    prev_ver['_history'] = asset['_history']
-                    mongo_db.tracked_assets.save(prev_ver)
+        #roll back order match status changes (which are not journaled) made after max_block_index
+        for order_match in mongo_db.order_matches.find({'status_history.block_index': {"$gt": max_block_index}}):
+            status_history = [s for s in order_match['status_history'] if s['block_index'] <= max_block_index]
+            mongo_db.order_matches.update({'_id': order_match['_id']},
+                {"$set": {'status': status_history[-1]['status'], 'status_history': status_history}})
+        candles.rebuild_candles(mongo_db, max_block_index) #(off of the now pruned trades)
+        balance_index.prune(max_block_index)
+        pending_order_matches.prune(max_block_index)
+        dex.order_book_index.reset() #(reloaded once we are caught up again)
+        trade_windows.rolling_trade_stats.reset() #(likewise)
+        assets_trading.market_cap_calculator.reset()
+        util.block_time_index.truncate(max_block_index)
+        util.clear_tracked_asset_cache()
+        util.purge_block_cache()
 
+        prefetcher.reset() #anything prefetched past this point is no longer valid
         config.CAUGHT_UP = False
         latest_block = mongo_db.processed_blocks.find_one({"block_index": max_block_index}) or LATEST_BLOCK_INIT
         return latest_block
     
+    def restore_from_checkpoint(running_info):
+        """restores our state from the newest checkpoint that was made against the litetokensd DB version we're
+        running against, and that is still part of litetokensd's chain. Returns the checkpoint's last processed block,
+        or None if no suitable checkpoint exists (in which case we just rebuild from scratch)"""
+        for block_index, path in checkpoint.list_checkpoints():
+            try:
+                info = checkpoint.read_checkpoint_info(path)
+                if    info['litetokensd_db_version_major'] != running_info['version_major'] \
+                   or info['litetokensd_db_version_minor'] != running_info['version_minor'] \
+                   or info['litetokensd_running_testnet'] != running_info['running_testnet'] \
+                   or block_index > running_info['last_block']['block_index']:
+                    continue
+                block_info = util.call_jsonrpc_api("get_block_info",
+                    {'block_index': block_index}, abort_on_error=True)['result']
+            except Exception, e:
+                logging.warn("Could not check checkpoint %s: %s" % (path, e))
+                continue
+            if block_info['block_hash'] != info['block_hash']:
+                logging.warn("Checkpoint %s is not on litetokensd's chain (anymore). Skipping..." % path)
+                continue
+
+            checkpoint.restore_checkpoint(mongo_db, path)
+            prefetcher.reset()
+            balance_index.reset()
+            undo_journal.reset()
+            pending_order_matches.reset()
+            dex.order_book_index.reset()
+            trade_windows.rolling_trade_stats.reset()
+            assets_trading.market_cap_calculator.reset()
+            util.clear_tracked_asset_cache()
+            util.purge_block_cache()
+            util.block_time_index.load(mongo_db)
+            config.CURRENT_BLOCK_INDEX = block_index
+            config.LAST_MESSAGE_INDEX = info['last_message_index']
+            return mongo_db.processed_blocks.find_one({"block_index": block_index})
+        return None
+
     def publish_mempool_tx():
         """fetch new tx from mempool"""
-        tx_hashes = []
-        mempool_txs = mongo_db.mempool.find(fields={'tx_hash': True})
-        for mempool_tx in mempool_txs:
-            tx_hashes.append(str(mempool_tx['tx_hash']))
-
-        params = None
-        if len(tx_hashes) > 0:
-            params = {
-                'filters': [
-                    {'field':'tx_hash', 'op': 'NOT IN', 'value': tx_hashes},
-                    {'field':'category', 'op': 'IN', 'value': ['sends', 'ltcpays', 'issuances', 'dividends', 'callbacks']}
-                ],
-                'filterop': 'AND'
-            }
-        new_txs = util.call_jsonrpc_api("get_mempool", params, abort_on_error=True)
-
-        for new_tx in new_txs['result']:
+        for new_tx in mempool_tracker.get_new_txs():
             tx = {
                 'tx_hash': new_tx['tx_hash'],
                 'command': new_tx['command'],
@@ -141,6 +552,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             }
             
             mongo_db.mempool.insert(tx)
+            mempool_tracker.add(tx['tx_hash'], tx['viewed_in_block'])
             del(tx['_id'])
             tx['_category'] = tx['category']
             tx['_message_index'] = 'mempool'
@@ -150,6 +562,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
     def clean_mempool_tx():
         """clean mempool transactions older than MAX_REORG_NUM_BLOCKS blocks"""
         mongo_db.mempool.remove({"viewed_in_block": {"$lt": config.CURRENT_BLOCK_INDEX - config.MAX_REORG_NUM_BLOCKS}})
+        mempool_tracker.evict(config.CURRENT_BLOCK_INDEX - config.MAX_REORG_NUM_BLOCKS)
 
 
     config.CURRENT_BLOCK_INDEX = 0 #initialize (last processed block index -- i.e. currently active block)
@@ -172,6 +585,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             logging.warn("liteblockd database app_config collection doesn't exist. BUILDING FROM SCRATCH...")
         app_config = blow_away_db()
         my_latest_block = LATEST_BLOCK_INIT
+        checkpoint_restore_pending = not config.REPARSE_FORCED #(a forced reparse always rebuilds from scratch)
     else:
         app_config = app_config[0]
         #get the last processed block out of mongo
@@ -179,7 +593,22 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
         #remove any data we have for blocks higher than this (would happen if liteblockd or mongo died
         # or errored out while processing a block)
         my_latest_block = prune_my_stale_blocks(my_latest_block['block_index'])
+        checkpoint_restore_pending = False
+        
+        if config.REPARSE_FROM is not None and config.REPARSE_FROM <= my_latest_block['block_index']:
+            #roll back to just before the requested block and re-ingest from there (leaving preferences, chat data, etc alone)
+            reparse_to_block_index = max(config.REPARSE_FROM - 1, config.BLOCK_FIRST)
+            logging.warn("REPARSE FROM BLOCK %i forced. Rolling back to block %i ..." % (config.REPARSE_FROM, reparse_to_block_index))
+            my_latest_block = prune_my_stale_blocks(reparse_to_block_index)
+            if app_config['last_block_assets_compiled'] > reparse_to_block_index:
+                app_config['last_block_assets_compiled'] = reparse_to_block_index
+                mongo_db.app_config.update({}, {'$set': {'last_block_assets_compiled': reparse_to_block_index}})
+        util.block_time_index.load(mongo_db)
 
+    msg_journal_checked = False
+    notifier = blocknotify.BlockNotifier()
+    notifier.start()
+    
     #start polling litetokensd for new blocks    
     while True:
         try:
@@ -222,6 +651,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             updatePrefs = True
         if wipeState:
             app_config = blow_away_db()
+            checkpoint_restore_pending = True
         if updatePrefs:
             app_config['litetokensd_db_version_major'] = running_info['version_major'] 
             app_config['litetokensd_db_version_minor'] = running_info['version_minor']
@@ -230,8 +660,17 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             
             #reset my latest block record
             my_latest_block = LATEST_BLOCK_INIT
+            prefetcher.reset()
             config.CAUGHT_UP = False #You've Come a Long Way, Baby
         
+        #if we've just been wiped, see if we can restore from a checkpoint instead of ingesting everything again
+        if checkpoint_restore_pending and running_info['last_block']['block_index'] is not None:
+            checkpoint_restore_pending = False
+            checkpoint_block = restore_from_checkpoint(running_info)
+            if checkpoint_block:
+                my_latest_block = checkpoint_block
+                app_config = mongo_db.app_config.find()[0]
+        
         #work up to what block litetokensd is at
         last_processed_block = running_info['last_block']
         
@@ -240,34 +679,45 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             time.sleep(3)
             continue
         
+        #(re)open our message journal for the litetokensd DB version we are running against, and on startup, make sure
+        # its tail is still on litetokensd's chain (as litetokensd may have gone through a reorg while we were down)
+        msg_journal.open(app_config)
+        if not msg_journal_checked and msg_journal.last_block_index is not None:
+            check_block_index = min(msg_journal.last_block_index, last_processed_block['block_index'])
+            try:
+                check_block = util.call_jsonrpc_api("get_block_info",
+                    {'block_index': check_block_index}, abort_on_error=True)['result']
+            except Exception, e:
+                logging.warn(str(e) + " Waiting 3 seconds before trying again...")
+                time.sleep(3)
+                continue
+            if    not msg_journal.has_block(check_block_index) \
+               or msg_journal.get(check_block_index)[0]['block_hash'] != check_block['block_hash']:
+                check_block_index -= config.MAX_REORG_NUM_BLOCKS
+            msg_journal.truncate(check_block_index)
+        msg_journal_checked = True
+        
         if my_latest_block['block_index'] < last_processed_block['block_index']:
             #need to catch up
             config.CAUGHT_UP = False
             
             cur_block_index = my_latest_block['block_index'] + 1
-            #get the blocktime for the next block we have to process 
+            #get the block info and messages for the next block we have to process (while prefetching the blocks
+            # after it, as long as they are deep enough that they shouldn't get reorged out)
             try:
-                cur_block = util.call_jsonrpc_api("get_block_info",
-                    {'block_index': cur_block_index}, abort_on_error=True)['result']
+                cur_block, block_data = prefetcher.get(cur_block_index,
+                    last_processed_block['block_index'] - config.MAX_REORG_NUM_BLOCKS)
             except Exception, e:
                 logging.warn(str(e) + " Waiting 3 seconds before trying again...")
                 time.sleep(3)
                 continue
             cur_block['block_time_obj'] = datetime.datetime.utcfromtimestamp(cur_block['block_time'])
             cur_block['block_time_str'] = cur_block['block_time_obj'].isoformat()
-            
-            try:
-                block_data = util.call_jsonrpc_api("get_messages",
-                    {'block_index': cur_block_index}, abort_on_error=True)['result']
-            except Exception, e:
-                logging.warn(str(e) + " Waiting 5 seconds before trying again...")
-                time.sleep(5)
-                continue
 
-            # clean api cache
-            util.clean_block_cache(cur_block_index)
+            balance_index.start_block()
             
             #parse out response (list of txns, ordered as they appeared in the block)
+            block_reorged = False
             for msg in block_data:
                 msg_data = json.loads(msg['bindings'])
                 
@@ -299,7 +749,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                    and msg['category'] not in ["debits", "credits", "order_matches", "bet_matches",
                        "order_expirations", "bet_expirations", "order_match_expirations", "bet_match_expirations",
                        "rps_matches", "rps_expirations", "rps_match_expirations", "bet_match_resolutions"]:
-                    mongo_db.transaction_stats.insert({
+                    write_buffer.insert('transaction_stats', {
                         'block_index': cur_block_index,
                         'block_time': cur_block['block_time_obj'],
                         'message_index': msg['message_index'],
@@ -311,6 +761,8 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                     logging.warn("Blockchain reorginization at block %s" % msg_data['block_index'])
                     #prune back to and including the specified message_index
                     my_latest_block = prune_my_stale_blocks(msg_data['block_index'] - 1)
+                    msg_journal.truncate(msg_data['block_index'] - 1)
+                    block_reorged = True
                     config.CURRENT_BLOCK_INDEX = msg_data['block_index'] - 1
 
                     #for the current last_message_index (which could have gone down after the reorg), query litetokensd
@@ -326,6 +778,8 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 
                 #track assets
                 if msg['category'] == 'issuances':
+                    if msg_data['status'] == 'valid':
+                        undo_journal.record_asset_change(msg_data['asset'], util.get_tracked_asset(msg_data['asset']) is None)
                     assets.parse_issuance(mongo_db, msg_data, cur_block_index, cur_block)
                 
                 #track balance changes for each address
@@ -333,7 +787,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 if msg['category'] in ['credits', 'debits',]:
                     actionName = 'credit' if msg['category'] == 'credits' else 'debit'
                     address = msg_data['address']
-                    asset_info = mongo_db.tracked_assets.find_one({ 'asset': msg_data['asset'] })
+                    asset_info = util.get_tracked_asset(msg_data['asset'])
                     if asset_info is None:
                         logging.warn("Credit/debit of %s where asset ('%s') does not exist. Ignoring..." % (msg_data['quantity'], msg_data['asset']))
                         continue
@@ -341,10 +795,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                     quantity_normalized = util_litecoin.normalize_quantity(quantity, asset_info['divisible'])
 
                     #look up the previous balance to go off of
-                    last_bal_change = mongo_db.balance_changes.find_one({
-                        'address': address,
-                        'asset': asset_info['asset']
-                    }, sort=[("block_index", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+                    last_bal_change = balance_index.get(address, asset_info['asset'])
                     
                     if     last_bal_change \
                        and last_bal_change['block_index'] == cur_block_index:
@@ -353,7 +804,6 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                         last_bal_change['quantity_normalized'] += quantity_normalized
                         last_bal_change['new_balance'] += quantity
                         last_bal_change['new_balance_normalized'] += quantity_normalized
-                        mongo_db.balance_changes.save(last_bal_change)
                         logging.info("Procesed %s bal change (UPDATED) from tx %s :: %s" % (actionName, msg['message_index'], last_bal_change))
                         bal_change = last_bal_change
                     else: #new balance change record for this block
@@ -367,8 +817,51 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                             'new_balance': last_bal_change['new_balance'] + quantity if last_bal_change else quantity,
                             'new_balance_normalized': last_bal_change['new_balance_normalized'] + quantity_normalized if last_bal_change else quantity_normalized,
                         }
-                        mongo_db.balance_changes.insert(bal_change)
+                        write_buffer.insert('balance_changes', bal_change)
                         logging.info("Procesed %s bal change from tx %s :: %s" % (actionName, msg['message_index'], bal_change))
+                    balance_index.add(bal_change)
+                
+                #mirror order matches (with their status history), for the DEX queries in dex.py
+                if msg['category'] == 'order_matches':
+                    if msg['command'] == 'insert':
+                        write_buffer.insert('order_matches', {
+                            'id': msg_data['tx0_hash'] + msg_data['tx1_hash'],
+                            'tx0_index': msg_data['tx0_index'],
+                            'tx1_index': msg_data['tx1_index'],
+                            'tx_index': max(msg_data['tx0_index'], msg_data['tx1_index']),
+                            'tx0_address': msg_data['tx0_address'],
+                            'tx1_address': msg_data['tx1_address'],
+                            'forward_asset': msg_data['forward_asset'],
+                            'forward_quantity': msg_data['forward_quantity'],
+                            'backward_asset': msg_data['backward_asset'],
+                            'backward_quantity': msg_data['backward_quantity'],
+                            'pair': dex.get_order_match_pair(msg_data['forward_asset'], msg_data['backward_asset']),
+                            'block_index': cur_block_index,
+                            'block_time': cur_block['block_time_obj'],
+                            'status': msg_data['status'],
+                            'status_history': [{'status': msg_data['status'], 'block_index': cur_block_index}],
+                        })
+                    elif msg['command'] == 'update':
+                        status_change = {'status': msg_data['status'], 'block_index': cur_block_index}
+                        queued_order_match = write_buffer.find('order_matches', 'id', msg_data['order_match_id'])
+                        if queued_order_match: #(matched in this same block)
+                            queued_order_match['status'] = msg_data['status']
+                            queued_order_match['status_history'].append(status_change)
+                        else:
+                            mongo_db.order_matches.update({'id': msg_data['order_match_id']},
+                                {"$set": {'status': msg_data['status']}, "$push": {'status_history': status_change}})
+                
+                #track pending order matches (the ones involving LTC), for booking the trade once one completes
+                settled_order_match = None
+                if msg['category'] == 'order_matches':
+                    if msg['command'] == 'insert' and msg_data['status'] == 'pending':
+                        pending_order_matches.add(msg_data, cur_block_index)
+                    elif msg['command'] == 'update' and msg_data['status'] != 'pending':
+                        settled_order_match = pending_order_matches.settle(
+                            msg_data['order_match_id'], msg_data['status'], cur_block_index)
+                
+                #keep the in-memory order books up to date
+                dex.order_book_index.apply_message(msg, msg_data)
                 
                 #book trades
                 if (msg['category'] == 'order_matches'
@@ -377,19 +870,15 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
 
                     if msg['command'] == 'update' and msg_data['status'] == 'completed':
                         #an order is being updated to a completed status (i.e. a LTCpay has completed)
-                        tx0_hash, tx1_hash = msg_data['order_match_id'][:64], msg_data['order_match_id'][64:] 
-                        #get the order_match this ltcpay settles
-                        order_match = util.call_jsonrpc_api("get_order_matches",
-                            {'filters': [
-                             {'field': 'tx0_hash', 'op': '==', 'value': tx0_hash},
-                             {'field': 'tx1_hash', 'op': '==', 'value': tx1_hash}]
-                            }, abort_on_error=True)['result'][0]
+                        #get the order_match this ltcpay settles (from our mirror if it was made before we started up)
+                        order_match = settled_order_match \
+                            or get_mirrored_order_match(mongo_db, write_buffer, msg_data['order_match_id'])
                     else:
                         assert msg_data['status'] == 'completed' #should not enter a pending state for non LTC matches
                         order_match = msg_data
 
-                    forward_asset_info = mongo_db.tracked_assets.find_one({'asset': order_match['forward_asset']})
-                    backward_asset_info = mongo_db.tracked_assets.find_one({'asset': order_match['backward_asset']})
+                    forward_asset_info = util.get_tracked_asset(order_match['forward_asset'])
+                    backward_asset_info = util.get_tracked_asset(order_match['backward_asset'])
                     assert forward_asset_info and backward_asset_info
                     base_asset, quote_asset = util.assets_to_asset_pair(order_match['forward_asset'], order_match['backward_asset'])
                     
@@ -427,7 +916,9 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                         ( D(trade['base_quantity_normalized']) / D(trade['quote_quantity_normalized']) ).quantize(
                             D('.00000000'), rounding=decimal.ROUND_HALF_EVEN))
 
-                    mongo_db.trades.insert(trade)
+                    write_buffer.insert('trades', trade)
+                    candle_buffer.add_trade(trade)
+                    trade_windows.rolling_trade_stats.add_trade(trade)
                     logging.info("Procesed Trade from tx %s :: %s" % (msg['message_index'], trade))
                 
                 #broadcast
@@ -439,7 +930,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 # can't guarantee that the socket.io connection will always be severed as well??)
                 if last_processed_block['block_index'] - my_latest_block['block_index'] < config.MAX_REORG_NUM_BLOCKS:
                     #send out the message to listening clients
-                    event = util.decorate_message_for_feed(msg, msg_data=msg_data)
+                    event = util.decorate_message_for_feed(msg, msg_data=msg_data, bal_change=bal_change)
                     zmq_publisher_eventfeed.send_json(event)
 
                 #this is the last processed message index
@@ -451,9 +942,25 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 'block_time': cur_block['block_time_obj'],
                 'block_hash': cur_block['block_hash'],
             }
+            undo_journal.commit_block(cur_block_index, write_buffer.flush())
+            candle_buffer.flush()
             mongo_db.processed_blocks.insert(new_block)
+            util.block_time_index.append(cur_block_index, new_block['block_time'])
+            if not block_reorged:
+                msg_journal.append(cur_block, block_data)
+            pending_order_matches.trim(cur_block_index)
             my_latest_block = new_block
             config.CURRENT_BLOCK_INDEX = cur_block_index
+            util.clean_block_cache(cur_block_index) #(API results cached for the previous block)
+            assets_trading.update_market_window_info() #(for the assets traded in this block)
+            if config.CHECKPOINT_INTERVAL and cur_block_index % config.CHECKPOINT_INTERVAL == 0 \
+               and last_processed_block['block_index'] - cur_block_index < config.MAX_REORG_NUM_BLOCKS:
+                #(not while catching up, as a checkpoint holds up block processing while it's being written)
+                try:
+                    msg_journal.sync() #(so that the journal is on disk up to the checkpoint, for replaying from it)
+                    checkpoint.write_checkpoint(mongo_db, app_config, new_block)
+                except Exception, e: #(a checkpoint is optional, so don't let e.g. a full disk stop block processing)
+                    logging.exception("Could not write checkpoint at block %i: %s" % (cur_block_index, e))
             #get the current blockchain service block
             if config.BLOCKCHAIN_SERVICE_LAST_BLOCK == 0 or config.BLOCKCHAIN_SERVICE_LAST_BLOCK - config.CURRENT_BLOCK_INDEX < config.MAX_REORG_NUM_BLOCKS:
                 #update as CURRENT_BLOCK_INDEX catches up with BLOCKCHAIN_SERVICE_LAST_BLOCK and/or surpasses it (i.e. if blockchain service gets behind for some reason)
@@ -474,6 +981,7 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
             # before what litetokensd is saying if we see this
             logging.error("Very odd: Ahead of litetokensd with block indexes! Pruning back %s blocks to be safe." % config.MAX_REORG_NUM_BLOCKS)
             my_latest_block = prune_my_stale_blocks(last_processed_block['block_index'] - config.MAX_REORG_NUM_BLOCKS)
+            msg_journal.truncate(last_processed_block['block_index'] - config.MAX_REORG_NUM_BLOCKS)
         else:
             #...we may be caught up (to litetokensd), but litetokensd may not be (to the blockchain). And if it isn't, we aren't
             config.CAUGHT_UP = running_info['db_caught_up']
@@ -495,6 +1003,9 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
                 logging.debug("Starting event timer: compile_asset_market_info")
                 gevent.spawn(events.compile_asset_market_info)
 
+                logging.debug("Starting event timer: expire_market_windows")
+                gevent.spawn(events.expire_market_windows)
+
                 logging.debug("Starting event timer: compile_extended_asset_info")
                 gevent.spawn(events.compile_extended_asset_info)
 
@@ -503,5 +1014,12 @@ def process_cpd_blockfeed(zmq_publisher_eventfeed):
 
                 config.CAUGHT_UP_STARTED_EVENTS = True
 
+            if not dex.order_book_index.loaded:
+                dex.order_book_index.load()
+            if not trade_windows.rolling_trade_stats.loaded:
+                trade_windows.rolling_trade_stats.load()
+                assets_trading.reset_market_window_info()
+
             publish_mempool_tx()
-            time.sleep(2) #liteblockd itself is at least caught up, wait a bit to query again for the latest block from cpd
+            #liteblockd itself is at least caught up, wait until litetokensd tells us it has something new (or a bit, at most)
+            notifier.wait(running_info['last_message_index'])
@@ -0,0 +1,107 @@
+"""
+blocknotify: wake blockfeed up as soon as litetokensd has something new for us, instead of having it poll on a timer
+"""
+import os
+import logging
+
+import gevent
+import gevent.event
+import zmq.green as zmq
+
+from lib import config
+
+MAX_WAIT = 2 #max seconds to wait between polls of litetokensd (also sets the mempool polling cadence)
+MIN_POLL_INTERVAL = 0.25 #poll interval right after seeing activity, when no notification source is available
+FILE_WATCH_INTERVAL = 0.25 #how often to stat litetokensd's database file(s) when watching them
+SOURCE_RETRY_INTERVAL = 10 #seconds to wait before trying to reconnect a failed notification source
+ZMQ_SILENCE_TIMEOUT = 5 * 60 #seconds without a ZMQ message after which we fall back to polling (until the next message)
+
+class BlockNotifier(object):
+    """Wakes up whoever is waiting in wait() when one of the configured notification sources signals that
+    litetokensd has new data:
+     - a ZMQ SUB socket connected to LITETOKENSD_ZMQ_CONNECT (any message published there counts as a notification).
+       As connecting succeeds whether or not anything is publishing there, this source only counts as up once a
+       message has come in, and until none has for ZMQ_SILENCE_TIMEOUT
+     - a watch on the modification time of litetokensd's (sqlite) database at LITETOKENSD_DB_PATH
+     - notify(), which can be called directly (e.g. as a local stand-in for the above when testing)
+    If no source is up, wait() falls back to adaptive polling: it returns quickly while litetokensd has new messages
+    coming in, and backs off to MAX_WAIT while idle."""
+    def __init__(self):
+        self._event = gevent.event.Event()
+        self._sources_up = set()
+        self._poll_interval = MIN_POLL_INTERVAL
+        self._last_message_index = None
+
+    def start(self):
+        if config.LITETOKENSD_ZMQ_CONNECT:
+            gevent.spawn(self._run_source, 'zmq', self._watch_zmq)
+        if config.LITETOKENSD_DB_PATH:
+            gevent.spawn(self._run_source, 'db_file', self._watch_db_file)
+
+    def notify(self):
+        self._event.set()
+
+    def is_source_up(self):
+        return bool(self._sources_up)
+
+    def wait(self, last_message_index):
+        """waits until notified of new data (or for the poll interval to pass). last_message_index is the last message
+        index litetokensd reported, which is used to adapt the poll interval when no notification source is up"""
+        if self._sources_up:
+            timeout = MAX_WAIT
+        else:
+            if last_message_index != self._last_message_index:
+                self._poll_interval = MIN_POLL_INTERVAL
+            else:
+                self._poll_interval = min(self._poll_interval * 2, MAX_WAIT)
+            timeout = self._poll_interval
+        self._last_message_index = last_message_index
+        self._event.wait(timeout)
+        self._event.clear()
+
+    def _run_source(self, name, watch_func):
+        while True:
+            try:
+                watch_func(name)
+            except Exception, e:
+                logging.warn("Block notification source '%s' failed: %s. Retrying in %s seconds..." % (name, e, SOURCE_RETRY_INTERVAL))
+            self._sources_up.discard(name)
+            gevent.sleep(SOURCE_RETRY_INTERVAL)
+
+    def _watch_zmq(self, name):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        try:
+            socket.setsockopt(zmq.SUBSCRIBE, '')
+            socket.connect(config.LITETOKENSD_ZMQ_CONNECT)
+            logging.info("Listening for litetokensd notifications at %s" % config.LITETOKENSD_ZMQ_CONNECT)
+            while True:
+                if socket.poll(ZMQ_SILENCE_TIMEOUT * 1000):
+                    socket.recv()
+                    if name not in self._sources_up:
+                        logging.info("Receiving litetokensd notifications at %s" % config.LITETOKENSD_ZMQ_CONNECT)
+                        self._sources_up.add(name)
+                    self.notify()
+                elif name in self._sources_up:
+                    logging.info("No litetokensd notifications at %s for %i seconds, polling until the next one" % (
+                        config.LITETOKENSD_ZMQ_CONNECT, ZMQ_SILENCE_TIMEOUT))
+                    self._sources_up.discard(name)
+        finally:
+            socket.close()
+
+    def _watch_db_file(self, name):
+        paths = [config.LITETOKENSD_DB_PATH, config.LITETOKENSD_DB_PATH + '-wal'] #(sqlite writes go to the WAL file first, in WAL mode)
+        def get_mtimes():
+            return [os.stat(p).st_mtime if os.path.exists(p) else None for p in paths]
+        mtimes = get_mtimes()
+        if mtimes[0] is None:
+            raise Exception("%s does not exist" % config.LITETOKENSD_DB_PATH)
+        logging.info("Watching litetokensd database at %s for changes" % config.LITETOKENSD_DB_PATH)
+        self._sources_up.add(name)
+        while True:
+            gevent.sleep(FILE_WATCH_INTERVAL)
+            new_mtimes = get_mtimes()
+            if new_mtimes[0] is None:
+                raise Exception("%s disappeared" % config.LITETOKENSD_DB_PATH)
+            if new_mtimes != mtimes:
+                mtimes = new_mtimes
+                self.notify()
@@ -0,0 +1,227 @@
+"""
+In-process caching of API results, with an optional shared (redis) second tier
+"""
+import json
+import time
+import hashlib
+import logging
+import collections
+
+from lib import config
+
+MISSING = object() #returned by LRUCache.get() on a miss (as None can be a cached value)
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+BLOCK_RESULT_REDIS_KEY_PREFIX = "liteblockd:block_result:"
+BLOCK_RESULT_REDIS_TTL = 10 * 60 #in seconds (entries are keyed on the block index, this just keeps redis tidy)
+
+PROXY_REDIS_KEY_PREFIX = "liteblockd:proxy:"
+#cache policies for litetokensd API methods called through proxy_to_litetokensd, as (scope, TTL in seconds), where scope
+# is either 'block' (valid until liteblockd processes the next block, with the TTL only applying to redis), or 'time'
+# (valid for TTL seconds). A policy of None means the method's results are not cached. Only read only methods may be
+# cached, as a cached call never reaches litetokensd (so e.g. broadcast_tx, sign_tx and do_* must never be)
+PROXY_CACHE_POLICIES = {
+    'get_running_info': ('time', 5),
+    'get_mempool': ('time', 5),
+    'get_unspent_txouts': ('time', 5), #(also changes with the mempool)
+    'search_raw_transactions': ('time', 5), #(likewise)
+    'unpack': ('time', 60),
+}
+PROXY_CACHE_PREFIX_POLICIES = [ #(method name prefix, policy), for methods not in PROXY_CACHE_POLICIES
+    ('get_', ('block', 10 * 60)),
+]
+PROXY_CACHE_DEFAULT_POLICY = None #(anything else, including create_* methods, which build transactions off of the current UTXO set)
+PROXY_STATS_MAX_METHODS = 250 #(method names come from clients, so we only keep separate stats for so many of them)
+
+def get_proxy_cache_policy(method):
+    """returns the cache policy for the given litetokensd API method (see PROXY_CACHE_POLICIES). As only read only
+    methods have one, this also tells if the method is read only"""
+    if method in PROXY_CACHE_POLICIES:
+        return PROXY_CACHE_POLICIES[method]
+    for prefix, policy in PROXY_CACHE_PREFIX_POLICIES:
+        if method.startswith(prefix):
+            return policy
+    return PROXY_CACHE_DEFAULT_POLICY
+
+def _delete_redis_keys(redis_client, pattern):
+    """deletes all redis keys matching the given pattern"""
+    try:
+        keys = list(redis_client.scan_iter(match=pattern))
+        for i in xrange(0, len(keys), 1000):
+            redis_client.delete(*keys[i:i + 1000])
+    except Exception, e:
+        logging.warn("Could not delete cache entries from redis: %s" % e)
+
+class LRUCache(object):
+    """A least recently used cache with a budget on the total size of the values it holds. Value sizes are given by the
+    caller (e.g. the length of the value's JSON encoding)"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() #key -> (value, size), least recently used first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return MISSING
+        self._entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size):
+        self.delete(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def delete(self, key):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+
+    def delete_where(self, predicate):
+        """removes all entries whose key matches the given predicate"""
+        for key in [k for k in self._entries if predicate(k)]:
+            self.delete(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+class BlockResultCache(object):
+    """Caches function results for the block liteblockd is currently at (config.CURRENT_BLOCK_INDEX). Entries are
+    keyed on the block index, function name and a canonical (JSON) encoding of the arguments, and are only valid until
+    the next block is processed (see invalidate()).
+
+    Cached results are shared between callers, and so must not be modified by them."""
+    def __init__(self, lru=None, redis_client=None):
+        self.lru = lru if lru is not None else LRUCache(DEFAULT_MAX_BYTES) #(may be shared with other caches)
+        self.redis_client = redis_client
+
+    def _get_key(self, func_name, args, kwargs):
+        args_hash = hashlib.sha1(json.dumps([args, kwargs], sort_keys=True, default=repr)).hexdigest()
+        return ('block_result', config.CURRENT_BLOCK_INDEX, func_name, args_hash)
+
+    def get_or_compute(self, func_name, func, args, kwargs):
+        key = self._get_key(func_name, args, kwargs)
+        result = self.lru.get(key)
+        if result is not MISSING:
+            return result
+
+        redis_key = BLOCK_RESULT_REDIS_KEY_PREFIX + "%i:%s:%s" % key[1:]
+        if self.redis_client:
+            try:
+                encoded = self.redis_client.get(redis_key)
+            except Exception, e:
+                logging.warn("Could not read block result cache entry from redis: %s" % e)
+                encoded = None
+            if encoded is not None:
+                result = json.loads(encoded)
+                self.lru.set(key, result, len(encoded))
+                return result
+
+        result = func(*args, **kwargs)
+        if key[1] != config.CURRENT_BLOCK_INDEX:
+            return result #a new block came in while computing the result, which may or may not reflect it
+        encoded = json.dumps(result)
+        self.lru.set(key, result, len(encoded))
+        if self.redis_client:
+            try:
+                self.redis_client.setex(redis_key, BLOCK_RESULT_REDIS_TTL, encoded)
+            except Exception, e:
+                logging.warn("Could not write block result cache entry to redis: %s" % e)
+        return result
+
+    def invalidate(self):
+        """drops all in-process entries (called as a new block is processed). redis entries are left to expire, as they
+        are keyed on the block index and another liteblockd sharing them may still be at that block"""
+        self.lru.delete_where(lambda key: key[0] == 'block_result')
+
+    def purge(self):
+        """drops all entries, including those in redis (called when blocks are rolled back or reparsed, as results
+        computed for an orphaned block would otherwise be served again once we're back at its height)"""
+        self.invalidate()
+        if self.redis_client:
+            _delete_redis_keys(self.redis_client, BLOCK_RESULT_REDIS_KEY_PREFIX + "*")
+
+class ProxyResultCache(object):
+    """Caches the results of litetokensd API calls made on behalf of clients (see api.proxy_to_litetokensd), in memory
+    and, optionally, in redis (shared with other liteblockd instances), according to the called method's policy in
+    PROXY_CACHE_POLICIES. Also keeps hit/miss counts per method"""
+    def __init__(self, lru=None, redis_client=None):
+        self.lru = lru if lru is not None else LRUCache(DEFAULT_MAX_BYTES) #(may be shared with other caches)
+        self.redis_client = redis_client
+        self.stats = {} #method -> {'hits': ..., 'redis_hits': ..., 'misses': ..., 'uncached': ...}
+
+    def get_policy(self, method):
+        return get_proxy_cache_policy(method)
+
+    def get_or_call(self, method, params, call_func):
+        """returns the cached result of calling method with params, or calls call_func(method, params) to get it. Error
+        results are not cached"""
+        if method not in self.stats and len(self.stats) >= PROXY_STATS_MAX_METHODS:
+            stats = self.stats.setdefault('(other)', {'hits': 0, 'redis_hits': 0, 'misses': 0, 'uncached': 0})
+        else:
+            stats = self.stats.setdefault(method, {'hits': 0, 'redis_hits': 0, 'misses': 0, 'uncached': 0})
+        policy = self.get_policy(method)
+        if policy is None:
+            stats['uncached'] += 1
+            return call_func(method, params)
+        scope, ttl = policy
+        block_index = config.CURRENT_BLOCK_INDEX if scope == 'block' else None
+        params_hash = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+        key = ('proxy', scope, block_index, method, params_hash)
+
+        entry = self.lru.get(key)
+        if entry is not MISSING and (entry[0] is None or entry[0] > time.time()):
+            stats['hits'] += 1
+            return entry[1]
+
+        redis_key = PROXY_REDIS_KEY_PREFIX + "%s:%s:%s:%s" % key[1:]
+        if self.redis_client:
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                pipe.get(redis_key)
+                pipe.ttl(redis_key)
+                encoded, remaining_ttl = pipe.execute()
+            except Exception, e:
+                logging.warn("Could not read proxy cache entry from redis: %s" % e)
+                encoded = None
+            if encoded is not None:
+                stats['redis_hits'] += 1
+                result = json.loads(encoded)
+                expires = time.time() + max(remaining_ttl or 0, 0) if scope == 'time' else None
+                self.lru.set(key, (expires, result), len(encoded))
+                return result
+
+        stats['misses'] += 1
+        result = call_func(method, params)
+        if 'error' in result or block_index != (config.CURRENT_BLOCK_INDEX if scope == 'block' else None):
+            return result
+        encoded = json.dumps(result)
+        self.lru.set(key, (time.time() + ttl if scope == 'time' else None, result), len(encoded))
+        if self.redis_client:
+            try:
+                self.redis_client.setex(redis_key, ttl, encoded)
+            except Exception, e:
+                logging.warn("Could not write proxy cache entry to redis: %s" % e)
+        return result
+
+    def invalidate(self):
+        """drops all in-process block scoped entries (called as a new block is processed)"""
+        self.lru.delete_where(lambda key: key[0] == 'proxy' and key[1] == 'block')
+
+    def purge(self):
+        """drops all block scoped entries, including those in redis (see BlockResultCache.purge)"""
+        self.invalidate()
+        if self.redis_client:
+            _delete_redis_keys(self.redis_client, PROXY_REDIS_KEY_PREFIX + "block:*")
@@ -0,0 +1,137 @@
+"""
+Compressed on-disk snapshots of the collections liteblockd builds from the litetokensd message feed, so that a new node
+(or one that lost or corrupted its database) can be brought up from the newest checkpoint instead of a full reparse.
+
+A checkpoint file is a gzipped stream of BSON documents: the first holds the checkpoint's metadata, and each one after
+that is a {'c': <collection name>, 'd': <document>} record.
+"""
+import os
+import re
+import gzip
+import struct
+import logging
+import datetime
+
+import bson
+import gevent
+
+from lib import config
+
+CHECKPOINT_COLLECTIONS = ('tracked_assets', 'asset_extended_info', 'trades', 'trade_candles', 'balance_changes',
+    'transaction_stats', 'order_matches', 'feeds', 'processed_blocks')
+#^ processed_blocks must go last, so that a restore that dies part way through only leaves data behind that the
+# startup prune (see blockfeed.prune_my_stale_blocks) will clean up
+CHECKPOINT_KEEP = 2 #number of checkpoint files to keep around
+CHECKPOINT_FILENAME_RE = re.compile(r'^checkpoint\.(\d+)\.(mainnet|testnet)\.(\d+)\.bson\.gz$')
+RESTORE_BATCH_SIZE = 1000
+WRITE_BATCH_SIZE = 1000 #number of documents to encode and compress at a time (off of the gevent hub)
+
+def _get_checkpoint_dir():
+    path = os.path.join(config.DATA_DIR, config.SUBDIR_CHECKPOINTS)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def _read_docs(f):
+    while True:
+        size_data = f.read(4)
+        if not size_data:
+            return
+        size = struct.unpack("<i", size_data)[0]
+        yield bson.BSON(size_data + f.read(size - 4)).decode()
+
+def _write_records(f, records):
+    f.write(''.join(bson.BSON.encode(r) for r in records))
+
+def list_checkpoints():
+    """returns (block_index, path) tuples for the checkpoints for our DB version and network, newest first"""
+    checkpoints = []
+    for filename in os.listdir(_get_checkpoint_dir()):
+        m = CHECKPOINT_FILENAME_RE.match(filename)
+        if     m and int(m.group(1)) == config.DB_VERSION \
+           and (m.group(2) == 'testnet') == config.TESTNET:
+            checkpoints.append((int(m.group(3)), os.path.join(_get_checkpoint_dir(), filename)))
+    return sorted(checkpoints, reverse=True)
+
+def write_checkpoint(mongo_db, app_config, block):
+    """writes a checkpoint of the derived collections, as of (just after) the given processed block. Should be called
+    from blockfeed in between blocks, so that the collections are consistent with each other. The documents are read
+    from the blockfeed greenlet, but encoded and compressed on gevent's threadpool, so that the rest of liteblockd
+    (API requests, etc) keeps running while the checkpoint is written"""
+    filename = "checkpoint.%i.%s.%i.bson.gz" % (config.DB_VERSION, 'testnet' if config.TESTNET else 'mainnet', block['block_index'])
+    path = os.path.join(_get_checkpoint_dir(), filename)
+    logging.info("Writing checkpoint at block %i to %s ..." % (block['block_index'], path))
+    f = gzip.open(path + '.tmp', 'wb')
+    try:
+        f.write(bson.BSON.encode({
+            'db_version': config.DB_VERSION,
+            'running_testnet': config.TESTNET,
+            'litetokensd_db_version_major': app_config['litetokensd_db_version_major'],
+            'litetokensd_db_version_minor': app_config['litetokensd_db_version_minor'],
+            'litetokensd_running_testnet': app_config['litetokensd_running_testnet'],
+            'block_index': block['block_index'],
+            'block_hash': block['block_hash'],
+            'last_message_index': config.LAST_MESSAGE_INDEX,
+            'created': datetime.datetime.utcnow(),
+        }))
+        threadpool = gevent.get_hub().threadpool
+        for collection in CHECKPOINT_COLLECTIONS:
+            records = []
+            for doc in mongo_db[collection].find().sort('_id', 1):
+                records.append({'c': collection, 'd': doc})
+                if len(records) >= WRITE_BATCH_SIZE:
+                    threadpool.apply(_write_records, (f, records))
+                    records = []
+            if records:
+                threadpool.apply(_write_records, (f, records))
+        f.close()
+    except:
+        #don't leave a partial checkpoint behind
+        try:
+            f.close()
+        except Exception:
+            pass #(e.g. the disk is still full, the original error is the one to raise)
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+    os.rename(path + '.tmp', path)
+
+    for block_index, old_path in list_checkpoints()[CHECKPOINT_KEEP:]:
+        os.remove(old_path)
+
+def read_checkpoint_info(path):
+    """returns the metadata stored in the given checkpoint file"""
+    f = gzip.open(path, 'rb')
+    try:
+        return _read_docs(f).next()
+    finally:
+        f.close()
+
+def restore_checkpoint(mongo_db, path):
+    """replaces the checkpointed collections (and app_config) with the contents of the given checkpoint file, and
+    returns the checkpoint's metadata"""
+    f = gzip.open(path, 'rb')
+    try:
+        docs = _read_docs(f)
+        info = docs.next()
+        logging.warn("Restoring from checkpoint at block %i (%s) ..." % (info['block_index'], path))
+        mongo_db.app_config.update({}, {'$set': {
+            'litetokensd_db_version_major': info['litetokensd_db_version_major'],
+            'litetokensd_db_version_minor': info['litetokensd_db_version_minor'],
+            'litetokensd_running_testnet': info['litetokensd_running_testnet'],
+            'last_block_assets_compiled': config.BLOCK_FIRST, #market info isn't checkpointed and will be recompiled
+        }})
+        for collection in CHECKPOINT_COLLECTIONS:
+            mongo_db[collection].remove()
+
+        batch = []
+        for record in docs:
+            if batch and batch[0]['c'] != record['c'] or len(batch) >= RESTORE_BATCH_SIZE:
+                mongo_db[batch[0]['c']].insert([r['d'] for r in batch])
+                batch = []
+            batch.append(record)
+        if batch:
+            mongo_db[batch[0]['c']].insert([r['d'] for r in batch])
+    finally:
+        f.close()
+    return info
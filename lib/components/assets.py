@@ -35,44 +35,56 @@ def parse_issuance(db, message, cur_block_index, cur_block):
             if os.path.exists(imagePath):
                 os.remove(imagePath)
 
-    tracked_asset = db.tracked_assets.find_one(
-        {'asset': message['asset']}, {'_id': 0, '_history': 0})
-    #^ pulls the tracked asset without the _id and history fields. This may be None
+    tracked_asset = util.get_tracked_asset(message['asset'])
+    #^ the current state of the tracked asset (without the _id and history fields), from the cache. This may be None
     
     if message['locked']: #lock asset
         assert tracked_asset is not None
+        changes = {
+            '_at_block': cur_block_index,
+            '_at_block_time': cur_block['block_time_obj'], 
+            '_change_type': 'locked',
+            'locked': True,
+        }
+        increments = { #(a locking issuance can issue more of the asset as well)
+            'total_issued': message['quantity'],
+            'total_issued_normalized': util_litecoin.normalize_quantity(message['quantity'], tracked_asset['divisible'])
+        }
         db.tracked_assets.update(
             {'asset': message['asset']},
-            {"$set": {
-                '_at_block': cur_block_index,
-                '_at_block_time': cur_block['block_time_obj'], 
-                '_change_type': 'locked',
-                'locked': True,
-             },
+            {"$set": changes,
+             "$inc": increments,
              "$push": {'_history': tracked_asset } }, upsert=False)
+        util.cache_tracked_asset(dict(tracked_asset, **dict(changes,
+            total_issued=tracked_asset['total_issued'] + increments['total_issued'],
+            total_issued_normalized=tracked_asset['total_issued_normalized'] + increments['total_issued_normalized'])))
         logging.info("Locking asset %s" % (message['asset'],))
     elif message['transfer']: #transfer asset
         assert tracked_asset is not None
+        changes = {
+            '_at_block': cur_block_index,
+            '_at_block_time': cur_block['block_time_obj'], 
+            '_change_type': 'transferred',
+            'owner': message['issuer'],
+        }
         db.tracked_assets.update(
             {'asset': message['asset']},
-            {"$set": {
-                '_at_block': cur_block_index,
-                '_at_block_time': cur_block['block_time_obj'], 
-                '_change_type': 'transferred',
-                'owner': message['issuer'],
-             },
+            {"$set": changes,
              "$push": {'_history': tracked_asset } }, upsert=False)
+        util.cache_tracked_asset(dict(tracked_asset, **changes))
         logging.info("Transferring asset %s to address %s" % (message['asset'], message['issuer']))
     elif message['quantity'] == 0 and tracked_asset is not None: #change description
+        changes = {
+            '_at_block': cur_block_index,
+            '_at_block_time': cur_block['block_time_obj'], 
+            '_change_type': 'changed_description',
+            'description': message['description'],
+        }
         db.tracked_assets.update(
             {'asset': message['asset']},
-            {"$set": {
-                '_at_block': cur_block_index,
-                '_at_block_time': cur_block['block_time_obj'], 
-                '_change_type': 'changed_description',
-                'description': message['description'],
-             },
+            {"$set": changes,
              "$push": {'_history': tracked_asset } }, upsert=False)
+        util.cache_tracked_asset(dict(tracked_asset, **changes))
         modify_extended_asset_info(message['asset'], message['description'])
         logging.info("Changing description for asset %s to '%s'" % (message['asset'], message['description']))
     else: #issue new asset or issue addition qty of an asset
@@ -94,22 +106,28 @@ def parse_issuance(db, message, cur_block_index, cur_block):
                 '_history': [] #to allow for block rollbacks
             }
             db.tracked_assets.insert(tracked_asset)
+            util.cache_tracked_asset(tracked_asset)
             logging.info("Tracking new asset: %s" % message['asset'])
             modify_extended_asset_info(message['asset'], message['description'])
         else: #issuing additional of existing asset
             assert tracked_asset is not None
+            changes = {
+                '_at_block': cur_block_index,
+                '_at_block_time': cur_block['block_time_obj'], 
+                '_change_type': 'issued_more',
+            }
+            increments = {
+                'total_issued': message['quantity'],
+                'total_issued_normalized': util_litecoin.normalize_quantity(message['quantity'], message['divisible'])
+            }
             db.tracked_assets.update(
                 {'asset': message['asset']},
-                {"$set": {
-                    '_at_block': cur_block_index,
-                    '_at_block_time': cur_block['block_time_obj'], 
-                    '_change_type': 'issued_more',
-                 },
-                 "$inc": {
-                     'total_issued': message['quantity'],
-                     'total_issued_normalized': util_litecoin.normalize_quantity(message['quantity'], message['divisible'])
-                 },
+                {"$set": changes,
+                 "$inc": increments,
                  "$push": {'_history': tracked_asset} }, upsert=False)
+            util.cache_tracked_asset(dict(tracked_asset, **dict(changes,
+                total_issued=tracked_asset['total_issued'] + increments['total_issued'],
+                total_issued_normalized=tracked_asset['total_issued_normalized'] + increments['total_issued_normalized'])))
             logging.info("Adding additional %s quantity for asset %s" % (
                 util_litecoin.normalize_quantity(message['quantity'], message['divisible']), message['asset']))
     return True
@@ -210,63 +228,63 @@ def get_escrowed_balances(addresses):
             WHERE source IN ({}) AND status = ? AND give_asset != ?
             GROUP BY source_asset'''.format(addresses_holder)
     bindings = addresses + ['open', 'LTC']
-    results = util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results = util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT (tx0_address || '_' || forward_asset) AS source_asset, tx0_address AS address, forward_asset AS asset, SUM(forward_quantity) AS quantity
              FROM order_matches
              WHERE tx0_address IN ({}) AND forward_asset != ? AND status = ?
              GROUP BY source_asset'''.format(addresses_holder)
     bindings = addresses + ['LTC', 'pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT (tx1_address || '_' || backward_asset) AS source_asset, tx1_address AS address, backward_asset AS asset, SUM(backward_quantity) AS quantity
              FROM order_matches
              WHERE tx1_address IN ({}) AND backward_asset != ? AND status = ?
              GROUP BY source_asset'''.format(addresses_holder)
     bindings = addresses + ['LTC', 'pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT source AS address, '{}' AS asset, SUM(wager_remaining) AS quantity
              FROM bets
              WHERE source IN ({}) AND status = ?
              GROUP BY address'''.format(config.XLT, addresses_holder)
     bindings = addresses + ['open']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT tx0_address AS address, '{}' AS asset, SUM(forward_quantity) AS quantity
              FROM bet_matches
              WHERE tx0_address IN ({}) AND status = ?
              GROUP BY address'''.format(config.XLT, addresses_holder)
     bindings = addresses + ['pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT tx1_address AS address, '{}' AS asset, SUM(backward_quantity) AS quantity
              FROM bet_matches
              WHERE tx1_address IN ({}) AND status = ?
              GROUP BY address'''.format(config.XLT, addresses_holder)
     bindings = addresses + ['pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT source AS address, '{}' AS asset, SUM(wager) AS quantity
              FROM rps
              WHERE source IN ({}) AND status = ?
              GROUP BY address'''.format(config.XLT, addresses_holder)
     bindings = addresses + ['open']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT tx0_address AS address, '{}' AS asset, SUM(wager) AS quantity
              FROM rps_matches
              WHERE tx0_address IN ({}) AND status IN (?, ?, ?)
              GROUP BY address'''.format(config.XLT, addresses_holder)
     bindings = addresses + ['pending', 'pending and resolved', 'resolved and pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     sql = '''SELECT tx1_address AS address, '{}' AS asset, SUM(wager) AS quantity
              FROM rps_matches
              WHERE tx1_address IN ({}) AND status IN (?, ?, ?)
              GROUP BY address'''.format(config.XLT, addresses_holder)
     bindings = addresses + ['pending', 'pending and resolved', 'resolved and pending']
-    results += util.call_jsonrpc_api("sql", {'query': sql, 'bindings': bindings}, abort_on_error=True)['result']
+    results += util.call_sql(sql, bindings, abort_on_error=True)
 
     escrowed_balances = {}
     for order in results:
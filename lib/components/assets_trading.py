@@ -8,11 +8,15 @@ import time
 import copy
 import decimal
 import cgi
+import bisect
+import itertools
 
 import numpy
 import pymongo
+from bson.son import SON
 
 from lib import config, util, util_litecoin
+from lib.components import candles, trade_windows
 
 D = decimal.Decimal
 
@@ -34,8 +38,8 @@ def get_market_price_summary(asset1, asset2, with_last_trades=0, start_dt=None,
     
     #look for the last max 6 trades within the past 10 day window
     base_asset, quote_asset = util.assets_to_asset_pair(asset1, asset2)
-    base_asset_info = mongo_db.tracked_assets.find_one({'asset': base_asset})
-    quote_asset_info = mongo_db.tracked_assets.find_one({'asset': quote_asset})
+    base_asset_info = util.get_tracked_asset(base_asset)
+    quote_asset_info = util.get_tracked_asset(quote_asset)
     
     if not isinstance(with_last_trades, int) or with_last_trades < 0 or with_last_trades > 30:
         raise Exception("Invalid with_last_trades")
@@ -83,7 +87,19 @@ def calc_inverse(quantity):
 def calc_price_change(open, close):
     return float((D(100) * (D(close) - D(open)) / D(open)))            
 
+@util.block_cache
+def get_current_price_primatives():
+    """the current XLT/LTC cross rates, cached for the current block (as the market info jobs all need them)"""
+    return _get_price_primatives()
+
 def get_price_primatives(start_dt=None, end_dt=None):
+    if start_dt is None and end_dt is None:
+        price_primatives = get_current_price_primatives()
+        if price_primatives is not None: #(None on an error, which _get_price_primatives() will raise below)
+            return tuple(price_primatives)
+    return _get_price_primatives(start_dt=start_dt, end_dt=end_dt)
+
+def _get_price_primatives(start_dt=None, end_dt=None):
     mps_xlt_ltc = get_market_price_summary(config.XLT, config.LTC, start_dt=start_dt, end_dt=end_dt)
     xlt_ltc_price = mps_xlt_ltc['market_price'] if mps_xlt_ltc else None # == XLT/LTC
     ltc_xlt_price = calc_inverse(mps_xlt_ltc['market_price']) if mps_xlt_ltc else None #LTC/XLT
@@ -91,10 +107,11 @@ def get_price_primatives(start_dt=None, end_dt=None):
 
 def get_asset_info(asset, at_dt=None):
     mongo_db = config.mongo_db
-    asset_info = mongo_db.tracked_assets.find_one({'asset': asset})
+    asset_info = util.get_tracked_asset(asset)
     
     if asset not in (config.XLT, config.LTC) and at_dt and asset_info['_at_block_time'] > at_dt:
         #get the asset info at or before the given at_dt datetime
+        asset_info = mongo_db.tracked_assets.find_one({'asset': asset}) #(the cached asset info has no _history)
         for e in reversed(asset_info['_history']): #newest to oldest
             if e['_at_block_time'] <= at_dt:
                 asset_info = e
@@ -204,100 +221,14 @@ def compile_summary_market_info(asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price
         'market_cap_in_{}'.format(config.LTC.lower()): market_cap_in_ltc,
     }
 
-def compile_24h_market_info(asset):        
-    asset_data = {}
-    start_dt_1d = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-    mongo_db = config.mongo_db
+def compile_24h_market_info(asset):
+    _24h_window = trade_windows.rolling_trade_stats.windows['24h']
 
-    #perform aggregation to get 24h statistics
     #TOTAL volume and count across all trades for the asset (on ALL markets, not just XLT and LTC pairings)
-    _24h_vols = {'vol': 0, 'count': 0}
-    _24h_vols_as_base = mongo_db.trades.aggregate([
-        {"$match": {
-            "base_asset": asset,
-            "block_time": {"$gte": start_dt_1d } }},
-        {"$project": {
-            "base_quantity_normalized": 1 #to derive volume
-        }},
-        {"$group": {
-            "_id":   1,
-            "vol":   {"$sum": "$base_quantity_normalized"},
-            "count": {"$sum": 1},
-        }}
-    ])
-    _24h_vols_as_base = {} if not _24h_vols_as_base['ok'] \
-        or not len(_24h_vols_as_base['result']) else _24h_vols_as_base['result'][0]
-    _24h_vols_as_quote = mongo_db.trades.aggregate([
-        {"$match": {
-            "quote_asset": asset,
-            "block_time": {"$gte": start_dt_1d } }},
-        {"$project": {
-            "quote_quantity_normalized": 1 #to derive volume
-        }},
-        {"$group": {
-            "_id":   1,
-            "vol":   {"$sum": "quote_quantity_normalized"},
-            "count": {"$sum": 1},
-        }}
-    ])
-    _24h_vols_as_quote = {} if not _24h_vols_as_quote['ok'] \
-        or not len(_24h_vols_as_quote['result']) else _24h_vols_as_quote['result'][0]
-    _24h_vols['vol'] = _24h_vols_as_base.get('vol', 0) + _24h_vols_as_quote.get('vol', 0) 
-    _24h_vols['count'] = _24h_vols_as_base.get('count', 0) + _24h_vols_as_quote.get('count', 0) 
-    
-    #XLT market volume with stats
-    if asset != config.XLT:
-        _24h_ohlc_in_xlt = mongo_db.trades.aggregate([
-            {"$match": {
-                "base_asset": config.XLT,
-                "quote_asset": asset,
-                "block_time": {"$gte": start_dt_1d } }},
-            {"$project": {
-                "unit_price": 1,
-                "base_quantity_normalized": 1 #to derive volume
-            }},
-            {"$group": {
-                "_id":   1,
-                "open":  {"$first": "$unit_price"},
-                "high":  {"$max": "$unit_price"},
-                "low":   {"$min": "$unit_price"},
-                "close": {"$last": "$unit_price"},
-                "vol":   {"$sum": "$base_quantity_normalized"},
-                "count": {"$sum": 1},
-            }}
-        ])
-        _24h_ohlc_in_xlt = {} if not _24h_ohlc_in_xlt['ok'] \
-            or not len(_24h_ohlc_in_xlt['result']) else _24h_ohlc_in_xlt['result'][0]
-        if _24h_ohlc_in_xlt: del _24h_ohlc_in_xlt['_id']
-    else:
-        _24h_ohlc_in_xlt = {}
-        
-    #LTC market volume with stats
-    if asset != config.LTC:
-        _24h_ohlc_in_ltc = mongo_db.trades.aggregate([
-            {"$match": {
-                "base_asset": config.LTC,
-                "quote_asset": asset,
-                "block_time": {"$gte": start_dt_1d } }},
-            {"$project": {
-                "unit_price": 1,
-                "base_quantity_normalized": 1 #to derive volume
-            }},
-            {"$group": {
-                "_id":   1,
-                "open":  {"$first": "$unit_price"},
-                "high":  {"$max": "$unit_price"},
-                "low":   {"$min": "$unit_price"},
-                "close": {"$last": "$unit_price"},
-                "vol":   {"$sum": "$base_quantity_normalized"},
-                "count": {"$sum": 1},
-            }}
-        ])
-        _24h_ohlc_in_ltc = {} if not _24h_ohlc_in_ltc['ok'] \
-            or not len(_24h_ohlc_in_ltc['result']) else _24h_ohlc_in_ltc['result'][0]
-        if _24h_ohlc_in_ltc: del _24h_ohlc_in_ltc['_id']
-    else:
-        _24h_ohlc_in_ltc = {}
+    _24h_vols = _24h_window.get_asset_totals(asset)
+    #XLT and LTC market volume with stats
+    _24h_ohlc_in_xlt = _24h_window.get_pair_ohlc(config.XLT, asset) if asset != config.XLT else {}
+    _24h_ohlc_in_ltc = _24h_window.get_pair_ohlc(config.LTC, asset) if asset != config.LTC else {}
         
     return {
         '24h_summary': _24h_vols,
@@ -320,71 +251,78 @@ def compile_7d_market_info(asset):
     #get XLT and LTC market summarized trades over a 7d period (quantize to hour long slots)
     _7d_history_in_xlt = None # xlt/asset market (or xlt/ltc for xlt or ltc)
     _7d_history_in_ltc = None # ltc/asset market (or ltc/xlt for xlt or ltc)
+    def get_7d_history(base_asset, quote_asset):
+        #(average price and volume per hour, from the pre-aggregated hourly candles)
+        return [{
+            'when': time.mktime(c['interval_time'].timetuple()) * 1000,
+            'price': c['price_sum'] / c['count'],
+            'vol': c['vol'],
+        } for c in candles.get_candles(mongo_db, base_asset, quote_asset, '1h', start_dt_7d)]
+
     if asset not in [config.LTC, config.XLT]:
-        for a in [config.XLT, config.LTC]:
-            _7d_history = mongo_db.trades.aggregate([
-                {"$match": {
-                    "base_asset": a,
-                    "quote_asset": asset,
-                    "block_time": {"$gte": start_dt_7d }
-                }},
-                {"$project": {
-                    "year":  {"$year": "$block_time"},
-                    "month": {"$month": "$block_time"},
-                    "day":   {"$dayOfMonth": "$block_time"},
-                    "hour":  {"$hour": "$block_time"},
-                    "unit_price": 1,
-                    "base_quantity_normalized": 1 #to derive volume
-                }},
-                {"$sort": {"block_time": pymongo.ASCENDING}},
-                {"$group": {
-                    "_id":   {"year": "$year", "month": "$month", "day": "$day", "hour": "$hour"},
-                    "price": {"$avg": "$unit_price"},
-                    "vol":   {"$sum": "$base_quantity_normalized"},
-                }},
-            ])
-            _7d_history = [] if not _7d_history['ok'] else _7d_history['result']
-            if a == config.XLT: _7d_history_in_xlt = _7d_history
-            else: _7d_history_in_ltc = _7d_history
+        _7d_history_in_xlt = get_7d_history(config.XLT, asset)
+        _7d_history_in_ltc = get_7d_history(config.LTC, asset)
     else: #get the XLT/LTC market and invert for LTC/XLT (_7d_history_in_ltc)
-        _7d_history = mongo_db.trades.aggregate([
-            {"$match": {
-                "base_asset": config.XLT,
-                "quote_asset": config.LTC,
-                "block_time": {"$gte": start_dt_7d }
-            }},
-            {"$project": {
-                "year":  {"$year": "$block_time"},
-                "month": {"$month": "$block_time"},
-                "day":   {"$dayOfMonth": "$block_time"},
-                "hour":  {"$hour": "$block_time"},
-                "unit_price": 1,
-                "base_quantity_normalized": 1 #to derive volume
-            }},
-            {"$sort": {"block_time": pymongo.ASCENDING}},
-            {"$group": {
-                "_id":   {"year": "$year", "month": "$month", "day": "$day", "hour": "$hour"},
-                "price": {"$avg": "$unit_price"},
-                "vol":   {"$sum": "$base_quantity_normalized"},
-            }},
-        ])
-        _7d_history = [] if not _7d_history['ok'] else _7d_history['result']
-        _7d_history_in_xlt = _7d_history
+        _7d_history_in_xlt = get_7d_history(config.XLT, config.LTC)
         _7d_history_in_ltc = copy.deepcopy(_7d_history_in_xlt)
         for i in xrange(len(_7d_history_in_ltc)):
             _7d_history_in_ltc[i]['price'] = calc_inverse(_7d_history_in_ltc[i]['price'])
             _7d_history_in_ltc[i]['vol'] = calc_inverse(_7d_history_in_ltc[i]['vol'])
-    
-    for l in [_7d_history_in_xlt, _7d_history_in_ltc]:
-        for e in l: #convert our _id field out to be an epoch ts (in ms), and delete _id
-            e['when'] = time.mktime(datetime.datetime(e['_id']['year'], e['_id']['month'], e['_id']['day'], e['_id']['hour']).timetuple()) * 1000 
-            del e['_id']
 
     return {
         '7d_history_in_{}'.format(config.XLT.lower()): [[e['when'], e['price']] for e in _7d_history_in_xlt],
         '7d_history_in_{}'.format(config.LTC.lower()): [[e['when'], e['price']] for e in _7d_history_in_ltc],
     }
 
+def update_market_window_info(assets=None):
+    """Writes the rolling 24h stats and 7d history to asset_market_info, for the given assets, or (if None) for those
+    whose trade windows have changed since the last call (e.g. with trades booked in a new block, or aged out)"""
+    mongo_db = config.mongo_db
+    if not trade_windows.rolling_trade_stats.loaded:
+        return
+    trade_windows.rolling_trade_stats.expire()
+    _24h_window = trade_windows.rolling_trade_stats.windows['24h']
+    _7d_window = trade_windows.rolling_trade_stats.windows['7d']
+    if assets is not None:
+        _24h_assets = _7d_assets = set(assets)
+    else:
+        _24h_assets = _24h_window.pop_dirty_assets()
+        _7d_assets = _7d_window.pop_dirty_assets()
+
+    for asset in _24h_assets:
+        mongo_db.asset_market_info.update({'asset': asset}, {"$set": compile_24h_market_info(asset)})
+    for asset in _7d_assets:
+        mongo_db.asset_market_info.update({'asset': asset}, {"$set": compile_7d_market_info(asset)})
+    if _24h_assets or _7d_assets:
+        logging.debug("Block: %s -- Updated 24h stats for %i assets, 7d stats for %i assets" % (
+            config.CURRENT_BLOCK_INDEX, len(_24h_assets), len(_7d_assets)))
+
+def reset_market_window_info():
+    """Writes the stats for every asset in the rolling trade windows, and clears them for all others (called once the
+    windows have been (re)loaded)"""
+    mongo_db = config.mongo_db
+    _24h_assets = trade_windows.rolling_trade_stats.windows['24h'].get_assets()
+    _7d_assets = trade_windows.rolling_trade_stats.windows['7d'].get_assets()
+    mongo_db.asset_market_info.update( {'asset': {'$nin': _24h_assets}}, {"$set": {
+            '24h_summary': {'vol': 0, 'count': 0},
+            '24h_ohlc_in_{}'.format(config.XLT.lower()): {},
+            '24h_ohlc_in_{}'.format(config.LTC.lower()): {},
+            '24h_vol_price_change_in_{}'.format(config.XLT.lower()): None,
+            '24h_vol_price_change_in_{}'.format(config.LTC.lower()): None,
+    }}, multi=True)
+    mongo_db.asset_market_info.update( {'asset': {'$nin': _7d_assets}}, {"$set": {
+            '7d_history_in_{}'.format(config.XLT.lower()): [],
+            '7d_history_in_{}'.format(config.LTC.lower()): [],
+    }}, multi=True)
+    for asset in _24h_assets:
+        mongo_db.asset_market_info.update({'asset': asset}, {"$set": compile_24h_market_info(asset)})
+    for asset in _7d_assets:
+        mongo_db.asset_market_info.update({'asset': asset}, {"$set": compile_7d_market_info(asset)})
+    for window in trade_windows.rolling_trade_stats.windows.itervalues():
+        window.pop_dirty_assets()
+    logging.info("Block: %s -- Calculated 24h stats for %i assets, 7d stats for %i assets" % (
+        config.CURRENT_BLOCK_INDEX, len(_24h_assets), len(_7d_assets)))
+
 def compile_asset_pair_market_info():
     """Compiles the pair-level statistics that show on the View Prices page of litetokenswallet, for instance"""
     #loop through all open orders, and compile a listing of pairs, with a count of open orders for each pair
@@ -412,10 +350,10 @@ def compile_asset_pair_market_info():
     for o in open_orders:
         (base_asset, quote_asset) = util.assets_to_asset_pair(o['give_asset'], o['get_asset'])
         pair = '%s/%s' % (base_asset, quote_asset)
-        base_asset_info = asset_info.get(base_asset, mongo_db.tracked_assets.find_one({ 'asset': base_asset }))
-        if base_asset not in asset_info: asset_info[base_asset] = base_asset_info
-        quote_asset_info = asset_info.get(quote_asset, mongo_db.tracked_assets.find_one({ 'asset': quote_asset }))
-        if quote_asset not in asset_info: asset_info[quote_asset] = quote_asset_info
+        if base_asset not in asset_info: asset_info[base_asset] = util.get_tracked_asset(base_asset)
+        if quote_asset not in asset_info: asset_info[quote_asset] = util.get_tracked_asset(quote_asset)
+        base_asset_info = asset_info[base_asset]
+        quote_asset_info = asset_info[quote_asset]
         
         pair_data.setdefault(pair, {'open_orders_count': 0, 'lowest_ask': None, 'highest_bid': None,
             'completed_trades_count': 0, 'vol_base': 0, 'vol_quote': 0})
@@ -461,8 +399,26 @@ def compile_asset_pair_market_info():
         pair_data[pair]['vol_base'] = e['vol_base'] 
         pair_data[pair]['vol_quote'] = e['vol_quote'] 
     
+    #get the last trade for a pair (before the given time, if any), for the % change stats. this is a single lookup on
+    # the trades (base_asset, quote_asset, block_time) index
+    def get_last_trade(base_asset, quote_asset, before_dt=None):
+        match = {'base_asset': base_asset, 'quote_asset': quote_asset}
+        if before_dt:
+            match['block_time'] = {"$lt": before_dt}
+        last_trades = list(mongo_db.trades.find(match, fields=['base_quantity_normalized', 'quote_quantity_normalized']
+            ).sort('block_time', pymongo.DESCENDING).limit(1))
+        return last_trades[0] if last_trades else None
+    
     #compose price data, relative to LTC and XLT
     mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price = get_price_primatives()
+    prices = {} #asset -> (price_in_xlt, price_in_ltc), as the same asset usually shows up in several pairs
+    def get_prices(asset):
+        if asset not in prices:
+            price_info = get_xlt_ltc_price_info(asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price, with_last_trades=0, start_dt=start_dt, end_dt=end_dt)
+            prices[asset] = (price_info[2], price_info[3])
+        return prices[asset]
+    
+    bulk = mongo_db.asset_pair_market_info.initialize_unordered_bulk_op()
     for pair, e in pair_data.iteritems():
         base_asset, quote_asset = pair.split('/')
         _24h_vol_in_ltc = None
@@ -475,8 +431,7 @@ def compile_asset_pair_market_info():
             _24h_vol_in_xlt = util_litecoin.round_out(e['vol_base'] * ltc_xlt_price) if ltc_xlt_price else 0
             _24h_vol_in_ltc = e['vol_base']
         else: #base is not XLT or LTC
-            price_summary_in_xlt, price_summary_in_ltc, price_in_xlt, price_in_ltc, aggregated_price_in_xlt, aggregated_price_in_ltc = \
-                get_xlt_ltc_price_info(base_asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price, with_last_trades=0, start_dt=start_dt, end_dt=end_dt)
+            price_in_xlt, price_in_ltc = get_prices(base_asset)
             if price_in_xlt:
                 _24h_vol_in_xlt = util_litecoin.round_out(e['vol_base'] * price_in_xlt)
             if price_in_ltc:
@@ -484,8 +439,7 @@ def compile_asset_pair_market_info():
             
             if _24h_vol_in_xlt is None or _24h_vol_in_ltc is None:
                 #the base asset didn't have price data against LTC or XLT, or both...try against the quote asset instead
-                price_summary_in_xlt, price_summary_in_ltc, price_in_xlt, price_in_ltc, aggregated_price_in_xlt, aggregated_price_in_ltc = \
-                    get_xlt_ltc_price_info(quote_asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price, with_last_trades=0, start_dt=start_dt, end_dt=end_dt)
+                price_in_xlt, price_in_ltc = get_prices(quote_asset)
                 if _24h_vol_in_xlt is None and price_in_xlt:
                     _24h_vol_in_xlt = util_litecoin.round_out(e['vol_quote'] * price_in_xlt)
                 if _24h_vol_in_ltc is None and price_in_ltc:
@@ -493,30 +447,132 @@ def compile_asset_pair_market_info():
             pair_data[pair]['24h_vol_in_{}'.format(config.XLT.lower())] = _24h_vol_in_xlt #might still be None
             pair_data[pair]['24h_vol_in_{}'.format(config.LTC.lower())] = _24h_vol_in_ltc #might still be None
         
-        #get % change stats -- start by getting the first trade directly before the 24h period starts
-        prev_trade = mongo_db.trades.find({
-            "base_asset": base_asset,
-            "quote_asset": quote_asset,
-            "block_time": {'$lt': start_dt}}).sort('block_time', pymongo.DESCENDING).limit(1)
-        latest_trade = mongo_db.trades.find({
-            "base_asset": base_asset,
-            "quote_asset": quote_asset}).sort('block_time', pymongo.DESCENDING).limit(1)
-        if not prev_trade.count(): #no previous trade before this 24hr period
+        #get % change stats -- from the first trade directly before the 24h period starts to the latest trade
+        prev_trade = get_last_trade(base_asset, quote_asset, before_dt=start_dt)
+        if not prev_trade: #no previous trade before this 24hr period
             pair_data[pair]['24h_pct_change'] = None
         else:
-            prev_trade = prev_trade[0]
-            latest_trade = latest_trade[0]
+            #(with no trades in the 24hr period, the latest trade is the previous one)
+            latest_trade = get_last_trade(base_asset, quote_asset) if e.get('completed_trades_count') else prev_trade
             prev_trade_price = get_price(prev_trade['base_quantity_normalized'], prev_trade['quote_quantity_normalized'])
             latest_trade_price = get_price(latest_trade['base_quantity_normalized'], latest_trade['quote_quantity_normalized'])
             pair_data[pair]['24h_pct_change'] = ((latest_trade_price - prev_trade_price) / prev_trade_price) * 100
         pair_data[pair]['last_updated'] = end_dt
         #print "PRODUCED", pair, pair_data[pair] 
-        mongo_db.asset_pair_market_info.update( {'base_asset': base_asset, 'quote_asset': quote_asset}, {"$set": pair_data[pair]}, upsert=True)
+        bulk.find({'base_asset': base_asset, 'quote_asset': quote_asset}).upsert().update({"$set": pair_data[pair]})
+    if pair_data:
+        bulk.execute()
         
     #remove any old pairs that were not just updated
     mongo_db.asset_pair_market_info.remove({'last_updated': {'$lt': end_dt}})
     logging.info("Recomposed 24h trade statistics for %i asset pairs: %s" % (len(pair_data), ', '.join(pair_data.keys())))
 
+class MarketCapCalculator(object):
+    """Compiles the asset_marketcap_history points for newly made trades. The last market cap point for each asset (in
+    XLT and LTC) and each asset's supply timeline are kept in memory between runs, so that a new point only needs the
+    asset's price lookups"""
+    def __init__(self):
+        self._generation = 0 #bumped on each reset, so that a compile_block() running at the time can tell
+        self.reset()
+
+    def reset(self):
+        """call after asset_marketcap_history or tracked_assets are rolled back (e.g. on a prune)"""
+        self._generation += 1
+        self._last_market_caps = None #(asset, market_cap_as) -> market cap of the latest history point (loaded on first use)
+        self._supply_timelines = {} #asset -> ([_at_block, ...], [total_issued_normalized, ...]), oldest first
+        self._xlt_supply = (None, None) #(block_index, supply)
+
+    def _load_last_market_caps(self):
+        generation = self._generation
+        last_market_caps = config.mongo_db.asset_marketcap_history.aggregate([
+            {"$sort": SON([("block_index", pymongo.ASCENDING)])},
+            {"$group": {
+                "_id": {"asset": "$asset", "market_cap_as": "$market_cap_as"},
+                "market_cap": {"$last": "$market_cap"},
+            }}
+        ])
+        last_market_caps = [] if not last_market_caps['ok'] else last_market_caps['result']
+        if self._generation == generation: #(not reset while loading)
+            self._last_market_caps = dict(((e['_id']['asset'], e['_id']['market_cap_as']), e['market_cap']) for e in last_market_caps)
+
+    def get_supply(self, asset, block_index):
+        """returns the (normalized) supply of the asset as of the given block, or None if it didn't exist yet"""
+        if asset == config.LTC:
+            return util_litecoin.normalize_quantity(util_litecoin.get_ltc_supply(normalize=False, at_block_index=block_index))
+        elif asset == config.XLT:
+            #(current supply, see the note in get_asset_info)
+            if self._xlt_supply[0] != config.CURRENT_BLOCK_INDEX:
+                self._xlt_supply = (config.CURRENT_BLOCK_INDEX, util_litecoin.normalize_quantity(
+                    util.call_jsonrpc_api("get_xlt_supply", abort_on_error=True)['result']))
+            return self._xlt_supply[1]
+        
+        supply_timelines = self._supply_timelines #(as a reset may replace it while we're querying)
+        if asset not in supply_timelines:
+            tracked_asset = config.mongo_db.tracked_assets.find_one({'asset': asset}, {'_id': 0,
+                '_at_block': 1, 'total_issued_normalized': 1, '_history._at_block': 1, '_history.total_issued_normalized': 1})
+            if not tracked_asset:
+                return None
+            states = tracked_asset['_history'] + [tracked_asset]
+            supply_timelines[asset] = ([e['_at_block'] for e in states], [e['total_issued_normalized'] for e in states])
+        at_blocks, supplies = supply_timelines[asset]
+        #pick up any issuances since the timeline was loaded
+        current = util.get_tracked_asset(asset)
+        if not current: #(e.g. the asset was rolled back out of existence since its timeline was loaded)
+            supply_timelines.pop(asset, None)
+            return None
+        if current['_at_block'] > at_blocks[-1]:
+            at_blocks.append(current['_at_block'])
+            supplies.append(current['total_issued_normalized'])
+        elif current['_at_block'] == at_blocks[-1]:
+            supplies[-1] = current['total_issued_normalized']
+        
+        i = bisect.bisect_right(at_blocks, block_index) - 1 #(the last state with _at_block == block_index is its final one)
+        return supplies[i] if i >= 0 else None
+
+    def compile_block(self, trades):
+        """returns the new asset_marketcap_history points for the given trades, which must all be from the same block.
+        Returns None if the calculator was reset (e.g. on a reorg) while compiling them, in which case the caller should
+        stop, and pick up again from its last compiled block on its next run"""
+        generation = self._generation
+        if self._last_market_caps is None:
+            self._load_last_market_caps()
+        last_market_caps = self._last_market_caps
+        if self._generation != generation:
+            return None
+        block_index, block_time = trades[0]['block_index'], trades[0]['block_time']
+        mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price = get_price_primatives(end_dt=block_time)
+        market_cap_history = []
+        assets_in_block = set()
+        #we only want one cap point per asset per block. we go through the block's trades from the last one, as the
+        # market price as of a later trade takes the earlier trades on that same block for that asset into account
+        for t in reversed(trades):
+            for asset in (t['base_asset'], t['quote_asset']):
+                if asset in assets_in_block: continue
+                assets_in_block.add(asset)
+                supply = self.get_supply(asset, block_index)
+                if supply is None: continue
+                (price_summary_in_xlt, price_summary_in_ltc, price_in_xlt, price_in_ltc, aggregated_price_in_xlt, aggregated_price_in_ltc
+                ) = get_xlt_ltc_price_info(asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price, with_last_trades=0, end_dt=block_time)
+                market_cap_in_xlt, market_cap_in_ltc = calc_market_cap({'total_issued_normalized': supply}, price_in_xlt, price_in_ltc)
+                if self._generation != generation: #(reset while we were querying)
+                    return None
+                
+                for market_cap_as, market_cap in ((config.XLT, market_cap_in_xlt), (config.LTC, market_cap_in_ltc)):
+                    #add a new history point only if the market cap differs from the asset's last one
+                    if market_cap and last_market_caps.get((asset, market_cap_as), None) != market_cap:
+                        market_cap_history.append({
+                            'block_index': block_index,
+                            'block_time': block_time,
+                            'asset': asset,
+                            'market_cap': market_cap,
+                            'market_cap_as': market_cap_as,
+                        })
+                        last_market_caps[(asset, market_cap_as)] = market_cap
+                        logging.info("Block %i -- Calculated market cap history point for %s as %s (mID: %s)" % (block_index, asset, market_cap_as, t['message_index']))
+        return market_cap_history
+
+market_cap_calculator = MarketCapCalculator()
+
 def compile_asset_market_info():
     """Run through all assets and compose and store market ranking information."""
     mongo_db = config.mongo_db
@@ -537,48 +593,7 @@ def compile_asset_market_info():
         return True
 
     mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price = get_price_primatives()
-    all_traded_assets = list(set(list([config.LTC, config.XLT]) + list(mongo_db.trades.find({}, {'quote_asset': 1, '_id': 0}).distinct('quote_asset'))))
-    
-    #######################
-    #get a list of all assets with a trade within the last 24h (not necessarily just against XLT and LTC)
-    # ^ this is important because compiled market info has a 24h vol parameter that designates total volume for the asset across ALL pairings
-    start_dt_1d = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-    
-    assets = list(set(
-          list(mongo_db.trades.find({'block_time': {'$gte': start_dt_1d}}).distinct('quote_asset'))
-        + list(mongo_db.trades.find({'block_time': {'$gte': start_dt_1d}}).distinct('base_asset'))
-    ))
-    for asset in assets:
-        market_info_24h = compile_24h_market_info(asset)
-        mongo_db.asset_market_info.update({'asset': asset}, {"$set": market_info_24h})
-    #for all others (i.e. no trade in the last 24 hours), zero out the 24h trade data
-    non_traded_assets = list(set(all_traded_assets) - set(assets))
-    mongo_db.asset_market_info.update( {'asset': {'$in': non_traded_assets}}, {"$set": {
-            '24h_summary': {'vol': 0, 'count': 0},
-            '24h_ohlc_in_{}'.format(config.XLT.lower()): {},
-            '24h_ohlc_in_{}'.format(config.LTC.lower()): {},
-            '24h_vol_price_change_in_{}'.format(config.XLT.lower()): None,
-            '24h_vol_price_change_in_{}'.format(config.LTC.lower()): None,
-    }}, multi=True)
-    logging.info("Block: %s -- Calculated 24h stats for: %s" % (current_block_index, ', '.join(assets)))
     
-    #######################
-    #get a list of all assets with a trade within the last 7d up against XLT and LTC
-    start_dt_7d = datetime.datetime.utcnow() - datetime.timedelta(days=7)
-    assets = list(set(
-          list(mongo_db.trades.find({'block_time': {'$gte': start_dt_7d}, 'base_asset': {'$in': [config.XLT, config.LTC]}}).distinct('quote_asset'))
-        + list(mongo_db.trades.find({'block_time': {'$gte': start_dt_7d}}).distinct('base_asset'))
-    ))
-    for asset in assets:
-        market_info_7d = compile_7d_market_info(asset)
-        mongo_db.asset_market_info.update({'asset': asset}, {"$set": market_info_7d})
-    non_traded_assets = list(set(all_traded_assets) - set(assets))
-    mongo_db.asset_market_info.update( {'asset': {'$in': non_traded_assets}}, {"$set": {
-            '7d_history_in_{}'.format(config.XLT.lower()): [],
-            '7d_history_in_{}'.format(config.LTC.lower()): [],
-    }}, multi=True)
-    logging.info("Block: %s -- Calculated 7d stats for: %s" % (current_block_index, ', '.join(assets)))
-
     #######################
     #update summary market data for assets traded since last_block_assets_compiled
     #get assets that were traded since the last check with either LTC or XLT, and update their market summary data
@@ -591,68 +606,21 @@ def compile_asset_market_info():
         logging.info("Block: %s -- Updating asset market info for %s ..." % (current_block_index, asset))
         summary_info = compile_summary_market_info(asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price)
         mongo_db.asset_market_info.update( {'asset': asset}, {"$set": summary_info}, upsert=True)
+    #(24h and 7d stats are kept current by update_market_window_info, but it only updates existing records)
+    update_market_window_info(assets)
 
     
     #######################
-    #next, compile market cap historicals (and get the market price data that we can use to update assets with new trades)
-    #NOTE: this algoritm still needs to be fleshed out some...I'm not convinced it's laid out/optimized like it should be
-    #start by getting all trades from when we last compiled this data
-    trades = mongo_db.trades.find({'block_index': {'$gt': last_block_assets_compiled}}).sort('block_index', pymongo.ASCENDING)
-    trades_by_block = [] #tracks assets compiled per block, as we only want to analyze any given asset once per block
-    trades_by_block_mapping = {} 
-    #organize trades by block
-    for t in trades:
-        if t['block_index'] in trades_by_block_mapping:
-            assert trades_by_block_mapping[t['block_index']]['block_index'] == t['block_index']
-            assert trades_by_block_mapping[t['block_index']]['block_time'] == t['block_time']
-            trades_by_block_mapping[t['block_index']]['trades'].append(t)
-        else:
-            e = {'block_index': t['block_index'], 'block_time': t['block_time'], 'trades': [t,]}
-            trades_by_block.append(e)
-            trades_by_block_mapping[t['block_index']] = e  
-
-    for t_block in trades_by_block:
-        #reverse the tradelist per block, and ensure that we only process an asset that hasn't already been processed for this block
-        # (as there could be multiple trades in a single block for any specific asset). we reverse the list because
-        # we'd rather process a later trade for a given asset, as the market price for that will take into account
-        # the earlier trades on that same block for that asset, and we don't want/need multiple cap points per block
-        assets_in_block = {}
-        mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price = get_price_primatives(end_dt=t_block['block_time'])
-        for t in reversed(t_block['trades']):
-            assets = []
-            if t['base_asset'] not in assets_in_block:
-                assets.append(t['base_asset'])
-                assets_in_block[t['base_asset']] = True
-            if t['quote_asset'] not in assets_in_block:
-                assets.append(t['quote_asset'])
-                assets_in_block[t['quote_asset']] = True
-            if not len(assets): continue
-    
-            for asset in assets:
-                #recalculate the market cap for the asset this trade is for
-                asset_info = get_asset_info(asset, at_dt=t['block_time'])
-                (price_summary_in_xlt, price_summary_in_ltc, price_in_xlt, price_in_ltc, aggregated_price_in_xlt, aggregated_price_in_ltc
-                ) = get_xlt_ltc_price_info(asset, mps_xlt_ltc, xlt_ltc_price, ltc_xlt_price, with_last_trades=0, end_dt=t['block_time'])
-                market_cap_in_xlt, market_cap_in_ltc = calc_market_cap(asset_info, price_in_xlt, price_in_ltc)
-                #^ this will get price data from the block time of this trade back the standard number of days and trades
-                # to determine our standard market price, relative (anchored) to the time of this trade
-        
-                for market_cap_as in (config.XLT, config.LTC):
-                    market_cap = market_cap_in_xlt if market_cap_as == config.XLT else market_cap_in_ltc
-                    #if there is a previously stored market cap for this asset, add a new history point only if the two caps differ
-                    prev_market_cap_history = mongo_db.asset_marketcap_history.find({'market_cap_as': market_cap_as, 'asset': asset,
-                        'block_index': {'$lt': t['block_index']}}).sort('block_index', pymongo.DESCENDING).limit(1)
-                    prev_market_cap_history = list(prev_market_cap_history)[0] if prev_market_cap_history.count() == 1 else None
-                    
-                    if market_cap and (not prev_market_cap_history or prev_market_cap_history['market_cap'] != market_cap):
-                        mongo_db.asset_marketcap_history.insert({
-                            'block_index': t['block_index'],
-                            'block_time': t['block_time'],
-                            'asset': asset,
-                            'market_cap': market_cap,
-                            'market_cap_as': market_cap_as,
-                        })
-                        logging.info("Block %i -- Calculated market cap history point for %s as %s (mID: %s)" % (t['block_index'], asset, market_cap_as, t['message_index']))
+    #next, compile market cap historicals for the trades made since we last compiled this data
+    trades = mongo_db.trades.find({'block_index': {'$gt': last_block_assets_compiled}}).sort(
+        [('block_index', pymongo.ASCENDING), ('message_index', pymongo.ASCENDING)])
+    for block_index, block_trades in itertools.groupby(trades, key=lambda t: t['block_index']):
+        market_cap_history = market_cap_calculator.compile_block(list(block_trades))
+        if market_cap_history is None:
+            logging.warn("Blocks were rolled back while compiling market cap history. Will pick up again on the next run.")
+            return False
+        if market_cap_history:
+            mongo_db.asset_marketcap_history.insert(market_cap_history)
     
     mongo_db.app_config.update({}, {'$set': {'last_block_assets_compiled': current_block_index}})
     return True
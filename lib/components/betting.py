@@ -150,11 +150,7 @@ def get_feed_counters(feed_address):
     sql  = 'SELECT COUNT(*) AS bet_count, SUM(wager_quantity) AS wager_quantity, SUM(wager_remaining) AS wager_remaining, status FROM bets '
     sql += 'WHERE feed_address=? GROUP BY status ORDER BY status DESC'
     bindings = [feed_address] 
-    params = {
-        'query': sql,
-        'bindings': bindings
-    }       
-    counters['bets'] = util.call_jsonrpc_api('sql', params)['result']
+    counters['bets'] = util.call_sql(sql, bindings)
     return counters;
 
 def find_feed(db, url_or_address):
@@ -233,11 +229,7 @@ def find_bets(bet_type, feed_address, deadline, target_value=None, leverage=5040
         bindings.append(target_value)
     sql += 'ORDER BY ((counterwager_quantity+0.0)/(wager_quantity+0.0)) ASC LIMIT ?';
     bindings.append(limit)
-    params = {
-        'query': sql,
-        'bindings': bindings
-    }   
-    return util.call_jsonrpc_api('sql', params)['result']
+    return util.call_sql(sql, bindings)
 
 def get_feeds_by_source(db, addresses):
     conditions = { 'source': { '$in': addresses }}
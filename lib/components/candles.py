@@ -0,0 +1,139 @@
+"""
+Pre-aggregated OHLCV candles for each market, at a few fixed resolutions, kept in the trade_candles collection.
+blockfeed updates them as it books each trade, so that price history queries read a candle per interval instead of
+aggregating over the raw trades.
+"""
+import datetime
+import logging
+
+import pymongo
+
+CANDLE_INTERVALS = {
+    '1m': datetime.timedelta(minutes=1),
+    '1h': datetime.timedelta(hours=1),
+    '1d': datetime.timedelta(days=1),
+}
+
+def get_interval_time(dt, interval):
+    """returns the start time of the candle of the given interval the given datetime falls in"""
+    if interval == '1m':
+        return dt.replace(second=0, microsecond=0)
+    elif interval == '1h':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    elif interval == '1d':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError("Unknown candle interval: %s" % interval)
+
+def _new_candle(base_asset, quote_asset, interval, interval_time):
+    return {
+        'base_asset': base_asset,
+        'quote_asset': quote_asset,
+        'interval': interval,
+        'interval_time': interval_time,
+        'open': None,
+        'high': None,
+        'low': None,
+        'close': None,
+        'vol': 0, #in the base asset (normalized)
+        'count': 0, #number of trades
+        'price_sum': 0, #sum of the trades' unit prices (to derive the average price)
+        'last_block_index': None, #block of the last trade in the candle (for rolling back)
+    }
+
+def _add_trade(candle, trade):
+    """adds a trade to a candle. trades must be added in the order they were booked"""
+    if candle['open'] is None:
+        candle['open'] = candle['high'] = candle['low'] = trade['unit_price']
+    candle['high'] = max(candle['high'], trade['unit_price'])
+    candle['low'] = min(candle['low'], trade['unit_price'])
+    candle['close'] = trade['unit_price']
+    candle['vol'] += trade['base_quantity_normalized']
+    candle['count'] += 1
+    candle['price_sum'] += trade['unit_price']
+    candle['last_block_index'] = trade['block_index']
+
+def _build_candle(mongo_db, base_asset, quote_asset, interval, interval_time, start_dt=None):
+    """builds the candle for the given interval off of the trades collection, only counting the trades from start_dt on
+    (if given). Returns None if there are no such trades"""
+    trades = mongo_db.trades.find({
+        'base_asset': base_asset,
+        'quote_asset': quote_asset,
+        'block_time': {
+            '$gte': start_dt or interval_time,
+            '$lt': interval_time + CANDLE_INTERVALS[interval]}
+    }).sort([('block_index', pymongo.ASCENDING), ('message_index', pymongo.ASCENDING)])
+    candle = _new_candle(base_asset, quote_asset, interval, interval_time)
+    for trade in trades:
+        _add_trade(candle, trade)
+    return candle if candle['count'] else None
+
+class CandleBuffer(object):
+    """Collects the candle updates for the trades booked in the block being processed, until they're written out with
+    flush() (once the block's trades themselves have been written)"""
+    def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        self._candles = {} #(base_asset, quote_asset, interval, interval_time) -> candle of this block's trades
+
+    def add_trade(self, trade):
+        for interval in CANDLE_INTERVALS:
+            key = (trade['base_asset'], trade['quote_asset'], interval, get_interval_time(trade['block_time'], interval))
+            if key not in self._candles:
+                self._candles[key] = _new_candle(*key)
+            _add_trade(self._candles[key], trade)
+
+    def flush(self):
+        if not self._candles:
+            return
+        bulk = self.mongo_db.trade_candles.initialize_unordered_bulk_op()
+        for (base_asset, quote_asset, interval, interval_time), block_candle in self._candles.iteritems():
+            #(merge this block's trades into the stored candle, creating it if this is the first trade in the interval)
+            bulk.find({'base_asset': base_asset, 'quote_asset': quote_asset,
+                'interval': interval, 'interval_time': interval_time}).upsert().update({
+                    '$setOnInsert': {'open': block_candle['open']},
+                    '$max': {'high': block_candle['high']},
+                    '$min': {'low': block_candle['low']},
+                    '$set': {'close': block_candle['close'], 'last_block_index': block_candle['last_block_index']},
+                    '$inc': {'vol': block_candle['vol'], 'count': block_candle['count'],
+                        'price_sum': block_candle['price_sum']},
+                })
+        bulk.execute()
+        self.discard()
+
+    def discard(self):
+        self._candles.clear()
+
+def rebuild_candles(mongo_db, max_block_index):
+    """rebuilds the candles with trades from blocks above max_block_index off of the trades collection. Call on a
+    prune/reorg, after the trades above max_block_index have been removed"""
+    stale_candles = list(mongo_db.trade_candles.find({'last_block_index': {'$gt': max_block_index}}))
+    for candle in stale_candles:
+        mongo_db.trade_candles.remove({'_id': candle['_id']})
+        new_candle = _build_candle(mongo_db, candle['base_asset'], candle['quote_asset'], candle['interval'],
+            candle['interval_time'])
+        if new_candle:
+            mongo_db.trade_candles.insert(new_candle)
+    if stale_candles:
+        logging.info("Rebuilt %i trade candles for blocks after %i" % (len(stale_candles), max_block_index))
+
+def get_candles(mongo_db, base_asset, quote_asset, interval, start_dt, end_dt=None):
+    """returns the candles of the given interval for a market, from start_dt to end_dt (or the latest), oldest first.
+    If start_dt falls within an interval, the first candle only covers the trades from start_dt on (and has start_dt as
+    its interval_time), so that the history doesn't start before the requested time"""
+    first_interval_time = get_interval_time(start_dt, interval)
+    interval_time_filter = {'$gte': first_interval_time}
+    if end_dt:
+        interval_time_filter['$lte'] = end_dt
+    result = list(mongo_db.trade_candles.find({
+        'base_asset': base_asset,
+        'quote_asset': quote_asset,
+        'interval': interval,
+        'interval_time': interval_time_filter,
+    }).sort('interval_time', pymongo.ASCENDING))
+    if start_dt != first_interval_time and result and result[0]['interval_time'] == first_interval_time:
+        first_candle = _build_candle(mongo_db, base_asset, quote_asset, interval, first_interval_time, start_dt=start_dt)
+        if first_candle:
+            first_candle['interval_time'] = start_dt
+            result[0] = first_candle
+        else:
+            result.pop(0)
+    return result
@@ -4,6 +4,10 @@ import decimal
 import base64
 import json
 import time
+import calendar
+
+import pymongo
+from bson.son import SON
 
 from lib import config, util
 
@@ -32,23 +36,131 @@ def calculate_price(base_quantity, quote_quantity, base_divisibility, quote_divi
         decimal.setcontext(decimal.Context(prec=8, rounding=decimal.ROUND_HALF_EVEN))
         return '0'
 
+def get_order_match_pair(asset1, asset2):
+    """returns the 'pair' key order matches between the two assets are mirrored under (in the order_matches collection)"""
+    return "%s/%s" % (min(asset1, asset2), max(asset1, asset2))
+
+def order_match_to_row(order_match):
+    """turns a mirrored order match into the form of a litetokensd order_matches row joined with its block_time"""
+    row = dict(order_match)
+    row['block_time'] = calendar.timegm(order_match['block_time'].utctimetuple())
+    return row
+
+class OrderBookIndex(object):
+    """In-memory index of the open orders on litetokensd, by asset pair, kept up to date from the orders messages
+    blockfeed processes (order matches, cancels and expirations all show up as updates to the orders involved).
+
+    It is (re)loaded from litetokensd once blockfeed is caught up, and thrown away on any prune/reorg. Until it is
+    loaded, get_orders() returns None and callers should go to litetokensd instead. Results computed off of a pair's
+    orders can be memoized with get_snapshot(), until the next change to that pair's orders"""
+    MAX_SNAPSHOTS_PER_PAIR = 16
+
+    def __init__(self):
+        self.loaded = False
+        self._orders = {} #tx_hash -> order
+        self._pairs = {} #(asset, asset) (sorted) -> {tx_hash: order}
+        self._snapshots = {} #(asset, asset) (sorted) -> {key: snapshot}
+
+    def _get_pair(self, asset1, asset2):
+        return (asset1, asset2) if asset1 < asset2 else (asset2, asset1)
+
+    def _add(self, order):
+        pair = self._get_pair(order['give_asset'], order['get_asset'])
+        self._orders[order['tx_hash']] = order
+        self._pairs.setdefault(pair, {})[order['tx_hash']] = order
+        self._snapshots.pop(pair, None)
+
+    def _remove(self, tx_hash):
+        order = self._orders.pop(tx_hash)
+        pair = self._get_pair(order['give_asset'], order['get_asset'])
+        del self._pairs[pair][tx_hash]
+        if not self._pairs[pair]:
+            del self._pairs[pair]
+        self._snapshots.pop(pair, None)
+
+    def load(self):
+        self.reset()
+        try:
+            orders = util.call_sql("SELECT * FROM orders WHERE status = ?", ['open'], abort_on_error=True)
+        except Exception, e:
+            logging.warn("Could not load open orders for the order book index: %s" % e)
+            return
+        for order in orders:
+            self._add(order)
+        self.loaded = True
+        logging.info("Loaded order book index (%i open orders)" % len(self._orders))
+
+    def reset(self):
+        self.loaded = False
+        self._orders.clear()
+        self._pairs.clear()
+        self._snapshots.clear()
+
+    def apply_message(self, msg, msg_data):
+        """updates the index from an orders message (other messages are ignored)"""
+        if not self.loaded or msg['category'] != 'orders':
+            return
+        if msg['command'] == 'insert':
+            if msg_data['status'] == 'open':
+                self._add(dict(msg_data))
+        elif msg['command'] == 'update' and msg_data['tx_hash'] in self._orders:
+            order = dict(self._orders[msg_data['tx_hash']], **msg_data)
+            self._remove(msg_data['tx_hash'])
+            if order['status'] == 'open':
+                self._add(order)
+
+    def get_orders(self, asset1, asset2):
+        """returns (copies of) the open orders between the two assets, oldest first, or None if not loaded"""
+        if not self.loaded:
+            return None
+        orders = self._pairs.get(self._get_pair(asset1, asset2), {}).itervalues()
+        return sorted([dict(o) for o in orders if o['expire_index'] >= config.CURRENT_BLOCK_INDEX],
+            key=lambda o: o['tx_index'])
+
+    def get_pair_order_counts(self, addresses):
+        """returns a dict of 'asset/asset' pair (with the assets sorted) -> number of open orders the given addresses
+        have placed on that pair"""
+        counts = {}
+        for order in self._orders.itervalues():
+            if order['source'] in addresses and order['give_asset'] != order['get_asset']:
+                pair = "%s/%s" % self._get_pair(order['give_asset'], order['get_asset'])
+                counts[pair] = counts.get(pair, 0) + 1
+        return counts
+
+    def get_snapshot(self, asset1, asset2, key, compute_func):
+        """returns compute_func(), memoized under key until the orders between the two assets change"""
+        snapshots = self._snapshots.setdefault(self._get_pair(asset1, asset2), {})
+        key = (config.CURRENT_BLOCK_INDEX, key) #(as get_orders() filters on it)
+        if key not in snapshots:
+            if len(snapshots) >= self.MAX_SNAPSHOTS_PER_PAIR:
+                snapshots.clear()
+            snapshots[key] = compute_func()
+        return snapshots[key]
+
+order_book_index = OrderBookIndex()
+
 def get_pairs_with_orders(addresses=[], max_pairs=12):
 
     pairs_with_orders = []
 
-    sources = '''AND source IN ({})'''.format(','.join(['?' for e in range(0,len(addresses))]))
+    if order_book_index.loaded:
+        pair_order_counts = order_book_index.get_pair_order_counts(addresses)
+        my_pairs = sorted([{'pair': pair, 'order_count': count} for pair, count in pair_order_counts.iteritems()],
+            key=lambda p: p['order_count'], reverse=True)[:max_pairs]
+    else: #order book index not loaded (yet)
+        sources = '''AND source IN ({})'''.format(','.join(['?' for e in range(0,len(addresses))]))
+            
+        sql = '''SELECT (MIN(give_asset, get_asset) || '/' || MAX(give_asset, get_asset)) AS pair,
+                        COUNT(*) AS order_count
+                 FROM orders
+                 WHERE give_asset != get_asset AND status = ? {} 
+                 GROUP BY pair 
+                 ORDER BY order_count DESC
+                 LIMIT ?'''.format(sources)
         
-    sql = '''SELECT (MIN(give_asset, get_asset) || '/' || MAX(give_asset, get_asset)) AS pair,
-                    COUNT(*) AS order_count
-             FROM orders
-             WHERE give_asset != get_asset AND status = ? {} 
-             GROUP BY pair 
-             ORDER BY order_count DESC
-             LIMIT ?'''.format(sources)
-    
-    bindings = ['open'] + addresses + [max_pairs]
+        bindings = ['open'] + addresses + [max_pairs]
 
-    my_pairs = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
+        my_pairs = util.call_sql(sql, bindings)
 
     for my_pair in my_pairs:
         base_asset, quote_asset = util.assets_to_asset_pair(*tuple(my_pair['pair'].split("/")))
@@ -66,38 +178,8 @@ def get_pairs_with_orders(addresses=[], max_pairs=12):
 
 
 def get_pairs(quote_asset='XLT', exclude_pairs=[], max_pairs=12, from_time=None):
-            
-    bindings = []
-    
-    sql = '''SELECT (CASE
-                        WHEN forward_asset = ? THEN backward_asset
-                        ELSE forward_asset
-                    END) AS base_asset,
-                    (CASE
-                        WHEN backward_asset = ? THEN backward_asset
-                        ELSE forward_asset
-                    END) AS quote_asset,
-                    (CASE
-                        WHEN backward_asset = ? THEN (forward_asset || '/' || backward_asset)
-                        ELSE (backward_asset || '/' || forward_asset)
-                    END) AS pair,
-                    (CASE
-                        WHEN forward_asset = ? THEN backward_quantity
-                        ELSE forward_quantity
-                    END) AS bq,
-                    (CASE
-                        WHEN backward_asset = ? THEN backward_quantity
-                        ELSE forward_quantity
-                    END) AS qq '''
-    if from_time:
-        sql += ''', block_time '''
-
-    sql += '''FROM order_matches '''
-    bindings += [quote_asset, quote_asset, quote_asset, quote_asset, quote_asset]
-
-    if from_time:
-        sql += '''INNER JOIN blocks ON order_matches.block_index = blocks.block_index '''
 
+    #pairs are only listed under the highest priority quote asset they have (see config.QUOTE_ASSETS)
     priority_quote_assets = []
     for priority_quote_asset in config.QUOTE_ASSETS:
         if priority_quote_asset != quote_asset:
@@ -105,35 +187,49 @@ def get_pairs(quote_asset='XLT', exclude_pairs=[], max_pairs=12, from_time=None)
         else:
             break
 
-    if len(priority_quote_assets) > 0:
-        asset_bindings = ','.join(['?' for e in range(0,len(priority_quote_assets))])
-        sql += '''WHERE ((forward_asset = ? AND backward_asset NOT IN ({})) 
-                         OR (forward_asset NOT IN ({}) AND backward_asset = ?)) '''.format(asset_bindings, asset_bindings)
-        bindings += [quote_asset] + priority_quote_assets + priority_quote_assets + [quote_asset]
-    else:
-        sql += '''WHERE ((forward_asset = ?) OR (backward_asset = ?)) '''
-        bindings += [quote_asset, quote_asset]
-
-    if len(exclude_pairs) > 0:
-        sql += '''AND pair NOT IN ({}) '''.format(','.join(['?' for e in range(0,len(exclude_pairs))]))
-        bindings += exclude_pairs
-
+    if max_pairs == 0:
+        return []
+
+    exclude_base_assets = [p.split('/')[0] for p in exclude_pairs if p.endswith('/' + quote_asset)]
+    excluded_assets = priority_quote_assets + exclude_base_assets + [quote_asset]
+    conditions = {
+        'status': 'completed',
+        '$or': [
+            {'forward_asset': quote_asset, 'backward_asset': {'$nin': excluded_assets}},
+            {'backward_asset': quote_asset, 'forward_asset': {'$nin': excluded_assets}},
+        ]
+    }
     if from_time:
-        sql += '''AND block_time > ? '''
-        bindings += [from_time]
+        conditions['block_time'] = {'$gt': datetime.utcfromtimestamp(from_time)}
+
+    pipeline = [
+        {"$match": conditions},
+        {"$project": {
+            "base_asset": {"$cond": [{"$eq": ["$forward_asset", quote_asset]}, "$backward_asset", "$forward_asset"]},
+            "bq": {"$cond": [{"$eq": ["$forward_asset", quote_asset]}, "$backward_quantity", "$forward_quantity"]},
+            "qq": {"$cond": [{"$eq": ["$backward_asset", quote_asset]}, "$backward_quantity", "$forward_quantity"]},
+        }},
+        {"$group": {
+            "_id": "$base_asset",
+            "base_quantity": {"$sum": "$bq"},
+            "quote_quantity": {"$sum": "$qq"},
+        }},
+        {"$sort": SON([("quote_quantity", pymongo.DESCENDING)])},
+    ]
+    if max_pairs > 0: #(a negative max_pairs means no limit, as with the SQL LIMIT this used to be)
+        pipeline.append({"$limit": max_pairs})
+    result = config.mongo_db.order_matches.aggregate(pipeline)
 
-    sql += '''AND forward_asset != backward_asset
-              AND status = ?'''
-
-    bindings += ['completed', max_pairs]
-
-    sql = '''SELECT base_asset, quote_asset, pair, SUM(bq) AS base_quantity, SUM(qq) AS quote_quantity 
-             FROM ({}) 
-             GROUP BY pair 
-             ORDER BY quote_quantity DESC
-             LIMIT ?'''.format(sql)
-
-    return util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
+    pairs = []
+    for p in (result['result'] if result['ok'] else []):
+        pairs.append({
+            'base_asset': p['_id'],
+            'quote_asset': quote_asset,
+            'pair': p['_id'] + '/' + quote_asset,
+            'base_quantity': p['base_quantity'],
+            'quote_quantity': p['quote_quantity'],
+        })
+    return pairs
 
 
 def get_quotation_pairs(exclude_pairs=[], max_pairs=12, from_time=None, include_currencies=[]):
@@ -227,22 +323,30 @@ def get_market_orders(asset1, asset2, addresses=[], supplies=None, min_fee_provi
     buy_orders = []
     sell_orders = []
 
-    sql = '''SELECT orders.*, blocks.block_time FROM orders INNER JOIN blocks ON orders.block_index=blocks.block_index 
-             WHERE  status = ? '''
-    bindings = ['open']
+    orders = order_book_index.get_orders(asset1, asset2)
+    if orders is not None:
+        orders = [o for o in reversed(orders) if o['give_remaining'] > 0 and (len(addresses) == 0 or o['source'] in addresses)]
+        if len(addresses) > 0:
+            for order in orders:
+                block_time = util.get_block_time(order['block_index'])
+                order['block_time'] = calendar.timegm(block_time.utctimetuple()) if block_time else None
+    else: #order book index not loaded (yet)
+        sql = '''SELECT orders.*, blocks.block_time FROM orders INNER JOIN blocks ON orders.block_index=blocks.block_index 
+                 WHERE  status = ? '''
+        bindings = ['open']
 
-    if len(addresses) > 0:
-        sql += '''AND source IN ({}) '''.format(','.join(['?' for e in range(0,len(addresses))]))
-        bindings += addresses
+        if len(addresses) > 0:
+            sql += '''AND source IN ({}) '''.format(','.join(['?' for e in range(0,len(addresses))]))
+            bindings += addresses
 
-    sql += '''AND give_remaining > 0 
-              AND give_asset IN (?, ?) 
-              AND get_asset IN (?, ?) 
-              ORDER BY tx_index DESC'''
+        sql += '''AND give_remaining > 0 
+                  AND give_asset IN (?, ?) 
+                  AND get_asset IN (?, ?) 
+                  ORDER BY tx_index DESC'''
 
-    bindings +=  [asset1, asset2, asset1, asset2]
+        bindings +=  [asset1, asset2, asset1, asset2]
 
-    orders = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
+        orders = util.call_sql(sql, bindings)
 
     for order in orders:
         market_order = {}
@@ -321,23 +425,11 @@ def get_market_trades(asset1, asset2, addresses=[], limit=50, supplies=None):
         supplies = get_assets_supply([asset1, asset2])
     market_trades = []
 
-    sources = ''
-    bindings = ['expired']
+    conditions = {'pair': get_order_match_pair(asset1, asset2), 'status': {'$ne': 'expired'}}
     if len(addresses) > 0:
-        placeholder = ','.join(['?' for e in range(0,len(addresses))])
-        sources = '''AND (tx0_address IN ({}) OR tx1_address IN ({}))'''.format(placeholder, placeholder)
-        bindings += addresses + addresses
-
-    sql = '''SELECT order_matches.*, blocks.block_time FROM order_matches INNER JOIN blocks ON order_matches.block_index=blocks.block_index
-             WHERE status != ? {}
-                AND forward_asset IN (?, ?) 
-                AND backward_asset IN (?, ?) 
-             ORDER BY block_index DESC
-             LIMIT ?'''.format(sources)
-
-    bindings +=  [asset1, asset2, asset1, asset2, limit]
-
-    order_matches = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
+        conditions['$or'] = [{'tx0_address': {'$in': addresses}}, {'tx1_address': {'$in': addresses}}]
+    order_matches = [order_match_to_row(o) for o in
+        config.mongo_db.order_matches.find(conditions).sort('tx_index', pymongo.DESCENDING).limit(limit)]
 
     for order_match in order_matches:
 
@@ -396,17 +488,10 @@ def get_assets_supply(assets=[]):
         supplies['LTC'] = (0, True)
         assets.remove('LTC')
 
-    if len(assets) > 0:
-        sql = '''SELECT asset, SUM(quantity) AS supply, divisible FROM issuances 
-                 WHERE asset IN ({}) 
-                 AND status = ?
-                 GROUP BY asset
-                 ORDER BY asset'''.format(','.join(['?' for e in range(0,len(assets))]))
-        bindings = assets + ['valid']
-
-        issuances = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
-        for issuance in issuances:
-            supplies[issuance['asset']] = (issuance['supply'], issuance['divisible'])
+    for asset in assets:
+        tracked_asset = util.get_tracked_asset(asset) #(total_issued sums the quantities of the asset's valid issuances)
+        if tracked_asset and tracked_asset['total_issued'] is not None:
+            supplies[asset] = (tracked_asset['total_issued'], tracked_asset['divisible'])
 
     return supplies
 
@@ -416,21 +501,10 @@ def get_pair_price(base_asset, quote_asset, max_block_time=None, supplies=None):
     if not supplies:
         supplies = get_assets_supply([base_asset, quote_asset])
 
-    sql = '''SELECT *, MAX(tx0_index, tx1_index) AS tx_index, blocks.block_time 
-             FROM order_matches INNER JOIN blocks ON order_matches.block_index = blocks.block_index
-             WHERE 
-                forward_asset IN (?, ?) AND
-                backward_asset IN (?, ?) '''
-    bindings = [base_asset, quote_asset, base_asset, quote_asset]
-
+    conditions = {'pair': get_order_match_pair(base_asset, quote_asset)}
     if max_block_time:
-        sql += '''AND block_time <= ? '''
-        bindings += [max_block_time]
-
-    sql += '''ORDER BY tx_index DESC
-             LIMIT 2'''
-    
-    order_matches = util.call_jsonrpc_api('sql', {'query': sql, 'bindings': bindings})['result']
+        conditions['block_time'] = {'$lte': datetime.utcfromtimestamp(max_block_time)}
+    order_matches = list(config.mongo_db.order_matches.find(conditions).sort('tx_index', pymongo.DESCENDING).limit(2))
 
     if len(order_matches) == 0:
         last_price = D(0.0)
@@ -18,12 +18,7 @@ def get_open_rps_count(possible_moves = 3, exclude_addresses = []):
         bindings += exclude_addresses
     sql += 'GROUP BY wager ORDER BY tx_index DESC'
     
-    params = {
-        'query': sql,
-        'bindings': bindings
-    }   
-  
-    return util.call_jsonrpc_api('sql', params)['result']
+    return util.call_sql(sql, bindings)
 
 def get_user_rps(addresses):
 
@@ -0,0 +1,163 @@
+"""
+Rolling trade statistics for each market and asset over the last 24 hours and 7 days. blockfeed adds trades as it books
+them, and they're expired as they age out of each window (see assets_trading.update_market_window_info), so that the
+figures in asset_market_info can be kept current without aggregating over the trades collection.
+"""
+import datetime
+import logging
+import collections
+
+import pymongo
+
+from lib import config, util
+
+WINDOWS = {
+    '24h': datetime.timedelta(days=1),
+    '7d': datetime.timedelta(days=7),
+}
+TRADE_FIELDS = ('block_index', 'block_time', 'base_asset', 'quote_asset', 'unit_price',
+    'base_quantity_normalized', 'quote_quantity_normalized')
+
+class _PairWindow(object):
+    """The trades in a window for a single market, oldest first. The high and low are tracked with monotonic queues,
+    so that expiring a trade doesn't require a scan over the rest"""
+    def __init__(self):
+        self.trades = collections.deque()
+        self.vol_base = 0
+        self.vol_quote = 0
+        self._highs = collections.deque() #trades that are (or may become) the high, with decreasing unit prices
+        self._lows = collections.deque() #trades that are (or may become) the low, with increasing unit prices
+
+    def append(self, trade):
+        self.trades.append(trade)
+        self.vol_base += trade['base_quantity_normalized']
+        self.vol_quote += trade['quote_quantity_normalized']
+        while self._highs and self._highs[-1]['unit_price'] <= trade['unit_price']:
+            self._highs.pop()
+        self._highs.append(trade)
+        while self._lows and self._lows[-1]['unit_price'] >= trade['unit_price']:
+            self._lows.pop()
+        self._lows.append(trade)
+
+    def popleft(self):
+        trade = self.trades.popleft()
+        if self.trades:
+            self.vol_base -= trade['base_quantity_normalized']
+            self.vol_quote -= trade['quote_quantity_normalized']
+        else: #(don't let float error accumulate)
+            self.vol_base = self.vol_quote = 0
+        if self._highs[0] is trade:
+            self._highs.popleft()
+        if self._lows[0] is trade:
+            self._lows.popleft()
+        return trade
+
+    def get_ohlc(self):
+        if not self.trades:
+            return {}
+        return {
+            'open': self.trades[0]['unit_price'],
+            'high': self._highs[0]['unit_price'],
+            'low': self._lows[0]['unit_price'],
+            'close': self.trades[-1]['unit_price'],
+            'vol': float(self.vol_base),
+            'count': len(self.trades),
+        }
+
+class TradeWindow(object):
+    """The trades booked within the given duration of now, with per market OHLC and per asset volume totals"""
+    def __init__(self, duration):
+        self.duration = duration
+        self.trades = collections.deque() #in the order they were booked
+        self.pairs = {} #(base_asset, quote_asset) -> _PairWindow
+        self.asset_totals = {} #asset -> {'vol': ..., 'count': ...}, across all of its markets (vol is in the asset itself)
+        self.dirty_assets = set() #assets whose stats have changed since the last pop_dirty_assets()
+
+    def _update_asset_totals(self, asset, quantity, count):
+        totals = self.asset_totals.setdefault(asset, {'vol': 0, 'count': 0})
+        totals['count'] += count
+        totals['vol'] += quantity
+        if not totals['count']:
+            del self.asset_totals[asset]
+        self.dirty_assets.add(asset)
+
+    def add_trade(self, trade):
+        if trade['block_time'] < datetime.datetime.utcnow() - self.duration:
+            return
+        self.trades.append(trade)
+        self.pairs.setdefault((trade['base_asset'], trade['quote_asset']), _PairWindow()).append(trade)
+        self._update_asset_totals(trade['base_asset'], trade['base_quantity_normalized'], 1)
+        self._update_asset_totals(trade['quote_asset'], trade['quote_quantity_normalized'], 1)
+
+    def expire(self, now=None):
+        """removes the trades that have aged out of the window. Note that block times aren't strictly increasing, so a
+        trade may stay in the window a little longer, until the trades booked before it have also expired"""
+        cutoff = (now or datetime.datetime.utcnow()) - self.duration
+        num_expired = 0
+        while self.trades and self.trades[0]['block_time'] < cutoff:
+            trade = self.trades.popleft()
+            pair = (trade['base_asset'], trade['quote_asset'])
+            self.pairs[pair].popleft()
+            if not self.pairs[pair].trades:
+                del self.pairs[pair]
+            self._update_asset_totals(trade['base_asset'], -trade['base_quantity_normalized'], -1)
+            self._update_asset_totals(trade['quote_asset'], -trade['quote_quantity_normalized'], -1)
+            num_expired += 1
+        return num_expired
+
+    def get_pair_ohlc(self, base_asset, quote_asset):
+        pair_window = self.pairs.get((base_asset, quote_asset), None)
+        return pair_window.get_ohlc() if pair_window else {}
+
+    def get_asset_totals(self, asset):
+        totals = self.asset_totals.get(asset, None)
+        return {'vol': float(totals['vol']), 'count': totals['count']} if totals else {'vol': 0, 'count': 0}
+
+    def get_assets(self):
+        return self.asset_totals.keys()
+
+    def pop_dirty_assets(self):
+        dirty_assets = self.dirty_assets
+        self.dirty_assets = set()
+        return dirty_assets
+
+class RollingTradeStats(object):
+    """The 24h and 7d trade windows. These are loaded off of the trades collection once we're caught up, and reset on
+    a reorg (to be reloaded)"""
+    def __init__(self):
+        self.windows = dict((name, TradeWindow(duration)) for name, duration in WINDOWS.iteritems())
+        self.loaded = False
+
+    def load(self):
+        self.reset()
+        start_dt = datetime.datetime.utcnow() - max(WINDOWS.values())
+        #(query by block index, which trades is indexed on. add_trade() drops any trades that are too old)
+        start_block_index, end_block_index = util.get_block_indexes_for_dates(start_dt=start_dt)
+        trades = config.mongo_db.trades.find({'block_index': {'$gte': start_block_index}}, fields=list(TRADE_FIELDS)
+            ).sort([('block_index', pymongo.ASCENDING), ('message_index', pymongo.ASCENDING)])
+        num_trades = 0
+        for trade in trades:
+            del trade['_id']
+            for window in self.windows.itervalues():
+                window.add_trade(trade)
+            num_trades += 1
+        self.loaded = True
+        logging.info("Loaded %i trades into the rolling trade windows" % num_trades)
+
+    def reset(self):
+        self.windows = dict((name, TradeWindow(duration)) for name, duration in WINDOWS.iteritems())
+        self.loaded = False
+
+    def add_trade(self, trade):
+        if not self.loaded:
+            return #(trades booked before we're loaded are picked up from the trades collection by load())
+        trade = dict((field, trade[field]) for field in TRADE_FIELDS)
+        for window in self.windows.itervalues():
+            window.add_trade(trade)
+
+    def expire(self):
+        now = datetime.datetime.utcnow()
+        for window in self.windows.itervalues():
+            window.expire(now)
+
+rolling_trade_stats = RollingTradeStats()
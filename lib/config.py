@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 VERSION = "1.5.0" #should keep up with the litetokenswallet version it works with (for now at least)
 
-DB_VERSION = 22 #a db version increment will cause liteblockd to rebuild its database off of litetokensd 
+DB_VERSION = 25 #a db version increment will cause liteblockd to rebuild its database off of litetokensd 
 
 CAUGHT_UP = False #atomic state variable, set to True when litetokensd AND liteblockd are caught up
 
@@ -9,6 +9,8 @@ UNIT = 100000000
 
 SUBDIR_ASSET_IMAGES = "asset_img" #goes under the data dir and stores retrieved asset images
 SUBDIR_FEED_IMAGES = "feed_img" #goes under the data dir and stores retrieved feed images
+SUBDIR_CHECKPOINTS = "checkpoints" #goes under the data dir and stores database checkpoints (see lib/checkpoint.py)
+SUBDIR_MESSAGE_JOURNAL = "message_journal" #goes under the data dir and stores the litetokensd message journal (see lib/message_journal.py)
 
 MARKET_PRICE_DERIVE_NUM_POINTS = 8 #number of last trades over which to derive the market price (via WVAP)
 
@@ -19,6 +21,7 @@ MULTISIG_DUST_SIZE = 6011
 ORDER_LTC_DUST_LIMIT_CUTOFF = MULTISIG_DUST_SIZE
 
 mongo_db = None #will be set on server init
+litetokensd_db = None #will be set on server init, if direct reads of litetokensd's database are enabled
 
 LTC = 'LTC'
 XLT = 'XLT'
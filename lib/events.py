@@ -19,6 +19,7 @@ from lib.components import assets, assets_trading, betting
 D = decimal.Decimal
 COMPILE_MARKET_PAIR_INFO_PERIOD = 10 * 60 #in seconds (this is every 10 minutes currently)
 COMPILE_ASSET_MARKET_INFO_PERIOD = 30 * 60 #in seconds (this is every 30 minutes currently)
+EXPIRE_MARKET_WINDOWS_PERIOD = 60 #in seconds
 
 def check_blockchain_service():
     try:
@@ -170,9 +171,13 @@ def generate_wallet_stats():
     gevent.spawn_later(30 * 60, generate_wallet_stats)
 
 def compile_asset_pair_market_info():
-    assets_trading.compile_asset_pair_market_info()
-    #all done for this run...call again in a bit                            
-    gevent.spawn_later(COMPILE_MARKET_PAIR_INFO_PERIOD, compile_asset_pair_market_info)
+    try:
+        assets_trading.compile_asset_pair_market_info()
+    except Exception, e:
+        logging.exception(e) #(don't let an error stop the timer)
+    finally:
+        #all done for this run...call again in a bit                            
+        gevent.spawn_later(COMPILE_MARKET_PAIR_INFO_PERIOD, compile_asset_pair_market_info)
 
 def compile_extended_asset_info():
     assets.fetch_all_asset_info(config.mongo_db)
@@ -185,7 +190,20 @@ def compile_extended_feed_info():
     gevent.spawn_later(60 * 5, compile_extended_feed_info)
 
 def compile_asset_market_info():
-    assets_trading.compile_asset_market_info()
-    #all done for this run...call again in a bit                            
-    gevent.spawn_later(COMPILE_ASSET_MARKET_INFO_PERIOD, compile_asset_market_info)
+    try:
+        assets_trading.compile_asset_market_info()
+    except Exception, e:
+        logging.exception(e) #(don't let an error stop the timer)
+    finally:
+        #all done for this run...call again in a bit                            
+        gevent.spawn_later(COMPILE_ASSET_MARKET_INFO_PERIOD, compile_asset_market_info)
+
+def expire_market_windows():
+    #age trades out of the rolling 24h/7d stats, even when no new blocks are coming in
+    try:
+        assets_trading.update_market_window_info()
+    except Exception, e:
+        logging.exception(e)
+    finally:
+        gevent.spawn_later(EXPIRE_MARKET_WINDOWS_PERIOD, expire_market_windows)
     
@@ -0,0 +1,82 @@
+"""
+Read-only, in-process access to litetokensd's sqlite database, for when liteblockd runs on the same host as litetokensd.
+This lets us run the queries we'd otherwise send through litetokensd's sql API call directly, without the HTTP round
+trip and JSON encoding/decoding of the results on both ends (see util.call_sql).
+"""
+import logging
+
+import gevent
+import gevent.queue
+import sqlite3
+
+POOL_SIZE = 4 #max number of open connections to the database
+BUSY_TIMEOUT = 5 #seconds a query will wait on a lock held by litetokensd before failing
+
+def _dict_factory(cursor, row):
+    return dict((col[0], row[i]) for i, col in enumerate(cursor.description))
+
+class LitetokensdDB(object):
+    """A small pool of read-only connections to litetokensd's database. Queries are run on gevent's threadpool, so that
+    a slow query doesn't block the whole process.
+
+    litetokensd keeps its database in WAL mode, so our readers don't block its writer (or vice versa), and each query
+    sees a consistent snapshot of the database. (sqlite's shared cache mode is not used, as it would make our readers
+    share table locks with each other and doesn't mix with WAL's snapshot isolation.)"""
+    def __init__(self, path, pool_size=POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle = gevent.queue.Queue()
+        self._num_connections = 0
+
+    def _connect(self):
+        #python 2.7's sqlite3 can't open a database with mode=ro, so we make the connection read-only with query_only
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        try:
+            db.row_factory = _dict_factory
+            db.execute('PRAGMA query_only = ON')
+            if db.execute('PRAGMA query_only').fetchone()['query_only'] != 1:
+                raise Exception("sqlite library too old to support PRAGMA query_only")
+        except:
+            db.close()
+            raise
+        return db
+
+    def _get_connection(self):
+        if self._idle.empty() and self._num_connections < self.pool_size:
+            self._num_connections += 1
+            try:
+                return gevent.get_hub().threadpool.apply(self._connect)
+            except:
+                self._num_connections -= 1
+                raise
+        return self._idle.get()
+
+    def _execute(self, db, query, bindings):
+        cursor = db.cursor()
+        try:
+            return cursor.execute(query, bindings).fetchall()
+        finally:
+            cursor.close()
+
+    def query(self, query, bindings=None):
+        """runs the given (read only) query, and returns the result rows as a list of dicts (like litetokensd's sql
+        API call does)"""
+        db = self._get_connection()
+        try:
+            result = gevent.get_hub().threadpool.apply(self._execute, (db, query, bindings or []))
+        except sqlite3.Error, e:
+            #don't reuse a connection that may be in a bad state
+            logging.debug("Closing litetokensd DB connection after error: %s" % e)
+            self._num_connections -= 1
+            db.close()
+            raise
+        except:
+            self._idle.put(db)
+            raise
+        self._idle.put(db)
+        return result
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().close()
+            self._num_connections -= 1
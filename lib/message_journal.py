@@ -0,0 +1,168 @@
+"""
+Local append-only journal of the raw blocks and messages blockfeed has received from litetokensd, so that a reparse can
+replay them from disk instead of asking litetokensd for every single message again.
+
+The journal consists of a data file holding one JSON record (block info + messages) per block, and an index file of
+fixed size (block_index, offset, length) entries, one per block, in block order.
+"""
+import os
+import json
+import struct
+import logging
+
+from lib import config
+
+INDEX_ENTRY = struct.Struct("<IQI") #block_index, offset in the data file, length of the record
+SYNC_INTERVAL = 100 #number of blocks appended between fsyncs of the journal files
+
+class MessageJournal(object):
+    def __init__(self):
+        self.first_block_index = None
+        self.last_block_index = None
+        self._versions = None
+        self._data_file = None
+        self._index_file = None
+        self._num_unsynced = 0
+        self._gap_at_block_index = None #block index we last refused to append at (so as to only warn once)
+
+    def _get_path(self, ext):
+        path = os.path.join(config.DATA_DIR, config.SUBDIR_MESSAGE_JOURNAL)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return os.path.join(path, "messages.%s.%s" % ('testnet' if config.TESTNET else 'mainnet', ext))
+
+    def open(self, app_config):
+        """opens the journal (if not already open), wiping it if it was written against a different litetokensd DB
+        version than the one app_config says we are running against"""
+        versions = [app_config['litetokensd_db_version_major'], app_config['litetokensd_db_version_minor'],
+            app_config['litetokensd_running_testnet']]
+        if self._versions == versions:
+            return
+        self.close()
+
+        try:
+            with open(self._get_path('json')) as f:
+                journal_versions = json.load(f)
+        except (IOError, ValueError):
+            journal_versions = None
+        mode = 'r+b'
+        if journal_versions != versions or not os.path.exists(self._get_path('dat')) or not os.path.exists(self._get_path('idx')):
+            logging.warn("Starting new message journal for litetokensd DB version %s.%s ..." % (versions[0], versions[1]))
+            mode = 'w+b'
+            with open(self._get_path('json'), 'w') as f:
+                json.dump(versions, f)
+        self._data_file = open(self._get_path('dat'), mode)
+        self._index_file = open(self._get_path('idx'), mode)
+        self._versions = versions
+
+        #drop any partially written (or, as they may not have been synced to disk, garbled) entries at the end (e.g. if
+        # we died while appending)
+        self._index_file.seek(0, os.SEEK_END)
+        num_entries = self._index_file.tell() // INDEX_ENTRY.size
+        self._data_file.seek(0, os.SEEK_END)
+        data_size = self._data_file.tell()
+        while num_entries and not self._is_valid_entry(num_entries - 1, data_size):
+            num_entries -= 1
+        self._truncate_to_entries(num_entries)
+        if num_entries:
+            logging.info("Message journal covers blocks %i to %i" % (self.first_block_index, self.last_block_index))
+
+    def close(self):
+        if self._data_file:
+            self.sync()
+            self._data_file.close()
+            self._index_file.close()
+        self._data_file = self._index_file = self._versions = None
+        self.first_block_index = self.last_block_index = None
+
+    def _read_index_entry_at(self, pos):
+        self._index_file.seek(pos * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self._index_file.read(INDEX_ENTRY.size))
+
+    def _is_valid_entry(self, pos, data_size):
+        block_index, offset, length = self._read_index_entry_at(pos)
+        if    offset + length > data_size \
+           or (pos and block_index != self._read_index_entry_at(0)[0] + pos):
+            return False
+        self._data_file.seek(offset)
+        try:
+            record = json.loads(self._data_file.read(length))
+        except ValueError:
+            return False
+        return record['block']['block_index'] == block_index
+
+    def sync(self):
+        """makes sure everything appended so far is on disk"""
+        if self._data_file is None or not self._num_unsynced:
+            return
+        for f in (self._data_file, self._index_file): #(data first, so that the index never points past it)
+            f.flush()
+            os.fsync(f.fileno())
+        self._num_unsynced = 0
+
+    def _truncate_to_entries(self, num_entries):
+        if num_entries:
+            block_index, offset, length = self._read_index_entry_at(num_entries - 1)
+            self.first_block_index = self._read_index_entry_at(0)[0]
+            self.last_block_index = block_index
+            data_size = offset + length
+        else:
+            self.first_block_index = self.last_block_index = None
+            data_size = 0
+        self._index_file.truncate(num_entries * INDEX_ENTRY.size)
+        self._data_file.truncate(data_size)
+
+    def has_block(self, block_index):
+        return self.last_block_index is not None and self.first_block_index <= block_index <= self.last_block_index
+
+    def get(self, block_index):
+        """returns a (block, messages) tuple for the given journaled block"""
+        assert self.has_block(block_index)
+        entry_block_index, offset, length = self._read_index_entry_at(block_index - self.first_block_index)
+        assert entry_block_index == block_index
+        self._data_file.seek(offset)
+        record = json.loads(self._data_file.read(length))
+        return record['block'], record['messages']
+
+    def append(self, block, messages):
+        """journals a processed block. A block we already have is ignored if it's the same block (e.g. as we replay
+        the journal), and otherwise replaces it and the rest of the journal after it. A block past the end of the journal
+        (e.g. after a checkpoint restore) is not journaled, as that would leave a gap"""
+        if self._data_file is None:
+            return
+        if self.has_block(block['block_index']):
+            if self.get(block['block_index'])[0]['block_hash'] == block['block_hash']:
+                return
+            self.truncate(block['block_index'] - 1)
+        elif self.first_block_index is not None and block['block_index'] < self.first_block_index:
+            return #(before the start of the journal, which we can't prepend to)
+        elif self.last_block_index is not None and block['block_index'] != self.last_block_index + 1:
+            if self._gap_at_block_index is None or block['block_index'] != self._gap_at_block_index + 1:
+                logging.warn("Not journaling block %i, as the message journal ends at block %i" % (
+                    block['block_index'], self.last_block_index))
+            self._gap_at_block_index = block['block_index']
+            return
+        record = json.dumps({
+            'block': {'block_index': block['block_index'], 'block_hash': block['block_hash'], 'block_time': block['block_time']},
+            'messages': messages,
+        })
+        self._data_file.seek(0, os.SEEK_END)
+        offset = self._data_file.tell()
+        self._data_file.write(record)
+        self._data_file.flush()
+        self._index_file.seek(0, os.SEEK_END)
+        self._index_file.write(INDEX_ENTRY.pack(block['block_index'], offset, len(record)))
+        self._index_file.flush()
+        if self.first_block_index is None:
+            self.first_block_index = block['block_index']
+        self.last_block_index = block['block_index']
+        self._num_unsynced += 1
+        if self._num_unsynced >= SYNC_INTERVAL:
+            self.sync()
+
+    def truncate(self, max_block_index):
+        """drops all journaled blocks above max_block_index (e.g. on a reorg)"""
+        if self.last_block_index is None or max_block_index >= self.last_block_index:
+            return
+        logging.warn("Truncating message journal to block %i ..." % max_block_index)
+        self._truncate_to_entries(max(max_block_index - self.first_block_index + 1, 0))
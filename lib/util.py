@@ -11,14 +11,20 @@ import cgi
 import itertools
 import StringIO
 import subprocess
+import array
+import bisect
+import socket
+import httplib
 
 import gevent
 import gevent.pool
+import gevent.event
 import gevent.ssl
 import numpy
 import pymongo
 from geventhttpclient import HTTPClient
 from geventhttpclient.url import URL
+from geventhttpclient.response import HTTPConnectionClosed
 import lxml.html
 from PIL import Image
 
@@ -31,7 +37,7 @@ from jsonschema import FormatChecker, Draft4Validator, FormatError
 # not needed here but to ensure that installed
 import strict_rfc3339, rfc3987, aniso8601
 
-from lib import config, util_litecoin
+from lib import config, util_litecoin, cache
 
 JSONRPC_API_REQUEST_TIMEOUT = 10 #in seconds 
 D = decimal.Decimal
@@ -77,6 +83,78 @@ def assets_to_asset_pair(asset1, asset2):
         
     return (base, quote)
 
+HTTP_POOL_CONCURRENCY = 20 #max number of (keep-alive) connections to have open to any one host
+http_clients = {} #(scheme, host, port, timeout) -> pooled HTTPClient
+
+def get_http_client(u, timeout):
+    """returns the shared keep-alive HTTPClient (with its own connection pool) for the host of the given URL object"""
+    key = (u.scheme, u.host, u.port, timeout)
+    if key not in http_clients:
+        client_kwargs = {'connection_timeout': timeout, 'network_timeout': timeout, 'insecure': True,
+            'concurrency': HTTP_POOL_CONCURRENCY}
+        if u.scheme == "https": client_kwargs['ssl_options'] = {'cert_reqs': gevent.ssl.CERT_NONE}
+        http_clients[key] = HTTPClient.from_url(u, **client_kwargs)
+    return http_clients[key]
+
+inflight_requests = {} #request key -> AsyncResult for the (status_code, body) of the identical request in flight
+inflight_request_stats = {'requests': 0, 'coalesced': 0}
+COALESCED_JSONRPC_METHODS = ('sql',) #read only litetokensd API methods besides those with a cache.PROXY_CACHE_POLICIES policy
+
+def http_request(u, method, timeout, body=None, headers=None, coalesce=None):
+    """makes a HTTP request over a pooled keep-alive connection, and returns a (status_code, response body) tuple.
+    
+    If coalesce is set (which it is by default for GET requests), and an identical request is already in flight (e.g.
+    many clients asking for the same thing right as a new block comes in), this waits on and returns the result of
+    that request instead of making another one. Only set it for requests that are safe to make just once"""
+    if coalesce is None:
+        coalesce = method == 'GET'
+    if not coalesce:
+        return _http_request(u, method, timeout, body=body, headers=headers)
+    key = (str(u), method, body, tuple(sorted((headers or {}).items())))
+    inflight_request_stats['requests'] += 1
+    if key in inflight_requests:
+        inflight_request_stats['coalesced'] += 1
+        return inflight_requests[key].get()
+    
+    inflight_requests[key] = async_result = gevent.event.AsyncResult()
+    try:
+        result = _http_request(u, method, timeout, body=body, headers=headers)
+    except Exception, e:
+        async_result.set_exception(e)
+        raise
+    else:
+        async_result.set(result)
+        return result
+    finally:
+        del inflight_requests[key]
+
+def _http_request(u, method, timeout, body=None, headers=None):
+    """If the request fails, the host's connection pool is thrown away. If it failed before we got any response back
+    in a way a stale pooled connection does (e.g. one closed by the server while idle), it is retried once on a new
+    connection. Timeouts and failures after the response started are not retried, as the server may have acted on the
+    request (and some requests, e.g. broadcasting a transaction, must not be repeated)"""
+    for attempt in xrange(2):
+        client = get_http_client(u, timeout)
+        try:
+            r = client.request(method, u.request_uri, body=body, headers=headers or {})
+        except Exception, e:
+            _drop_http_client(u, timeout, client)
+            if attempt or isinstance(e, socket.timeout) \
+               or not isinstance(e, (socket.error, HTTPConnectionClosed, httplib.BadStatusLine)):
+                raise
+            logging.debug("Retrying HTTP request to %s on a new connection after: %s" % (u.host, e))
+            continue
+        try:
+            return r.status_code, r.read() #(reading the full body returns the connection to the pool)
+        except Exception:
+            _drop_http_client(u, timeout, client)
+            raise
+
+def _drop_http_client(u, timeout, client):
+    if http_clients.get((u.scheme, u.host, u.port, timeout)) is client:
+        del http_clients[(u.scheme, u.host, u.port, timeout)]
+    client.close()
+
 def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_error=False):
     if not endpoint: endpoint = config.LITETOKENSD_RPC
     if not auth: auth = config.LITETOKENSD_AUTH
@@ -90,48 +168,45 @@ def call_jsonrpc_api(method, params=None, endpoint=None, auth=None, abort_on_err
     }
     headers = {
         'Content-Type': 'application/json',
-        'Connection':'close', #no keepalive
     }
     if auth:
         #auth should be a (username, password) tuple, if specified
         headers['Authorization'] = http_basic_auth_str(auth[0], auth[1])
     
     try:
-        u = URL(endpoint)
-        client = HTTPClient.from_url(u, connection_timeout=JSONRPC_API_REQUEST_TIMEOUT,
-            network_timeout=JSONRPC_API_REQUEST_TIMEOUT)
-        r = client.post(u.request_uri, body=json.dumps(payload), headers=headers)
+        status_code, body = http_request(URL(endpoint), 'POST', JSONRPC_API_REQUEST_TIMEOUT,
+            body=json.dumps(payload, sort_keys=True), headers=headers, #(sorted so identical calls can be coalesced)
+            coalesce=method in COALESCED_JSONRPC_METHODS or cache.get_proxy_cache_policy(method) is not None)
     except Exception, e:
         raise Exception("Got call_jsonrpc_api request error: %s" % e)
-    else:
-        if r.status_code != 200 and abort_on_error:
-            raise Exception("Bad status code returned from litetokensd: '%s'. result body: '%s'." % (r.status_code, r.read()))
-        result = json.loads(r.read())
-    finally:
-        client.close()
+    if status_code != 200 and abort_on_error:
+        raise Exception("Bad status code returned from litetokensd: '%s'. result body: '%s'." % (status_code, body))
+    result = json.loads(body)
     
     if abort_on_error and 'error' in result:
         raise Exception("Got back error from server: %s" % result['error'])
     return result
 
-def get_url(url, abort_on_error=False, is_json=True, fetch_timeout=5):
-    headers = { 'Connection':'close', } #no keepalive
+def call_sql(query, bindings=None, abort_on_error=False):
+    """runs a read only query against litetokensd's database, and returns the result rows (as a list of dicts). The
+    query is run directly against the database if we have read access to it (see lib/litetokensd_db.py), falling
+    back to litetokensd's sql API call if that is not available or fails"""
+    if config.litetokensd_db:
+        try:
+            return config.litetokensd_db.query(query, bindings)
+        except Exception, e:
+            logging.warn("Direct litetokensd DB query failed (%s). Falling back to the sql API call ..." % e)
+    result = call_jsonrpc_api('sql', {'query': query, 'bindings': bindings or []}, abort_on_error=abort_on_error)
+    return result['result']
 
+def get_url(url, abort_on_error=False, is_json=True, fetch_timeout=5):
     try:
-        u = URL(url)
-        client_kwargs = {'connection_timeout': fetch_timeout, 'network_timeout': fetch_timeout, 'insecure': True}
-        if u.scheme == "https": client_kwargs['ssl_options'] = {'cert_reqs': gevent.ssl.CERT_NONE}
-        client = HTTPClient.from_url(u, **client_kwargs)
-        r = client.get(u.request_uri, headers=headers)
+        status_code, body = http_request(URL(url), 'GET', fetch_timeout)
     except Exception, e:
         raise Exception("Got get_url request error: %s" % e)
-    else:
-        if r.status_code != 200 and abort_on_error:
-            raise Exception("Bad status code returned: '%s'. result body: '%s'." % (r.status_code, r.read()))
-        result = json.loads(r.read()) if is_json else r.read()
-    finally:
-        client.close()
-    return result
+    if status_code != 200 and abort_on_error:
+        raise Exception("Bad status code returned: '%s'. result body: '%s'." % (status_code, body))
+    return json.loads(body) if is_json else body
 
 def get_address_cols_for_entity(entity):
     if entity in ['debits', 'credits']:
@@ -193,18 +268,98 @@ def json_dthandler(obj):
     else:
         raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
 
+class BlockTimeIndex(object):
+    """In-memory block_index -> block_time index of the blocks in processed_blocks, so that block times (and blocks by
+    time) can be looked up without going out to the database. Kept in step with processed_blocks by blockfeed.
+    
+    Block times are stored as epoch seconds in an array, along with the running maximum of the block times (as block
+    times aren't strictly increasing), which can be bisected to look up blocks by time."""
+    def __init__(self):
+        self.loaded = False #if False, callers should go to processed_blocks instead
+        self.first_block_index = None
+        self._times = array.array('l')
+        self._max_times = array.array('l')
+    
+    def load(self, mongo_db):
+        self.reset()
+        for block in mongo_db.processed_blocks.find(fields={'block_index': True, 'block_time': True}).sort('block_index', pymongo.ASCENDING):
+            if not self.append(block['block_index'], block['block_time']):
+                logging.warn("Gap in processed_blocks at block %i. Not using block time index." % block['block_index'])
+                self.loaded = False
+                return
+        logging.info("Loaded block time index (%i blocks)" % len(self._times))
+    
+    def reset(self):
+        """empties out the index (e.g. as processed_blocks has just been wiped)"""
+        self.first_block_index = None
+        del self._times[:]
+        del self._max_times[:]
+        self.loaded = True
+    
+    def append(self, block_index, block_time):
+        """adds a newly processed block. returns False (and stops using the index) if the block doesn't directly follow
+        the last block in the index"""
+        if not self.loaded:
+            return False
+        if self.first_block_index is None:
+            self.first_block_index = block_index
+        elif block_index != self.first_block_index + len(self._times):
+            self.loaded = False
+            return False
+        t = calendar.timegm(block_time.utctimetuple())
+        self._times.append(t)
+        self._max_times.append(max(t, self._max_times[-1]) if len(self._max_times) else t)
+        return True
+    
+    def truncate(self, max_block_index):
+        if self.first_block_index is None:
+            return
+        num_blocks = max(max_block_index - self.first_block_index + 1, 0)
+        del self._times[num_blocks:]
+        del self._max_times[num_blocks:]
+        if not num_blocks:
+            self.first_block_index = None
+    
+    def has_block(self, block_index):
+        return self.loaded and self.first_block_index is not None \
+            and self.first_block_index <= block_index < self.first_block_index + len(self._times)
+    
+    def get_last_block_index(self):
+        return self.first_block_index + len(self._times) - 1
+    
+    def get(self, block_index):
+        return datetime.datetime.utcfromtimestamp(self._times[block_index - self.first_block_index])
+    
+    def find_last_at_or_before(self, dt):
+        """returns the index of the last block before which (and at which) no block time is past dt, or None"""
+        i = bisect.bisect_right(self._max_times, calendar.timegm(dt.utctimetuple())) - 1
+        return self.first_block_index + i if i >= 0 else None
+    
+    def find_first_at_or_after(self, dt):
+        """returns the index of the first block with a block time at or past dt, or None"""
+        t = calendar.timegm(dt.utctimetuple()) + (1 if dt.microsecond else 0)
+        i = bisect.bisect_left(self._max_times, t)
+        return self.first_block_index + i if i < len(self._max_times) else None
+
+block_time_index = BlockTimeIndex()
+
 def get_block_indexes_for_dates(start_dt=None, end_dt=None):
     """Returns a 2 tuple (start_block, end_block) result for the block range that encompasses the given start_date
     and end_date unix timestamps"""
     mongo_db = config.mongo_db
+    use_index = block_time_index.loaded and block_time_index.first_block_index is not None
     if start_dt is None:
         start_block_index = config.BLOCK_FIRST
+    elif use_index:
+        start_block_index = block_time_index.find_last_at_or_before(start_dt) or config.BLOCK_FIRST
     else:
         start_block = mongo_db.processed_blocks.find_one({"block_time": {"$lte": start_dt} }, sort=[("block_time", pymongo.DESCENDING)])
         start_block_index = config.BLOCK_FIRST if not start_block else start_block['block_index']
     
     if end_dt is None:
         end_block_index = config.CURRENT_BLOCK_INDEX
+    elif use_index:
+        end_block_index = block_time_index.find_first_at_or_after(end_dt) or block_time_index.get_last_block_index()
     else:
         end_block = mongo_db.processed_blocks.find_one({"block_time": {"$gte": end_dt} }, sort=[("block_time", pymongo.ASCENDING)])
         if not end_block:
@@ -214,11 +369,36 @@ def get_block_indexes_for_dates(start_dt=None, end_dt=None):
     return (start_block_index, end_block_index)
 
 def get_block_time(block_index):
-    """TODO: implement result caching to avoid having to go out to the database"""
+    if block_time_index.has_block(block_index):
+        return block_time_index.get(block_index)
     block = config.mongo_db.processed_blocks.find_one({"block_index": block_index })
     if not block: return None
     return block['block_time']
 
+TRACKED_ASSET_CACHE_FIELDS = ('asset', 'owner', 'description', 'divisible', 'locked', 'total_issued',
+    'total_issued_normalized', '_at_block', '_at_block_time', '_change_type')
+#^ all fields of a tracked asset other than _id and _history (as assets.parse_issuance pushes it onto _history)
+tracked_asset_cache = {} #asset -> tuple of TRACKED_ASSET_CACHE_FIELDS values, for the current state of each tracked asset
+
+def cache_tracked_asset(tracked_asset):
+    """stores (or replaces) the current state of a tracked asset in the tracked asset cache"""
+    tracked_asset_cache[tracked_asset['asset']] = tuple(tracked_asset.get(f, None) for f in TRACKED_ASSET_CACHE_FIELDS)
+
+def clear_tracked_asset_cache():
+    """call after tracked_assets is modified by anything other than assets.parse_issuance (e.g. a prune or db rebuild)"""
+    tracked_asset_cache.clear()
+
+def get_tracked_asset(asset):
+    """returns the current asset, owner, description, divisible, locked and total_issued(_normalized) fields of a
+    tracked asset (along with its _at_block, _at_block_time and _change_type), without going out to the database if
+    possible. Returns None if the asset is not tracked (yet). NOTE: _history is not included, use tracked_assets
+    directly for that"""
+    if asset not in tracked_asset_cache:
+        tracked_asset = config.mongo_db.tracked_assets.find_one({'asset': asset}, {'_id': 0, '_history': 0})
+        if not tracked_asset: return None #don't cache misses
+        cache_tracked_asset(tracked_asset)
+    return dict(zip(TRACKED_ASSET_CACHE_FIELDS, tracked_asset_cache[asset]))
+
 def decorate_message(message, for_txn_history=False):
     #insert custom fields in certain events...
     #even invalid actions need these extra fields for proper reporting to the client (as the reporting message
@@ -233,7 +413,7 @@ def decorate_message(message, for_txn_history=False):
         if message['_category'] in ['bet_expirations', 'order_expirations', 'bet_match_expirations', 'order_match_expirations']:
             message['_tx_index'] = 0 #add tx_index to all entries (so we can sort on it secondarily in history view), since these lack it
     
-    if message['_category'] in ['credits', 'debits']:
+    if message['_category'] in ['credits', 'debits'] and '_balance' not in message:
         #find the last balance change on record
         bal_change = mongo_db.balance_changes.find_one({ 'address': message['address'], 'asset': message['asset'] },
             sort=[("block_time", pymongo.DESCENDING)])
@@ -242,14 +422,14 @@ def decorate_message(message, for_txn_history=False):
         message['_balance_normalized'] = bal_change['new_balance_normalized'] if bal_change else None
 
     if message['_category'] in ['orders',] and message['_command'] == 'insert':
-        get_asset_info = mongo_db.tracked_assets.find_one({'asset': message['get_asset']})
-        give_asset_info = mongo_db.tracked_assets.find_one({'asset': message['give_asset']})
+        get_asset_info = get_tracked_asset(message['get_asset'])
+        give_asset_info = get_tracked_asset(message['give_asset'])
         message['_get_asset_divisible'] = get_asset_info['divisible'] if get_asset_info else None
         message['_give_asset_divisible'] = give_asset_info['divisible'] if give_asset_info else None
     
     if message['_category'] in ['order_matches',] and message['_command'] == 'insert':
-        forward_asset_info = mongo_db.tracked_assets.find_one({'asset': message['forward_asset']})
-        backward_asset_info = mongo_db.tracked_assets.find_one({'asset': message['backward_asset']})
+        forward_asset_info = get_tracked_asset(message['forward_asset'])
+        backward_asset_info = get_tracked_asset(message['backward_asset'])
         message['_forward_asset_divisible'] = forward_asset_info['divisible'] if forward_asset_info else None
         message['_backward_asset_divisible'] = backward_asset_info['divisible'] if backward_asset_info else None
     
@@ -260,16 +440,17 @@ def decorate_message(message, for_txn_history=False):
         )
 
     if message['_category'] in ['dividends', 'sends', 'callbacks']:
-        asset_info = mongo_db.tracked_assets.find_one({'asset': message['asset']})
+        asset_info = get_tracked_asset(message['asset'])
         message['_divisible'] = asset_info['divisible'] if asset_info else None
     
     if message['_category'] in ['issuances',]:
         message['_quantity_normalized'] = util_litecoin.normalize_quantity(message['quantity'], message['divisible'])
     return message
 
-def decorate_message_for_feed(msg, msg_data=None):
+def decorate_message_for_feed(msg, msg_data=None, bal_change=None):
     """This function takes a message from litetokensd's message feed and mutates it a bit to be suitable to be
-    sent through the liteblockd message feed to an end-client"""
+    sent through the liteblockd message feed to an end-client. For credits/debits, bal_change is the balance change
+    record the message was booked into (if not yet written to mongo)"""
     if not msg_data:
         msg_data = json.loads(msg['bindings'])
     
@@ -280,6 +461,10 @@ def decorate_message_for_feed(msg, msg_data=None):
     message['_block_time'] = get_block_time(msg['block_index'])
     message['_category'] = msg['category']
     message['_status'] = msg_data.get('status', 'valid')
+    if bal_change:
+        message['_quantity_normalized'] = abs(bal_change['quantity_normalized'])
+        message['_balance'] = bal_change['new_balance']
+        message['_balance_normalized'] = bal_change['new_balance_normalized']
     message = decorate_message(message)
     return message
 
@@ -476,37 +661,29 @@ def init_geoip():
     download_geoip_data();
     return pygeoip.GeoIP(os.path.join(config.DATA_DIR, 'GeoIP.dat'))
 
+block_result_cache = cache.BlockResultCache() #(these are replaced on server init with ones configured with our
+proxy_result_cache = cache.ProxyResultCache() # cache size and redis client)
+
 def block_cache(func):
+    """caches the results of the wrapped function for the current block (see lib/cache.py). The wrapped function's
+    results must be JSON serializable, and must not be modified by callers"""
     def cached_function(*args, **kwargs):
-        
-        function_signature = hashlib.sha256(func.__name__ + str(args) + str(kwargs)).hexdigest()
-
-        sql = "SELECT block_index FROM blocks ORDER BY block_index DESC LIMIT 1"
-        block_index = call_jsonrpc_api('sql', {'query': sql, 'bindings': []})['result'][0]['block_index']
-
-        cached_result = config.mongo_db.liteblockd_cache.find_one({'block_index': block_index, 'function': function_signature})
-
-        if not cached_result or config.TESTNET:
-            #logging.info("generate cache ({}, {}, {})".format(func.__name__, block_index, function_signature))
-            try:
-                result = func(*args, **kwargs)
-                config.mongo_db.liteblockd_cache.insert({
-                    'block_index': block_index, 
-                    'function': function_signature,
-                    'result': json.dumps(result)
-                })
-                return result
-            except Exception, e:
-                logging.exception(e)
-        else:
-            #logging.info("result from cache ({}, {}, {})".format(func.__name__, block_index, function_signature))
-            result = json.loads(cached_result['result'])
-            return result
+        try:
+            return block_result_cache.get_or_compute(func.__name__, func, args, kwargs)
+        except Exception, e:
+            logging.exception(e)
             
     return cached_function
 
 
 def clean_block_cache(block_index):
-    #logging.info("clean block cache lower than {}".format(block_index))
-    config.mongo_db.liteblockd_cache.remove({'block_index': {'$lt': block_index}})
+    #logging.info("clean block cache for new block {}".format(block_index))
+    block_result_cache.invalidate()
+    proxy_result_cache.invalidate()
+
+def purge_block_cache():
+    """call when blocks are rolled back (or the database is rebuilt), so that results cached for the old blocks (in
+    memory or in redis) aren't served again once we're back at the same block heights"""
+    block_result_cache.purge()
+    proxy_result_cache.purge()
 
@@ -28,7 +28,7 @@ redis.connection.socket = gevent.socket #make redis play well with gevent
 from socketio import server as socketio_server
 import pygeoip
 
-from lib import (config, api, events, blockfeed, siofeeds, util)
+from lib import (config, api, events, blockfeed, siofeeds, util, litetokensd_db, cache)
 
 
 if __name__ == '__main__':
@@ -38,6 +38,8 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='sets log level to DEBUG instead of WARNING')
 
     parser.add_argument('--reparse', action='store_true', default=False, help='force full re-initialization of the liteblockd database')
+    parser.add_argument('--reparse-from', type=int, metavar='BLOCK', help='roll the liteblockd database back to just before the given block, and reparse from there')
+    parser.add_argument('--checkpoint-interval', type=int, help='write a database checkpoint every this many blocks (0 to disable)')
     parser.add_argument('--testnet', action='store_true', default=False, help='use Litecoin testnet addresses and block numbers')
     parser.add_argument('--data-dir', help='specify to explicitly override the directory in which to keep the config file and log file')
     parser.add_argument('--config-file', help='the location of the configuration file')
@@ -50,6 +52,9 @@ if __name__ == '__main__':
     parser.add_argument('--litetokensd-rpc-port', type=int, help='the port used to communicate with litetokensd over JSON-RPC')
     parser.add_argument('--litetokensd-rpc-user', help='the username used to communicate with litetokensd over JSON-RPC')
     parser.add_argument('--litetokensd-rpc-password', help='the password used to communicate with litetokensd over JSON-RPC')
+    parser.add_argument('--litetokensd-zmq-connect', help='the ZMQ endpoint litetokensd (or a relay) publishes new block/message notifications on, if any')
+    parser.add_argument('--litetokensd-db-path', help='the path to the litetokensd database file, to watch for changes (if litetokensd runs on this host)')
+    parser.add_argument('--litetokensd-db-direct-reads', action='store_true', default=False, help='run read only queries directly against the litetokensd database file at --litetokensd-db-path, instead of through litetokensd\'s sql API call')
 
     parser.add_argument('--blockchain-service-name', help='the blockchain service name to connect to')
     parser.add_argument('--blockchain-service-connect', help='the blockchain service server URL base to connect to, if not default')
@@ -60,6 +65,7 @@ if __name__ == '__main__':
     parser.add_argument('--mongodb-user', help='the optional username used to communicate with mongodb')
     parser.add_argument('--mongodb-password', help='the optional password used to communicate with mongodb')
 
+    parser.add_argument('--api-cache-size', type=int, metavar='MB', help='the amount of memory to use for caching API results in-process, in MB (default 64)')
     parser.add_argument('--redis-enable-apicache', action='store_true', default=False, help='set to true to enable caching of API requests')
     parser.add_argument('--redis-connect', help='the hostname of the redis server to use for caching (if enabled')
     parser.add_argument('--redis-port', type=int, help='the port used to connect to the redis server for caching (if enabled)')
@@ -110,6 +116,15 @@ if __name__ == '__main__':
         
     # reparse
     config.REPARSE_FORCED = args.reparse
+    config.REPARSE_FROM = args.reparse_from
+
+    # checkpoints
+    if args.checkpoint_interval is not None:
+        config.CHECKPOINT_INTERVAL = args.checkpoint_interval
+    elif has_config and configfile.has_option('Default', 'checkpoint-interval') and configfile.get('Default', 'checkpoint-interval'):
+        config.CHECKPOINT_INTERVAL = configfile.getint('Default', 'checkpoint-interval')
+    else:
+        config.CHECKPOINT_INTERVAL = 10000
         
     ##############
     # THINGS WE CONNECT TO
@@ -154,6 +169,32 @@ if __name__ == '__main__':
     else:
         config.LITETOKENSD_RPC_PASSWORD = 'rpcpassword'
 
+    # litetokensd ZMQ notification endpoint
+    if args.litetokensd_zmq_connect:
+        config.LITETOKENSD_ZMQ_CONNECT = args.litetokensd_zmq_connect
+    elif has_config and configfile.has_option('Default', 'litetokensd-zmq-connect') and configfile.get('Default', 'litetokensd-zmq-connect'):
+        config.LITETOKENSD_ZMQ_CONNECT = configfile.get('Default', 'litetokensd-zmq-connect')
+    else:
+        config.LITETOKENSD_ZMQ_CONNECT = None
+
+    # litetokensd database file (to watch for new blocks)
+    if args.litetokensd_db_path:
+        config.LITETOKENSD_DB_PATH = args.litetokensd_db_path
+    elif has_config and configfile.has_option('Default', 'litetokensd-db-path') and configfile.get('Default', 'litetokensd-db-path'):
+        config.LITETOKENSD_DB_PATH = configfile.get('Default', 'litetokensd-db-path')
+    else:
+        config.LITETOKENSD_DB_PATH = None
+
+    # litetokensd database direct reads
+    if args.litetokensd_db_direct_reads:
+        config.LITETOKENSD_DB_DIRECT_READS = args.litetokensd_db_direct_reads
+    elif has_config and configfile.has_option('Default', 'litetokensd-db-direct-reads') and configfile.get('Default', 'litetokensd-db-direct-reads'):
+        config.LITETOKENSD_DB_DIRECT_READS = configfile.getboolean('Default', 'litetokensd-db-direct-reads')
+    else:
+        config.LITETOKENSD_DB_DIRECT_READS = False
+    if config.LITETOKENSD_DB_DIRECT_READS and not config.LITETOKENSD_DB_PATH:
+        raise Exception("litetokensd-db-direct-reads requires litetokensd-db-path to be set")
+
     config.LITETOKENSD_RPC = 'http://' + config.LITETOKENSD_RPC_CONNECT + ':' + str(config.LITETOKENSD_RPC_PORT) + '/api/'
     config.LITETOKENSD_AUTH = (config.LITETOKENSD_RPC_USER, config.LITETOKENSD_RPC_PASSWORD) if (config.LITETOKENSD_RPC_USER and config.LITETOKENSD_RPC_PASSWORD) else None
 
@@ -267,6 +308,16 @@ if __name__ == '__main__':
     except:
         raise Exception("Please specific a valid redis-database configuration parameter (between 0 and 16 inclusive)")
 
+    # API result cache size
+    if args.api_cache_size is not None:
+        config.API_CACHE_SIZE = args.api_cache_size
+    elif has_config and configfile.has_option('Default', 'api-cache-size') and configfile.get('Default', 'api-cache-size'):
+        config.API_CACHE_SIZE = configfile.getint('Default', 'api-cache-size')
+    else:
+        config.API_CACHE_SIZE = 64
+    if config.API_CACHE_SIZE < 0:
+        raise Exception("Please specify a valid api-cache-size configuration parameter (in MB, 0 to disable)")
+
     # redis connect
     if args.armory_utxsvr_enable:
         config.ARMORY_UTXSVR_ENABLE = args.armory_utxsvr_enable
@@ -528,10 +579,16 @@ if __name__ == '__main__':
             raise Exception("Could not authenticate to mongodb with the supplied username and password.")
     config.mongo_db = mongo_db #should be able to access fine across greenlets, etc
 
+    if config.LITETOKENSD_DB_DIRECT_READS:
+        logging.info("Using direct read access to litetokensd database at %s ..." % config.LITETOKENSD_DB_PATH)
+        config.litetokensd_db = litetokensd_db.LitetokensdDB(config.LITETOKENSD_DB_PATH)
+
     #insert mongo indexes if need-be (i.e. for newly created database)
     ##COLLECTIONS THAT ARE PURGED AS A RESULT OF A REPARSE
     #processed_blocks
     mongo_db.processed_blocks.ensure_index('block_index', unique=True)
+    #undo_journal
+    mongo_db.undo_journal.ensure_index('block_index', unique=True)
     #tracked_assets
     mongo_db.tracked_assets.ensure_index('asset', unique=True)
     mongo_db.tracked_assets.ensure_index('_at_block') #for tracked asset pruning
@@ -551,6 +608,34 @@ if __name__ == '__main__':
         ("quote_asset", pymongo.ASCENDING)
     ])
 
+    #trade_candles
+    mongo_db.trade_candles.ensure_index([
+        ("base_asset", pymongo.ASCENDING),
+        ("quote_asset", pymongo.ASCENDING),
+        ("interval", pymongo.ASCENDING),
+        ("interval_time", pymongo.ASCENDING)
+    ], unique=True)
+    mongo_db.trade_candles.ensure_index('last_block_index')
+
+    #order_matches
+    mongo_db.order_matches.ensure_index('id', unique=True)
+    mongo_db.order_matches.ensure_index('block_index')
+    mongo_db.order_matches.ensure_index('status_history.block_index') #for rolling back status changes
+    mongo_db.order_matches.ensure_index([
+        ("pair", pymongo.ASCENDING),
+        ("tx_index", pymongo.DESCENDING)
+    ])
+    mongo_db.order_matches.ensure_index([ #dex.get_pairs
+        ("forward_asset", pymongo.ASCENDING),
+        ("status", pymongo.ASCENDING)
+    ])
+    mongo_db.order_matches.ensure_index([ #dex.get_pairs
+        ("backward_asset", pymongo.ASCENDING),
+        ("status", pymongo.ASCENDING)
+    ])
+    mongo_db.order_matches.ensure_index('tx0_address')
+    mongo_db.order_matches.ensure_index('tx1_address')
+
     #balance_changes
     mongo_db.balance_changes.ensure_index('block_index')
     mongo_db.balance_changes.ensure_index([
@@ -624,6 +709,8 @@ if __name__ == '__main__':
     mongo_db.feeds.ensure_index('info_url')
     #mempool
     mongo_db.mempool.ensure_index('tx_hash')
+    #liteblockd_cache (no longer used -- API results are now cached in memory and optionally in redis, see lib/cache.py)
+    mongo_db.liteblockd_cache.drop()
     
     #Connect to redis
     if config.REDIS_ENABLE_APICACHE:
@@ -631,6 +718,9 @@ if __name__ == '__main__':
         redis_client = redis.StrictRedis(host=config.REDIS_CONNECT, port=config.REDIS_PORT, db=config.REDIS_DATABASE)
     else:
         redis_client = None
+    api_cache_lru = cache.LRUCache(config.API_CACHE_SIZE * 1024 * 1024) #(shared by the caches below)
+    util.block_result_cache = cache.BlockResultCache(api_cache_lru, redis_client)
+    util.proxy_result_cache = cache.ProxyResultCache(api_cache_lru, redis_client)
     
     #set up zeromq publisher for sending out received events to connected socket.io clients
     zmq_context = zmq.Context()